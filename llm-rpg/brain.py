@@ -1,13 +1,38 @@
 import random
-from pathfinding import a_star_pathfinding
-from constants import SCREEN_WIDTH, SCREEN_HEIGHT, GRID_SIZE, COLORS
-from llm import prompt, get_context
+from pathfinding import a_star_pathfinding, jps_pathfinding, occupied_cells
+from incremental import DStarLite
+from cooperative import COOPERATIVE_PLANNER
+from path_scheduler import PATH_SCHEDULER, WAITING, REFRESH
+from path_workers import PATH_WORKERS
+from hierarchy import hierarchical_pathfinding
+from path_cache import PATH_CACHE
+from flow_field import FlowPath, get_flow_field
+from pursuit import PURSUIT
+from constants import SCREEN_WIDTH, SCREEN_HEIGHT, GRID_SIZE, COLORS, USE_FLOW_FIELDS, PATHFINDING_ENGINE, NPC_PATHFINDING_ENGINE, COOPERATIVE_PATHFINDING, USE_PATH_SCHEDULER, USE_PATH_WORKERS, PURSUIT_MODE, USE_ASYNC_LLM, USE_DECISION_BATCHING, USE_DECISION_RULES, USE_NPC_MEMORY, MEMORY_TOP_K
+from llm import prompt, get_context, decision_messages, decide
+from llm_pipeline import LLM_PIPELINE
+from decision_batch import DECISION_BATCHER
+from decision_rules import DECISION_RULES
+from plans import PLANS, parse_plan
+from prefetch import PREFETCHER, PREFETCH_PENDING
+from vector_memory import VectorMemory
+
+# All take (start, target, game_map, current_npc), picked by name in constants.py
+PATHFINDING_ENGINES = {
+    'astar': a_star_pathfinding,
+    'jps': jps_pathfinding,
+    'hierarchical': hierarchical_pathfinding,
+    'cached': PATH_CACHE.find_path,
+}
+
 class Brain:
     def __init__(self, parent_npc):
         self.parent_npc = parent_npc
         self.memory = Memory()
         self.target = None
         self.path = None
+        self.planner = None  # incremental.DStarLite, kept across replans towards the same goal
+        self.path_pending = False  # a planner outside this Brain will fill in self.path
 
         # Dialogue-related attributes  
         
@@ -16,12 +41,60 @@ class Brain:
         self.last_actions = []
 
     def decide_action(self, game_map, all_npcs):
-        """Decide on the next action for the NPC."""
+        """
+        Decide on the next action for the NPC. A decision PREFETCHER asked for ahead of time
+        is used if the NPC ended up as expected, obvious cases are answered on the spot by
+        DECISION_RULES, the rest go to the LLM. With USE_ASYNC_LLM this only sends the
+        request (or hands it to DECISION_BATCHER), the action is queued by apply_decision
+        once LLM_PIPELINE has the answer and the NPC idles meanwhile.
+        """
         
         # action = random.choice(['converse', 'pathfind', 'buy_food', 'eat', 'do_job'])
         # context = get_context(self.parent_npc, game_map, all_npcs)
-        action_data = prompt(self.parent_npc, game_map, all_npcs, self.last_actions)
+        if LLM_PIPELINE.is_pending(self.parent_npc) or DECISION_BATCHER.is_pending(self.parent_npc) \
+                or self.parent_npc.owes_replies:
+            return  # a decision, or a reply that keeps the conversation going, is on its way
+        if PREFETCHER.enabled and USE_ASYNC_LLM:
+            prefetched = PREFETCHER.take(self.parent_npc, game_map)
+            if prefetched is PREFETCH_PENDING:
+                return
+            if prefetched is not None:
+                action_data, self.parent_npc.reasoning_history = prefetched
+                self.apply_decision(action_data, game_map, all_npcs)
+                return
+        if USE_DECISION_RULES:
+            action_data = DECISION_RULES.decide(self.parent_npc, game_map, all_npcs)
+            if action_data is not None:
+                self.apply_decision(action_data, game_map, all_npcs)
+                return
+        if not USE_ASYNC_LLM:
+            self.apply_decision(prompt(self.parent_npc, game_map, all_npcs, self.last_actions), game_map, all_npcs)
+            return
+        if USE_DECISION_BATCHING:
+            DECISION_BATCHER.add(self.parent_npc, game_map, all_npcs)
+            return
+        messages = decision_messages(self.parent_npc, game_map, all_npcs, self.last_actions)
+
+        def apply(result):
+            action_data, self.parent_npc.reasoning_history = result
+            self.apply_decision(action_data, game_map, all_npcs)
+
+        def fail(error):
+            self.parent_npc.add_log(f"NPC {COLORS[self.parent_npc.color]} couldn't decide what to do ({error}).")
+
+        LLM_PIPELINE.submit(self.parent_npc, decide(messages, all_npcs, game_map, self.parent_npc), apply, fail)
+
+    def prefetch(self, game_map, all_npcs):
+        """Ask for the next decision ahead of time if the queue is about to run out."""
+        if PREFETCHER.enabled and USE_ASYNC_LLM and not USE_DECISION_BATCHING:
+            PREFETCHER.request(self.parent_npc, game_map, all_npcs, self.last_actions)
+
+    def apply_decision(self, action_data, game_map, all_npcs):
+        """Queue the action the LLM (or a rule) picked."""
         action = action_data['type']
+        if action == 'queue_multiple_actions':
+            self.apply_plan(action_data, game_map, all_npcs)
+            return
         self.last_actions.append(action)
         if len(self.last_actions)>3: self.last_actions.pop(0)
 
@@ -45,8 +118,8 @@ class Brain:
             loc = action_data['target'].split(':')[-1]
             target_location = game_map._find_location_by_name(loc)
             if target_location:
-                target_location = target_location.get_random_point(game_map)
-                self.parent_npc.queue_action(action, target_location)
+                target_point = target_location.get_random_point(game_map)
+                self.parent_npc.queue_action(action, target_point, location=target_location)
             else:
                 target_npc_name = action_data['target']
                 target_npc = None
@@ -66,6 +139,20 @@ class Brain:
         else:
             self.parent_npc.queue_action(action)
 
+    def apply_plan(self, action_data, game_map, all_npcs):
+        """Queue every usable step of a plan, tagged with it so a failed step can drop the rest."""
+        steps = action_data.get('actions')
+        parsed, error = parse_plan(steps, game_map, all_npcs, npc=self.parent_npc)
+        if error:
+            self.parent_npc.add_log(f"NPC {COLORS[self.parent_npc.color]}'s plan was cut short, {error}.")
+        plan = PLANS.start(parsed, cut=len(steps) - len(parsed) if isinstance(steps, list) else 0)
+        queue = self.parent_npc.action_queue
+        for step in parsed:
+            queued = len(queue)
+            self.apply_decision(step, game_map, all_npcs)
+            for action in list(queue)[queued:]:
+                action.plan = plan
+
 
     # def decide_action(self, game_map, all_npcs):
     #     action = random.choice(['converse', 'pathfind', 'buy_food', 'eat', 'do_job'])
@@ -139,25 +226,110 @@ class Brain:
     #             print(f"NPC {COLORS[self.parent_npc.color]} is targeting ({x}, {y})")
     #             break
     
+    def _target_position(self, action):
+        if not isinstance(action.target, tuple):
+            return {'type': 'npc',
+                    'data': (action.target.x, action.target.y),
+                    'npc': action.target}
+        return {'type': 'coords',
+                'data': action.target,}
+
     def determine_path(self, current_position, game_map):
         current_action = self.parent_npc.action_queue[0] if self.parent_npc.action_queue else None
         if current_action and current_action.type == 'pathfind':
-            if not isinstance(current_action.target, tuple):
-                target_position = {'type': 'npc',
-                                   'data': (current_action.target.x, current_action.target.y),
-                                   'npc': current_action.target}
-                pass
-            else:
-                target_position = {'type': 'coords',
-                                   'data': current_action.target,}
-                pass
+            target_position = self._target_position(current_action)
             self.target_position = target_position['data']
-            self.path = a_star_pathfinding(current_position, target_position, game_map, {'type': 'npc', 'data': (self.parent_npc.x, self.parent_npc.y), 'npc': self.parent_npc})
+            current_npc = {'type': 'npc', 'data': (self.parent_npc.x, self.parent_npc.y), 'npc': self.parent_npc}
+            if COOPERATIVE_PATHFINDING and current_position != target_position['data']:
+                # Planned with everyone else's requests at the start of the next tick
+                self.path = None
+                self.path_pending = True
+                COOPERATIVE_PLANNER.request(self.parent_npc)
+            elif COOPERATIVE_PATHFINDING:
+                self.path = []
+            elif USE_PATH_WORKERS:
+                # Solved in a worker process, the NPC waits until the game loop collects it
+                PATH_WORKERS.submit(self.parent_npc, current_action, current_position, target_position, game_map)
+                self.path_pending = not self.path
+            elif USE_PATH_SCHEDULER:
+                # Searched within the per-frame budget; without a path the NPC waits meanwhile
+                PATH_SCHEDULER.submit(self.parent_npc, current_action, current_position, target_position, game_map,
+                                      priority=REFRESH if self.path else WAITING)
+                self.path_pending = not self.path
+            elif USE_FLOW_FIELDS and current_action.location is not None:
+                # Follow the location's shared distance field instead of searching
+                self.path = FlowPath(get_flow_field(game_map, current_action.location), self.parent_npc)
+            elif target_position['type'] == 'coords':
+                engine = PATHFINDING_ENGINES[PATHFINDING_ENGINE]
+                self.path = engine(current_position, target_position, game_map, current_npc)
+            else:
+                engine = PATHFINDING_ENGINES[NPC_PATHFINDING_ENGINE]
+                self.path = engine(current_position, target_position, game_map, current_npc)
             
         else:
             Exception("No pathfinding action in queue")
 
-    
+    def receive_path(self, path):
+        """Take a path that was planned outside determine_path (path_scheduler, cooperative)."""
+        self.path_pending = False
+        if not path and self.path:
+            return  # a refresh found nothing better, keep walking the old path
+        self.path = path
+        if not path:
+            # nowhere to go, same as a failed search in NPC._execute_pathfind
+            if path is None:
+                self.parent_npc.action_failed(self.parent_npc.action_queue[0])
+            self.parent_npc.action_queue.popleft()
+            self.parent_npc.resume_previous_action()
+
+    def replan(self, current_position, game_map):
+        """
+        Repair the path after the next step turned out to be taken. The D* Lite planner
+        is kept between calls, so NPCs shuffling around a doorway only cost the cells
+        that changed. It starts over when the goal or the walls change.
+        """
+        current_action = self.parent_npc.action_queue[0] if self.parent_npc.action_queue else None
+        if not current_action or current_action.type != 'pathfind':
+            self.path = None
+            return
+        if COOPERATIVE_PATHFINDING:
+            self.determine_path(current_position, game_map)
+            return
+        target_position = self._target_position(current_action)
+        self.target_position = target_position['data']
+        blocked = occupied_cells(target_position, {'type': 'npc', 'data': current_position})
+        if self.planner is None or self.planner.goal != target_position['data'] or self.planner.version != game_map.version:
+            self.planner = DStarLite(game_map, current_position, target_position['data'], blocked)
+        else:
+            self.planner.move_start(current_position)
+            self.planner.update_blocked(blocked)
+        self.path = self.planner.path()
+
+    def follow_target(self, current_position, game_map):
+        """
+        Pursuit of an NPC target: whenever the target has changed cell, move the end of the
+        current path to it with PURSUIT instead of searching again. Returns False when this
+        doesn't apply (coordinate target, cooperative plans, a path that isn't a plain list),
+        so the caller falls back to target_has_moved_significantly.
+        """
+        action = self.parent_npc.action_queue[0] if self.parent_npc.action_queue else None
+        if not PURSUIT_MODE or COOPERATIVE_PATHFINDING or not action or action.type != 'pathfind':
+            return False
+        if isinstance(action.target, tuple) or not isinstance(self.path, list):
+            return False
+        target_position = self._target_position(action)
+        goal = target_position['data']
+        if goal == self.target_position:
+            return True
+        blocked = occupied_cells(target_position, {'type': 'npc', 'data': current_position})
+        path = PURSUIT.retarget(self.path, current_position, goal, game_map, blocked)
+        if path is None:
+            self.determine_path(current_position, game_map)
+        else:
+            self.path = path
+            self.target_position = goal
+        return True
+
     # def determine_path(self, current_position, game_map):
     #     if self.target:
     #         if self.target['type']=='npc': self.target['data'] = (self.target['npc'].x, self.target['npc'].y)
@@ -194,6 +366,17 @@ class Brain:
 class Memory:
     def __init__(self):
         self.associations = {}
+        self.events = VectorMemory() if USE_NPC_MEMORY else None  # what the NPC saw and heard
 
     def associate(self, entity, location):
         self.associations[entity] = location
+
+    def remember(self, text):
+        if self.events is not None:
+            self.events.remember(text)
+
+    def recall(self, query, k=MEMORY_TOP_K, exclude=()):
+        """The k memories most relevant to query, none with USE_NPC_MEMORY off."""
+        if self.events is None:
+            return []
+        return self.events.recall(query, k, exclude)
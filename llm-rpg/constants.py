@@ -8,3 +8,83 @@ IMAGE_PATH = 'llm-rpg/images/maps/map_image.png'
 BLACK = (0, 0, 0)
 WHITE = (255, 255, 255)
 COLORS = {(255, 0, 0): "RED", (0, 255, 0): "GREEN", (0, 0, 255): "BLUE"}
+
+# NPC index
+SPATIAL_BUCKET_SIZE = 8  # cells per side of a spatial_hash.SpatialHash bucket
+CONTEXT_NPC_LIMIT = 10  # nearest NPCs listed in the LLM context
+
+# NPC memory (vector_memory.VectorMemory per NPC), the most relevant memories go in the LLM context
+USE_NPC_MEMORY = True
+MEMORY_EMBEDDING = 'hashing'  # from vector_memory.EMBEDDINGS
+MEMORY_DIM = 256  # embedding size
+MEMORY_CAPACITY = 2000  # memories per NPC, the oldest are forgotten first
+MEMORY_TOP_K = 5  # memories put in each context
+MEMORY_MIN_SCORE = 0.05  # least similarity for a memory to count as relevant, about one shared word
+MEMORY_ANN_MIN = 512  # memories from which searches are approximate (clustered) instead of exact
+MEMORY_ANN_PROBES = 8  # clusters searched per query, out of sqrt(memories)
+MEMORY_HISTORY_TURNS = 2  # LLM_HISTORY_TURNS when NPC memory is on, memories stand in for older turns
+
+# Decision rules (decision_rules.DECISION_RULES), tried before the LLM
+USE_DECISION_RULES = True
+RULE_HUNGER = 70  # hunger (it counts up to 100) from which eating or getting food is obvious
+RULE_LOW_CURRENCY = 10  # below this, go and work
+RULE_LOW_SOCIAL = 30  # below this, talk to the nearest NPC
+
+# LLM
+LLM_BACKEND = 'openai'  # from llm_backends.LLM_BACKENDS: 'openai', or 'standin' for offline load tests
+LLM_MODEL = 'gpt-3.5-turbo'
+LLM_PROMPT_BUDGET = 2000  # most tokens in a decision prompt, tool schemas included (history.HISTORY)
+LLM_SUMMARY_BUDGET = 200  # tokens of rolling summary of folded turns and logs
+LLM_LOG_BUDGET = 200  # tokens of game logs since the last decision sent as they are
+LLM_HISTORY_TURNS = 6  # most earlier messages kept as they are, the rest are summarized
+LLM_MAX_CONNECTIONS = 32  # pooled HTTP connections per backend
+LLM_KEEPALIVE_S = 60  # how long an idle pooled connection is kept open
+STANDIN_LATENCY_MS = 800  # median latency of the stand-in backend
+STANDIN_LATENCY_SPREAD = 0.5  # sigma of the stand-in's lognormal latency
+STANDIN_ERROR_RATE = 0.02  # fraction of stand-in calls that fail with a 429 or 503
+STANDIN_COMPLETION_TOKENS = 40  # mean completion tokens per stand-in answer
+STANDIN_SEED = 0
+LLM_DECISION_RETRIES = 1  # times an invalid decision is sent back to the LLM before falling back
+LLM_FALLBACK_ACTIVITY = 'waits around, unsure what to do'  # activity an NPC falls back to without a valid decision
+LLM_REQUESTS_PER_MIN = 3500  # llm_governor.LLM_GOVERNOR keeps every call under these provider limits
+LLM_TOKENS_PER_MIN = 90000
+LLM_BURST_S = 10  # seconds' worth of the per-minute limits that can go out at once
+LLM_MAX_IN_FLIGHT = 16  # most LLM calls out at once
+LLM_COMPLETION_TOKENS = 100  # completion tokens counted per call on top of its prompt
+LLM_PRIORITY_AGING_S = 2.0  # seconds of waiting that move a call up one priority class
+LLM_RETRIES = 3  # retries of a call after a 429, 503 or connection error
+LLM_BACKOFF_S = 0.5  # first retry backoff, doubled each retry and jittered by +-50%
+LLM_BACKOFF_MAX_S = 20
+USE_ASYNC_LLM = True  # make LLM calls through llm_pipeline.LLM_PIPELINE without blocking the game loop
+USE_DECISION_BATCHING = False  # send decisions in batches with decision_batch.DECISION_BATCHER (needs USE_ASYNC_LLM)
+DECISION_BATCH_WINDOW_MS = 50  # how long the first request in a batch waits for others
+DECISION_BATCH_SIZE = 8  # most NPCs per batch
+DECISION_BATCH_MODE = 'combined'  # 'combined' = one multi-NPC prompt, 'parallel' = per-NPC prompts sent together
+USE_LLM_CACHE = True  # answer repeated prompts from llm_cache.LLM_CACHE
+LLM_CACHE_SIZE = 1024  # responses kept in memory, the rest are on disk
+LLM_CACHE_PATH = 'cache/llm_responses.sqlite'  # relative to this directory, None = memory only
+LLM_CACHE_TTL = 7 * 24 * 3600  # seconds a cached response is used for, None = forever
+LLM_CACHE_STAT_STEP = 10  # stats in the context are rounded down to this step for the cache key, 0 = exact
+USE_PREFETCH = True  # ask for the next decision before the queue runs out with prefetch.PREFETCHER (needs USE_ASYNC_LLM)
+PREFETCH_STEPS = 20  # ticks of queued work left when the next decision is asked for
+PREFETCH_TOLERANCE = 5  # how far each stat may be off the projection for a prefetched decision to be used
+PLAN_MAX_STEPS = 8  # most steps queued from one queue_multiple_actions call
+PLAN_FAILURE_POLICY = 'abort'  # when a plan step fails: 'abort' drops the rest of the plan, 'continue' keeps going
+
+# Pathfinding
+# Engines from brain.PATHFINDING_ENGINES: 'cached' (door graph routes and door to door paths from path_cache.PATH_CACHE), 'hierarchical', 'astar', 'jps'
+PATHFINDING_ENGINE = 'cached'  # for fixed coordinate targets
+NPC_PATHFINDING_ENGINE = 'astar'  # for NPC targets, which move so aren't worth caching
+PATH_CACHE_SIZE = 256  # routes and door to door paths kept by path_cache.PATH_CACHE
+PATH_REPAIR_EXPANSIONS = 200  # node budget for a local detour around NPCs before a full re-search
+USE_FLOW_FIELDS = False  # pathfind to Locations by following a shared flow_field.FlowField
+COOPERATIVE_PATHFINDING = False  # plan paths in per-tick batches with cooperative.COOPERATIVE_PLANNER
+COOPERATIVE_WINDOW = 16  # ticks of (cell, tick) reservations per cooperative plan
+USE_PATH_SCHEDULER = False  # search in path_scheduler.PATH_SCHEDULER under a per-frame time budget
+PATHFINDING_BUDGET_MS = 2.0  # pathfinding time allowed per frame
+PATHFINDING_SLICE = 64  # node expansions between budget checks
+USE_PATH_WORKERS = False  # search in path_workers.PATH_WORKERS processes
+PATH_WORKER_COUNT = None  # None = one per CPU
+PATH_WORKER_BATCH = 32  # most requests sent to a worker at once
+PURSUIT_MODE = True  # follow moving NPC targets with pursuit.PURSUIT instead of re-searching
+PURSUIT_REPAIR_EXPANSIONS = 64  # node budget to extend a pursuit path before a full search
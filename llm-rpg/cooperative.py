@@ -0,0 +1,223 @@
+import heapq
+from collections import OrderedDict, deque
+from constants import COOPERATIVE_WINDOW
+from globals import NPC_REGISTRY
+from pathfinding import NEIGHBORS
+
+WAIT = (0, 0)
+MAX_EXPANSIONS = 5000  # per space-time search
+DISTANCE_FIELDS = 64  # goals whose true-distance heuristic is kept
+
+
+class ReservationTable:
+    """(cell, tick) slots claimed by NPCs for the steps they've planned."""
+    def __init__(self):
+        self.slots = {}
+        self.by_npc = {}
+
+    def owner(self, cell, tick):
+        return self.slots.get((cell, tick))
+
+    def reserve(self, npc, cell, tick):
+        self.slots[(cell, tick)] = npc
+        self.by_npc.setdefault(npc, []).append((cell, tick))
+
+    def release(self, npc):
+        for slot in self.by_npc.pop(npc, []):
+            if self.slots.get(slot) is npc:
+                del self.slots[slot]
+
+    def prune(self, before_tick):
+        for npc in list(self.by_npc):
+            kept = []
+            for slot in self.by_npc[npc]:
+                if slot[1] < before_tick:
+                    if self.slots.get(slot) is npc:
+                        del self.slots[slot]
+                else:
+                    kept.append(slot)
+            if kept:
+                self.by_npc[npc] = kept
+            else:
+                del self.by_npc[npc]
+
+
+class CooperativePlanner:
+    """
+    Windowed Hierarchical Cooperative A* (WHCA*). Pathfind requests made during a tick are
+    planned together at the start of the next one: each NPC runs a space-time A* over the
+    next `window` ticks that avoids every slot already reserved, reserves its own steps,
+    and follows the static shortest path past the window. NPCs re-plan every half window
+    so their reservations always reach ahead. NPCs without a plan are treated as standing
+    still. No two NPCs hold the same cell in consecutive ticks, which also rules out swaps,
+    so moving the NPCs one after the other in the game loop can't collide.
+    """
+    def __init__(self, window=COOPERATIVE_WINDOW):
+        self.window = window
+        self.tick = 0
+        self.table = ReservationTable()
+        self.pending = OrderedDict()  # npc -> None, in request order
+        self.planned_at = {}  # npc -> tick its current plan was made
+        self.failures = {}  # npc -> searches in a row that found nothing
+        self.distance_fields = OrderedDict()
+        self.conflicts_avoided = 0
+
+    def request(self, npc):
+        self.pending[npc] = None
+
+    def cancel(self, npc):
+        self.pending.pop(npc, None)
+        self.planned_at.pop(npc, None)
+        self.failures.pop(npc, None)
+        self.table.release(npc)
+
+    def begin_tick(self, game_map):
+        """Advance the clock and plan every pending request as one batch."""
+        self.tick += 1
+        self.table.prune(self.tick - 1)
+        for npc, planned in list(self.planned_at.items()):
+            if npc in self.pending:
+                continue
+            action = npc.action_queue[0] if npc.action_queue else None
+            if not action or action.type != 'pathfind' or not npc.brain.path:
+                # done moving, anyone planned through the cell it now stands on plans again
+                self.cancel(npc)
+                for (cell, tick), owner in list(self.table.slots.items()):
+                    if cell == (npc.x, npc.y) and tick >= self.tick:
+                        self.request(owner)
+            elif self.tick - planned >= max(self.window // 2, 1):
+                self.request(npc)
+
+        batch = list(self.pending)
+        self.pending.clear()
+        for npc in batch:
+            self.table.release(npc)
+            self.table.reserve(npc, (npc.x, npc.y), self.tick)
+        planning = set(batch) | set(self.planned_at)
+        standing = {(npc.x, npc.y) for npc in NPC_REGISTRY if npc not in planning}
+        for npc in batch:
+            self._plan(npc, game_map, standing)
+
+    def _plan(self, npc, game_map, standing):
+        action = npc.action_queue[0] if npc.action_queue else None
+        if not action or action.type != 'pathfind':
+            npc.brain.path_pending = False
+            return
+        target = npc.brain._target_position(action)
+        goal = target['data']
+        npc.brain.target_position = goal
+        start = (npc.x, npc.y)
+        if target['type'] == 'coords' and goal in standing and goal != start:
+            self._give_up(npc)  # someone is standing on the spot, same as a failed A*
+            return
+        blocked = standing - {start, goal}
+        path = self._space_time_search(npc, start, goal, game_map, blocked)
+        if path is None:
+            self.failures[npc] = self.failures.get(npc, 0) + 1
+            if self.failures[npc] >= self.window:
+                self._give_up(npc)
+                return
+            # boxed in for now, hold this cell and try again next tick
+            self._reserve(npc, [], start)
+            self.request(npc)
+            return
+        self.failures.pop(npc, None)
+        self._reserve(npc, path, start)
+        self.planned_at[npc] = self.tick
+        npc.brain.receive_path(path)
+
+    def _give_up(self, npc):
+        """No path, the NPC drops its pathfind action like it would after a failed search."""
+        self.cancel(npc)
+        npc.brain.path = None
+        npc.brain.receive_path(None)
+
+    def _reserve(self, npc, path, start):
+        """Claim the planned steps inside the window, then the last of them until the window ends."""
+        cell = start
+        for offset in range(1, self.window + 1):
+            if offset <= len(path):
+                cell = path[offset - 1]
+            self.table.reserve(npc, cell, self.tick + offset)
+
+    def _distance_field(self, goal, game_map):
+        """True distances to goal over the static map (the RRA* heuristic), cached per goal."""
+        key = (goal, game_map.version)
+        if key in self.distance_fields:
+            self.distance_fields.move_to_end(key)
+            return self.distance_fields[key]
+        width, height, walls = game_map.width, game_map.height, game_map.wall_bytes
+        field = [-1] * (width * height)
+        if game_map.in_bounds(*goal) and not walls[goal[1] * width + goal[0]]:
+            field[goal[1] * width + goal[0]] = 0
+            queue = deque([goal])
+            while queue:
+                x, y = queue.popleft()
+                next_distance = field[y * width + x] + 1
+                for dx, dy in NEIGHBORS:
+                    nx, ny = x + dx, y + dy
+                    if 0 <= nx < width and 0 <= ny < height:
+                        index = ny * width + nx
+                        if field[index] == -1 and not walls[index]:
+                            field[index] = next_distance
+                            queue.append((nx, ny))
+        self.distance_fields[key] = field
+        if len(self.distance_fields) > DISTANCE_FIELDS:
+            self.distance_fields.popitem(last=False)
+        return field
+
+    def _slot_free(self, npc, cell, tick):
+        # Nobody else may hold the cell the tick before, during or after, so no NPC ever
+        # moves into a cell in the same tick another NPC leaves it
+        for when in (tick - 1, tick, tick + 1):
+            owner = self.table.owner(cell, when)
+            if owner is not None and owner is not npc:
+                return False
+        return True
+
+    def _space_time_search(self, npc, start, goal, game_map, blocked):
+        width = game_map.width
+        field = self._distance_field(goal, game_map)
+        if field[start[1] * width + start[0]] == -1:
+            return None
+
+        def distance(cell):
+            return field[cell[1] * width + cell[0]]
+
+        h = distance(start)
+        open_heap = [(h, h, 0, start)]
+        parent = {(start, 0): None}
+        expansions = 0
+        while open_heap and expansions < MAX_EXPANSIONS:
+            _, h, t, cell = heapq.heappop(open_heap)
+            expansions += 1
+            if cell == goal or t == self.window:
+                path = []
+                node = (cell, t)
+                while parent[node] is not None:
+                    path.append(node[0])
+                    node = parent[node]
+                path.reverse()
+                # Past the window, walk down the static distance field
+                while cell != goal:
+                    cell = next(c for c in ((cell[0] + dx, cell[1] + dy) for dx, dy in NEIGHBORS)
+                                if game_map.in_bounds(*c) and distance(c) == distance(cell) - 1)
+                    path.append(cell)
+                return path
+            for dx, dy in NEIGHBORS + [WAIT]:
+                child = (cell[0] + dx, cell[1] + dy)
+                if (child, t + 1) in parent or not game_map.in_bounds(*child):
+                    continue
+                if distance(child) == -1 or child in blocked:
+                    continue
+                if not self._slot_free(npc, child, self.tick + t + 1):
+                    self.conflicts_avoided += 1
+                    continue
+                parent[(child, t + 1)] = (cell, t)
+                child_h = distance(child)
+                heapq.heappush(open_heap, (t + 1 + child_h, child_h, t + 1, child))
+        return None
+
+
+# Shared by every NPC's Brain, driven from the game loop
+COOPERATIVE_PLANNER = CooperativePlanner()
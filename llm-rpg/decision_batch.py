@@ -0,0 +1,149 @@
+import asyncio
+import time
+from collections import OrderedDict
+from constants import DECISION_BATCH_WINDOW_MS, DECISION_BATCH_SIZE, DECISION_BATCH_MODE, COLORS
+from llm import decide, decide_batch, decision_messages, get_context, record_decision
+from llm_pipeline import LLM_PIPELINE
+from plans import decision_error
+
+
+class DecisionBatch:
+    """Owner of one batched request in the pipeline."""
+    def __init__(self, npcs):
+        self.npcs = npcs
+
+
+class DecisionBatcher:
+    """
+    Collects the decision requests NPCs make within a short window and sends them to the
+    LLM together. In 'combined' mode the system message goes once with every NPC's context
+    and one structured answer is split back per NPC, NPCs it left out or gave a decision
+    that doesn't check out (plans.decision_error) are asked on their own. In 'parallel'
+    mode the usual per-NPC prompts go out as one concurrent batch. Results reach each
+    NPC's Brain through LLM_PIPELINE.collect() like any other decision.
+    """
+    def __init__(self, window_ms=DECISION_BATCH_WINDOW_MS, max_size=DECISION_BATCH_SIZE, mode=DECISION_BATCH_MODE,
+                 pipeline=LLM_PIPELINE, decide=decide, decide_batch=decide_batch):
+        self.window = window_ms / 1000
+        self.max_size = max_size
+        self.mode = mode
+        self.pipeline = pipeline
+        self.decide = decide
+        self.decide_batch = decide_batch
+        self.waiting = OrderedDict()  # npc -> None, in request order
+        self.opened = None  # when the first NPC in waiting asked
+        self.in_flight = set()
+        self.game_map = None
+        self.all_npcs = None
+        self.batches = 0
+        self.batched_decisions = 0
+        self.fallbacks = 0
+        self.failed = 0  # decisions that didn't come back at all
+
+    def add(self, npc, game_map, all_npcs):
+        if not self.waiting:
+            self.opened = time.perf_counter()
+        self.waiting[npc] = None
+        self.game_map, self.all_npcs = game_map, all_npcs
+
+    def is_pending(self, npc):
+        return npc in self.waiting or npc in self.in_flight
+
+    def flush(self, force=False):
+        """Send what's waiting once the window has passed or a batch is full."""
+        if not self.waiting:
+            return
+        if not force and len(self.waiting) < self.max_size and time.perf_counter() - self.opened < self.window:
+            return
+        npcs = list(self.waiting)
+        self.waiting.clear()
+        for i in range(0, len(npcs), self.max_size):
+            chunk = npcs[i:i + self.max_size]
+            if len(chunk) == 1:
+                self._submit_single(chunk[0])
+            elif self.mode == 'combined':
+                self._submit_combined(chunk)
+            else:
+                self._submit_parallel(chunk)
+
+    def _submit_single(self, npc):
+        game_map, all_npcs = self.game_map, self.all_npcs
+        messages = decision_messages(npc, game_map, all_npcs, npc.brain.last_actions)
+
+        def apply(result):
+            action_data, npc.reasoning_history = result
+            npc.brain.apply_decision(action_data, game_map, all_npcs)
+
+        self.pipeline.submit(npc, self.decide(messages, all_npcs, game_map, npc), apply, lambda error: self._failed(npc, error))
+
+    def _submit_combined(self, npcs):
+        game_map, all_npcs = self.game_map, self.all_npcs
+        # keyed by position in the batch, NPC names repeat once there are more NPCs than colors
+        contexts = {str(i): get_context(npc, game_map, all_npcs, npc.brain.last_actions) for i, npc in enumerate(npcs, 1)}
+        batch = DecisionBatch(npcs)
+        self.in_flight.update(npcs)
+        self.batches += 1
+
+        def apply(decisions):
+            self.in_flight.difference_update(npcs)
+            for npc_id, npc in zip(contexts, npcs):
+                action_data = decisions.get(npc_id)
+                if action_data is None or decision_error(action_data, game_map, all_npcs, npc) is not None:
+                    self.fallbacks += 1
+                    self._submit_single(npc)
+                    continue
+                self.batched_decisions += 1
+                record_decision(npc, contexts[npc_id], action_data)
+                npc.brain.apply_decision(action_data, game_map, all_npcs)
+
+        def fail(error):
+            self.in_flight.difference_update(npcs)
+            self.fallbacks += len(npcs)
+            for npc in npcs:
+                self._submit_single(npc)
+
+        self.pipeline.submit(batch, self.decide_batch(contexts), apply, fail)
+
+    def _submit_parallel(self, npcs):
+        game_map, all_npcs = self.game_map, self.all_npcs
+        coroutines = [self.decide(decision_messages(npc, game_map, all_npcs, npc.brain.last_actions), all_npcs, game_map, npc)
+                      for npc in npcs]
+        batch = DecisionBatch(npcs)
+        self.in_flight.update(npcs)
+        self.batches += 1
+
+        async def run_all():
+            return await asyncio.gather(*coroutines, return_exceptions=True)
+
+        def apply(results):
+            self.in_flight.difference_update(npcs)
+            for npc, result in zip(npcs, results):
+                if isinstance(result, Exception):
+                    self._failed(npc, result)
+                    continue
+                self.batched_decisions += 1
+                action_data, npc.reasoning_history = result
+                npc.brain.apply_decision(action_data, game_map, all_npcs)
+
+        def fail(error):
+            self.in_flight.difference_update(npcs)
+            for npc in npcs:
+                self._failed(npc, error)
+
+        self.pipeline.submit(batch, run_all(), apply, fail)
+
+    def _failed(self, npc, error):
+        self.failed += 1
+        npc.add_log(f"NPC {COLORS[npc.color]} couldn't decide what to do ({error}).")
+
+    def stats(self):
+        return {
+            'batches': self.batches,
+            'batched_decisions': self.batched_decisions,
+            'fallbacks': self.fallbacks,
+            'failed': self.failed,
+        }
+
+
+# Shared by every NPC's Brain, flushed from the game loop
+DECISION_BATCHER = DecisionBatcher()
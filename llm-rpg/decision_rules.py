@@ -0,0 +1,101 @@
+from collections import Counter
+from constants import COLORS, RULE_HUNGER, RULE_LOW_CURRENCY, RULE_LOW_SOCIAL
+from globals import NPC_INDEX
+
+GREETING = "Hi! How are you doing?"
+
+
+def _home(npc, game_map):
+    """The NPC's house, if it has one."""
+    name = COLORS[npc.color]
+    for location in game_map.village.sub_locations:
+        if name in location.name.upper() and 'HOUSE' in location.name.upper():
+            return location
+    return None
+
+
+def _at(npc, location):
+    return location is not None and location.contains_point(npc.x, npc.y)
+
+
+def eat_when_hungry(npc, game_map, all_npcs):
+    """Hungry with food: eat at home, or go home first."""
+    if npc.hunger < RULE_HUNGER or npc.food < 10:
+        return None
+    home = _home(npc, game_map)
+    if home is None:
+        return None
+    if _at(npc, home):
+        return {'type': 'eat'}
+    return {'type': 'pathfind', 'target': home.full_name()}
+
+
+def buy_food_when_hungry(npc, game_map, all_npcs):
+    """Hungry without food but with money: buy some at the Shop, or go there first."""
+    if npc.hunger < RULE_HUNGER or npc.food >= 10 or npc.currency < 10:
+        return None
+    if _at(npc, game_map.shop):
+        return {'type': 'buy_food'}
+    return {'type': 'pathfind', 'target': game_map.shop.full_name()}
+
+
+def work_when_broke(npc, game_map, all_npcs):
+    """Out of money: do the job at the Workplace, or go there first."""
+    if npc.currency >= RULE_LOW_CURRENCY:
+        return None
+    if _at(npc, game_map.workplace):
+        return {'type': 'do_job'}
+    return {'type': 'pathfind', 'target': game_map.workplace.full_name()}
+
+
+def socialize_when_lonely(npc, game_map, all_npcs):
+    """Lonely: talk to the nearest NPC, or walk up to them first."""
+    if npc.social >= RULE_LOW_SOCIAL:
+        return None
+    nearest = [other for other in NPC_INDEX.nearest((npc.x, npc.y), 1, exclude=npc) if other in all_npcs]
+    if not nearest:
+        return None
+    other = nearest[0]
+    if abs(other.x - npc.x) + abs(other.y - npc.y) <= 1:
+        return {'type': 'converse', 'target': other.name, 'message': GREETING}
+    return {'type': 'pathfind', 'target': other.name}
+
+
+# Tried in order, the first one with an answer decides
+RULES = [eat_when_hungry, buy_food_when_hungry, work_when_broke, socialize_when_lonely]
+
+
+class DecisionRules:
+    """
+    Utility rules that answer the obvious decisions locally before anything goes to the
+    LLM. A rule takes (npc, game_map, all_npcs) and returns action data in the same form
+    as llm.prompt, or None when the situation isn't clear-cut for it. When no rule
+    answers, the decision is escalated to the LLM.
+    """
+    def __init__(self, rules=RULES):
+        self.rules = list(rules)
+        self.handled = Counter()  # rule name -> decisions it made
+        self.escalated = 0
+
+    def decide(self, npc, game_map, all_npcs):
+        for rule in self.rules:
+            action_data = rule(npc, game_map, all_npcs)
+            if action_data is not None:
+                self.handled[rule.__name__] += 1
+                return action_data
+        self.escalated += 1
+        return None
+
+    def stats(self):
+        handled = sum(self.handled.values())
+        total = handled + self.escalated
+        return {
+            'handled': handled,
+            'escalated': self.escalated,
+            'handled_fraction': handled / total if total else 0.0,
+            'by_rule': dict(self.handled),
+        }
+
+
+# Shared by every NPC's Brain
+DECISION_RULES = DecisionRules()
@@ -0,0 +1,82 @@
+from collections import deque
+from pathfinding import NEIGHBORS
+from globals import NPC_INDEX
+
+
+class FlowField:
+    """
+    Distance from every cell of the map to the nearest walkable cell of a Location,
+    from one multi-source BFS. Any NPC anywhere takes its next step towards the
+    location by moving to a neighbor one step closer, with no search of its own.
+    """
+    def __init__(self, game_map, location):
+        self.location = location
+        self.width = game_map.width
+        self.height = game_map.height
+        self.distances = [-1] * (self.width * self.height)  # -1 = wall or can't reach the location
+
+        walls = game_map.wall_bytes
+        queue = deque()
+        for x, y in game_map.walkable_cells(location.top_left, location.bottom_right):
+            self.distances[y * self.width + x] = 0
+            queue.append((x, y))
+        while queue:
+            x, y = queue.popleft()
+            next_distance = self.distances[y * self.width + x] + 1
+            for dx, dy in NEIGHBORS:
+                nx, ny = x + dx, y + dy
+                if 0 <= nx < self.width and 0 <= ny < self.height:
+                    index = ny * self.width + nx
+                    if self.distances[index] == -1 and not walls[index]:
+                        self.distances[index] = next_distance
+                        queue.append((nx, ny))
+
+    def distance(self, x, y):
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            return -1
+        return self.distances[y * self.width + x]
+
+    def next_step(self, x, y, blocked=()):
+        """A neighbor one step closer to the location that isn't blocked, or None."""
+        here = self.distance(x, y)
+        if here <= 0:
+            return None
+        for dx, dy in NEIGHBORS:
+            cell = (x + dx, y + dy)
+            if self.distance(*cell) == here - 1 and cell not in blocked:
+                return cell
+        return None
+
+
+def get_flow_field(game_map, location) -> FlowField:
+    """Build the field for a location on first use, shared afterwards by every NPC."""
+    key = location.full_name()
+    if key not in game_map.flow_fields:
+        game_map.flow_fields[key] = FlowField(game_map, location)
+    return game_map.flow_fields[key]
+
+
+class FlowPath:
+    """
+    List-like path that follows a FlowField from an NPC's position, one step per pop.
+    When every step downhill is taken by another NPC it returns the current cell, so
+    the NPC waits in place instead of replanning.
+    """
+    def __init__(self, field, npc):
+        self.field = field
+        self.npc = npc
+        self.position = (npc.x, npc.y)
+
+    def pop(self, index=0):
+        blocked = NPC_INDEX.view({self.position})
+        step = self.field.next_step(*self.position, blocked)
+        if step is None:
+            return self.position
+        self.position = step
+        return step
+
+    def __bool__(self):
+        return self.field.distance(*self.position) > 0
+
+    def __len__(self):
+        return max(self.field.distance(*self.position), 0)
@@ -1,21 +1,69 @@
 import pygame
+import numpy as np
 from PIL import Image, ImageDraw
 from constants import SCREEN_WIDTH, SCREEN_HEIGHT, GRID_SIZE, BLACK, WHITE, IMAGE_PATH
 import random
 from typing import List, Union, Tuple
 
 class GameMap:
-    def __init__(self, image_path: str, init_locations: bool=True):
+    def __init__(self, image_path: str, init_locations: bool=True, collision_path: str=None):
         self.image_path = image_path
         self.map_image = pygame.image.load(self.image_path)
+        # Walls are sampled once here, every wall query afterwards reads from this grid.
+        # A separate collision image (e.g. images/maps/LLM-RPG-collision.png) is one pixel per cell.
+        if collision_path:
+            self.walls = build_collision_grid(pygame.image.load(collision_path), cell_size=1)
+        else:
+            self.walls = build_collision_grid(self.map_image, cell_size=GRID_SIZE)
+        self.height, self.width = self.walls.shape
+        # Bumped whenever walls change so cached paths and graphs built on the old layout are dropped
+        self.version = 0
+        self._walls_changed()
         if init_locations:
             self.village, self.reds_house, self.blue_house, self.shop, self.workplace = initialize_locations()
 
+    def _walls_changed(self):
+        # Flat row-major copy (index = y * width + x) for the pure python searches in pathfinding.py
+        self.wall_bytes = self.walls.tobytes()
+        self.door_graph = None  # built on first use by hierarchy.get_door_graph
+        self.flow_fields = {}  # Location.full_name() -> flow_field.FlowField, built on first use
+
+    def set_wall(self, x: int, y: int, wall: bool = True):
+        """Add or remove a wall at runtime."""
+        if not self.in_bounds(x, y):
+            raise ValueError(f"Cell ({x}, {y}) is outside the map.")
+        if bool(self.walls[y, x]) != wall:
+            self.walls[y, x] = wall
+            self.version += 1
+            self._walls_changed()
+
+    def in_bounds(self, x: int, y: int) -> bool:
+        """Check if a cell lies on the grid."""
+        return 0 <= x < self.width and 0 <= y < self.height
+
     def is_wall(self, x: int, y: int) -> bool:
-        # Implement this function to check if a given grid cell is a wall
-        # Use pygame's Surface.get_at() to check the pixel color
-        pixel_color = self.map_image.get_at((x * GRID_SIZE + GRID_SIZE // 2, y * GRID_SIZE + GRID_SIZE // 2)) #ERROR: IndexError: pixel index out of range 
-        return pixel_color == BLACK
+        """Check if a grid cell is a wall. Cells outside the grid count as walls."""
+        if not self.in_bounds(x, y):
+            return True
+        return bool(self.walls[y, x])
+
+    def are_walls(self, xs, ys) -> np.ndarray:
+        """Vectorized is_wall over arrays of x and y cell coordinates."""
+        xs = np.asarray(xs, dtype=np.intp)
+        ys = np.asarray(ys, dtype=np.intp)
+        inside = (xs >= 0) & (xs < self.width) & (ys >= 0) & (ys < self.height)
+        result = np.ones(np.broadcast(xs, ys).shape, dtype=bool)
+        result[inside] = self.walls[ys[inside], xs[inside]]
+        return result
+
+    def walkable_cells(self, top_left: Tuple[int, int], bottom_right: Tuple[int, int]) -> List[Tuple[int, int]]:
+        """All non-wall cells inside an inclusive rectangle, clipped to the grid."""
+        x0, y0 = max(top_left[0], 0), max(top_left[1], 0)
+        x1, y1 = min(bottom_right[0], self.width - 1), min(bottom_right[1], self.height - 1)
+        if x0 > x1 or y0 > y1:
+            return []
+        ys, xs = np.nonzero(~self.walls[y0:y1 + 1, x0:x1 + 1])
+        return list(zip((xs + x0).tolist(), (ys + y0).tolist()))
 
     def get_current_location(self, x: int, y: int) -> str:
         """Retrieve the current location as a string based on coordinates."""
@@ -100,12 +148,23 @@ class Location:
 
     def get_random_point(self, game_map: 'GameMap') -> Tuple[int, int]:
         """Get a random point within the location boundaries that isn't a wall."""
-        while True:
-            x = random.randint(self.top_left[0], self.bottom_right[0])
-            y = random.randint(self.top_left[1], self.bottom_right[1])
-            if not game_map.is_wall(x, y):
-                return (x, y)
-
+        cells = game_map.walkable_cells(self.top_left, self.bottom_right)
+        if not cells:
+            raise ValueError(f"Location {self.name} has no walkable cells.")
+        return random.choice(cells)
+
+
+
+def build_collision_grid(surface: pygame.Surface, cell_size: int = GRID_SIZE) -> np.ndarray:
+    """Sample the center pixel of every cell and return a (rows, cols) boolean grid, True for walls."""
+    width, height = surface.get_size()
+    if width < cell_size or height < cell_size:
+        raise ValueError(f"Map image of size {width}x{height} is smaller than one cell.")
+    pixels = pygame.surfarray.array3d(surface)  # indexed [x, y, rgb]
+    centers = pixels[cell_size // 2::cell_size, cell_size // 2::cell_size]
+    centers = centers[:width // cell_size, :height // cell_size]
+    walls = np.all(centers == np.array(BLACK, dtype=centers.dtype), axis=-1)
+    return np.ascontiguousarray(walls.T)
 
 
 def draw_room(draw, room_top_left, room_bottom_right, door_wall="bottom"):
@@ -1 +1,4 @@
-NPC_REGISTRY = []
\ No newline at end of file
+from spatial_hash import SpatialHash
+
+NPC_REGISTRY = []
+NPC_INDEX = SpatialHash()  # where every NPC in NPC_REGISTRY stands, updated by NPC.x/NPC.y
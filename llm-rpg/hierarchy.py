@@ -0,0 +1,193 @@
+import heapq
+from collections import deque
+from typing import Dict, List, Tuple
+import numpy as np
+from pathfinding import NEIGHBORS, LazyPath, grid_a_star, occupied_cells
+
+OUTSIDE = 0  # region id of the village cells that aren't inside any room
+
+Cell = Tuple[int, int]
+
+
+class DoorGraph:
+    """
+    Abstract graph for HPA*-style pathfinding over the Location tree.
+
+    Every top level sub-location of the village (the houses, the shop, the workplace) is
+    a region, the rest of the village is the OUTSIDE region. Door openings are found from
+    the collision grid as runs of walkable cells that touch another region, and each run
+    becomes a pair of nodes, one on either side of the opening. Nodes sharing a region are
+    linked with their walking distance inside that region, which is precomputed from a
+    BFS distance field per node. The same fields give the cost from any cell to the doors
+    of its region in O(1).
+    """
+    def __init__(self, game_map):
+        self.width = game_map.width
+        self.height = game_map.height
+        self.walls = game_map.walls
+        self.rooms = list(game_map.village.sub_locations)
+
+        self.regions = np.full((self.height, self.width), OUTSIDE, dtype=np.int16)
+        for region, room in enumerate(self.rooms, start=1):
+            x0, y0 = max(room.top_left[0], 0), max(room.top_left[1], 0)
+            x1, y1 = min(room.bottom_right[0], self.width - 1), min(room.bottom_right[1], self.height - 1)
+            self.regions[y0:y1 + 1, x0:x1 + 1] = region
+        self.region_count = len(self.rooms) + 1
+        # Walls plus every cell outside the region, so searches can't leave it
+        self.region_walls = [(self.walls | (self.regions != r)).tobytes() for r in range(self.region_count)]
+
+        self.nodes: Dict[Cell, int] = {}  # node cell -> region
+        self.edges: Dict[Cell, Dict[Cell, int]] = {}
+        self.distance_fields: Dict[Cell, List[int]] = {}
+        self._find_doors()
+        self._link_regions()
+
+    def region(self, x: int, y: int) -> int:
+        return int(self.regions[y, x])
+
+    def _find_doors(self):
+        """Group walkable cells that step into another region into door clusters."""
+        crossings = {}
+        for y in range(self.height):
+            for x in range(self.width):
+                if self.walls[y, x]:
+                    continue
+                for dx, dy in NEIGHBORS:
+                    nx, ny = x + dx, y + dy
+                    if 0 <= nx < self.width and 0 <= ny < self.height and not self.walls[ny, nx] \
+                            and self.regions[ny, nx] != self.regions[y, x]:
+                        crossings[(x, y)] = (nx, ny)
+
+        seen = set()
+        for cell in sorted(crossings):
+            if cell in seen:
+                continue
+            cluster, frontier = [], [cell]
+            seen.add(cell)
+            while frontier:
+                cx, cy = frontier.pop()
+                cluster.append((cx, cy))
+                for dx, dy in NEIGHBORS:
+                    other = (cx + dx, cy + dy)
+                    if other in crossings and other not in seen and \
+                            self.region(*other) == self.region(*cell) and \
+                            self.region(*crossings[other]) == self.region(*crossings[cell]):
+                        seen.add(other)
+                        frontier.append(other)
+            inside = sorted(cluster)[len(cluster) // 2]
+            outside = crossings[inside]
+            for node in (inside, outside):
+                self.nodes[node] = self.region(*node)
+                self.edges.setdefault(node, {})
+            self.edges[inside][outside] = 1
+            self.edges[outside][inside] = 1
+
+    def _link_regions(self):
+        for node, region in self.nodes.items():
+            self.distance_fields[node] = self._distance_field(node, region)
+        for node, region in self.nodes.items():
+            field = self.distance_fields[node]
+            for other, other_region in self.nodes.items():
+                if other != node and other_region == region:
+                    cost = field[other[1] * self.width + other[0]]
+                    if cost >= 0:
+                        self.edges[node][other] = cost
+
+    def _distance_field(self, source: Cell, region: int) -> List[int]:
+        """BFS distances from source to every cell of its region, -1 where unreachable."""
+        walls = self.region_walls[region]
+        field = [-1] * (self.width * self.height)
+        field[source[1] * self.width + source[0]] = 0
+        queue = deque([source])
+        while queue:
+            x, y = queue.popleft()
+            next_cost = field[y * self.width + x] + 1
+            for dx, dy in NEIGHBORS:
+                nx, ny = x + dx, y + dy
+                if 0 <= nx < self.width and 0 <= ny < self.height:
+                    index = ny * self.width + nx
+                    if field[index] == -1 and not walls[index]:
+                        field[index] = next_cost
+                        queue.append((nx, ny))
+        return field
+
+    def _door_costs(self, cell: Cell) -> Dict[Cell, int]:
+        """Walking distance from a cell to each door node of its region."""
+        region = self.region(*cell)
+        index = cell[1] * self.width + cell[0]
+        costs = {}
+        for node, node_region in self.nodes.items():
+            if node_region == region:
+                cost = self.distance_fields[node][index]
+                if cost >= 0:
+                    costs[node] = cost
+        return costs
+
+    def abstract_path(self, start: Cell, goal: Cell):
+        """Door nodes to walk through between start and goal (Dijkstra on the door graph), or None."""
+        goal_costs = self._door_costs(goal)
+        best = {start: 0}
+        parent = {start: None}
+        open_heap = [(0, start)]
+        while open_heap:
+            cost, node = heapq.heappop(open_heap)
+            if cost > best[node]:
+                continue
+            if node == goal:
+                waypoints = []
+                while parent[node] is not None:
+                    waypoints.append(node)
+                    node = parent[node]
+                return waypoints[::-1]
+            neighbors = dict(self.edges.get(node, {}))
+            if node == start:
+                neighbors.update(self._door_costs(start))
+            if node in goal_costs:
+                neighbors[goal] = goal_costs[node]
+            for other, step in neighbors.items():
+                if cost + step < best.get(other, float('inf')):
+                    best[other] = cost + step
+                    parent[other] = node
+                    heapq.heappush(open_heap, (cost + step, other))
+        return None
+
+
+def get_door_graph(game_map) -> DoorGraph:
+    if game_map.door_graph is None:
+        game_map.door_graph = DoorGraph(game_map)
+    return game_map.door_graph
+
+
+def hierarchical_pathfinding(start, target, game_map, current_npc):
+    """
+    Same signature as a_star_pathfinding. Targets in another region are routed over the
+    door graph and the returned LazyPath searches one region at a time as it's walked,
+    so NPC positions are only read for the segment the NPC is about to take.
+    """
+    npc = current_npc.get('npc')
+
+    def blocked():
+        position = (npc.x, npc.y) if npc else current_npc['data']
+        return occupied_cells(target, {'type': 'npc', 'data': position})
+
+    return _hierarchical_path(start, target['data'], game_map, blocked)
+
+
+def _hierarchical_path(start, goal, game_map, blocked):
+    graph = get_door_graph(game_map)
+    waypoints = None
+    if game_map.in_bounds(*start) and game_map.in_bounds(*goal) and \
+            graph.region(*start) != graph.region(*goal):
+        waypoints = graph.abstract_path(start, goal)
+    if waypoints is None:
+        return grid_a_star(game_map.wall_bytes, game_map.width, game_map.height, start, goal, blocked())
+
+    def refine(a, b):
+        region = graph.region(*a)
+        walls = graph.region_walls[region] if region == graph.region(*b) else game_map.wall_bytes
+        return grid_a_star(walls, game_map.width, game_map.height, a, b, blocked())
+
+    def fallback(position):
+        return grid_a_star(game_map.wall_bytes, game_map.width, game_map.height, position, goal, blocked())
+
+    return LazyPath(start, waypoints, refine, fallback)
@@ -0,0 +1,152 @@
+import json
+import re
+from langchain.schema import SystemMessage
+from constants import LLM_PROMPT_BUDGET, LLM_SUMMARY_BUDGET, LLM_LOG_BUDGET, LLM_HISTORY_TURNS, USE_NPC_MEMORY, MEMORY_HISTORY_TURNS
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("cl100k_base")
+except ImportError:
+    _encoding = None
+
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+MESSAGE_OVERHEAD = 4  # role and separators the chat API adds per message
+SUMMARY_HEADER = "SUMMARY OF EARLIER TURNS:"
+LOGS_HEADER = "GAME LOGS:"
+LOCATION_PATTERN = re.compile(r"Current Location: (.*)")
+
+
+def count_tokens(text):
+    """Tokens in text, with tiktoken if it's installed, else an estimate that errs high."""
+    if _encoding is not None:
+        return len(_encoding.encode(text))
+    # a word piece is a token per ~6 characters, punctuation a token each
+    return sum(1 + (len(piece) - 1) // 6 for piece in TOKEN_PATTERN.findall(text))
+
+
+def message_tokens(message):
+    tokens = MESSAGE_OVERHEAD + count_tokens(message.content)
+    call = message.additional_kwargs.get('function_call')
+    if call:
+        tokens += count_tokens(call.get('name', '')) + count_tokens(call.get('arguments', ''))
+    return tokens
+
+
+def summarize(message):
+    """Short summary lines for a message folded out of the history."""
+    call = message.additional_kwargs.get('function_call')
+    if call:
+        try:
+            args = ", ".join(f"{k}={v}" for k, v in json.loads(call.get('arguments') or '{}').items())
+        except ValueError:
+            args = ""
+        return [f"- chose {call.get('name')}({args})"]
+    content = message.content
+    if message.type == 'function':
+        return [f"- that choice was rejected: {content.strip()}"]
+    if content.startswith(LOGS_HEADER):
+        return [f"- log: {line}" for line in content.splitlines()[1:] if line.strip()]
+    location = LOCATION_PATTERN.search(content)
+    if location:
+        return [f"- was at {location.group(1).strip()}"]  # an old context
+    if not content.strip():
+        return []
+    label = "note" if message.type == 'system' else "said"
+    return [f"- {label}: {' '.join(content.split())[:120]}"]
+
+
+class HistoryManager:
+    """
+    Keeps each decision prompt under budget tokens. After the fixed head of the prompt
+    (instructions, tool schemas, NPC profile) come a rolling summary of earlier turns, as
+    many recent turns as fit (max_turns at most), the game logs since the last decision
+    (newest first, at most log_budget tokens) and the fresh context. Old contexts and
+    logs are always folded into the summary since newer ones replace them, turns and
+    logs that don't fit are too, a short line each from summarize(), and the oldest
+    summary lines are dropped beyond summary_budget. Only the head and context are never
+    cut, so those alone can exceed the budget.
+    """
+    def __init__(self, budget=LLM_PROMPT_BUDGET, summary_budget=LLM_SUMMARY_BUDGET, log_budget=LLM_LOG_BUDGET,
+                 max_turns=LLM_HISTORY_TURNS):
+        self.budget = budget
+        self.max_turns = max_turns
+        self.summary_budget = summary_budget
+        self.log_budget = log_budget
+        self.folded = 0
+
+    def _split(self, history):
+        """Previous history after the head -> (summary lines, turns)."""
+        rest = list(history)
+        summary = []
+        if rest and rest[0].type == 'system' and rest[0].content.startswith(SUMMARY_HEADER):
+            summary = rest.pop(0).content.splitlines()[1:]
+        return summary, rest
+
+    def build(self, history, logs, context, reserved=0):
+        """
+        The changing part of the next decision prompt. history is what followed the head
+        in the NPC's last prompt and answer, logs the log lines since the last decision,
+        context the fresh state message and reserved the tokens of the head.
+        """
+        summary, history_turns = self._split(history)
+        room = self.budget - reserved - message_tokens(context)
+        turns = []
+        for message in history_turns:
+            if message.type == 'system':
+                summary += summarize(message)
+                self.folded += 1
+            else:
+                turns.append(message)
+
+        # Newest logs first, the rest go to the summary
+        kept_logs = []
+        log_room = min(self.log_budget, max(room, 0)) - MESSAGE_OVERHEAD - count_tokens(LOGS_HEADER)
+        for line in reversed(logs):
+            cost = count_tokens(line) + 1
+            if cost > log_room:
+                break
+            kept_logs.append(line)
+            log_room -= cost
+        kept_logs.reverse()
+        folded_logs = logs[:len(logs) - len(kept_logs)]
+        summary += [f"- log: {line}" for line in folded_logs]
+        logs_message = SystemMessage(content="\n".join([LOGS_HEADER] + kept_logs)) if kept_logs else None
+        if logs_message:
+            room -= message_tokens(logs_message)
+
+        # Newest turns that fit next to a full summary, the rest folded
+        turn_room = room - min(self.summary_budget, max(room, 0))
+        split = len(turns)
+        while split > max(len(turns) - self.max_turns, 0) and message_tokens(turns[split - 1]) <= turn_room:
+            turn_room -= message_tokens(turns[split - 1])
+            split -= 1
+        for message in turns[:split]:
+            summary += summarize(message)
+        self.folded += split + len(folded_logs)
+        kept_turns = turns[split:]
+        room -= sum(message_tokens(m) for m in kept_turns)
+
+        messages = []
+        summary_room = min(self.summary_budget, room) - MESSAGE_OVERHEAD - count_tokens(SUMMARY_HEADER)
+        kept_summary = []
+        for line in reversed(summary):
+            cost = count_tokens(line) + 1
+            if cost > summary_room:
+                break
+            kept_summary.append(line)
+            summary_room -= cost
+        if kept_summary:
+            messages.append(SystemMessage(content="\n".join([SUMMARY_HEADER] + kept_summary[::-1])))
+        messages += kept_turns
+        if logs_message:
+            messages.append(logs_message)
+        messages.append(context)
+        return messages
+
+
+def prompt_tokens(messages, functions=()):
+    return sum(message_tokens(m) for m in messages) + sum(count_tokens(json.dumps(f)) for f in functions)
+
+
+# Shared by every NPC's decisions, with fewer raw turns when memories are recalled instead
+HISTORY = HistoryManager(max_turns=MEMORY_HISTORY_TURNS if USE_NPC_MEMORY else LLM_HISTORY_TURNS)
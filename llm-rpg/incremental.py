@@ -0,0 +1,125 @@
+import heapq
+from pathfinding import NEIGHBORS, manhattan
+
+INF = float('inf')
+
+
+class DStarLite:
+    """
+    D* Lite planner kept per NPC. It searches backwards from the goal, so the NPC can keep
+    walking (move_start) and a few cells can change occupancy (update_blocked) while only
+    the part of the search those changes touch is redone. The goal itself is fixed; a new
+    goal needs a new planner.
+    """
+    def __init__(self, game_map, start, goal, blocked=()):
+        self.wall_bytes = game_map.wall_bytes
+        self.width = game_map.width
+        self.height = game_map.height
+        self.version = game_map.version
+        self.start = start
+        self.last_start = start
+        self.goal = goal
+        self.blocked = set(blocked) - {start, goal}
+        self.km = 0
+        self.g = {}
+        self.rhs = {goal: 0}
+        self.open_keys = {}  # cell -> key it is queued with, heap entries with another key are stale
+        self.open_heap = []
+        self._push(goal)
+        self.expansions = 0
+
+    def _passable(self, cell):
+        x, y = cell
+        if x < 0 or x >= self.width or y < 0 or y >= self.height:
+            return False
+        return not self.wall_bytes[y * self.width + x] and cell not in self.blocked
+
+    def _neighbors(self, cell):
+        for dx, dy in NEIGHBORS:
+            yield (cell[0] + dx, cell[1] + dy)
+
+    def _key(self, cell):
+        best = min(self.g.get(cell, INF), self.rhs.get(cell, INF))
+        return (best + manhattan(self.start, cell) + self.km, best)
+
+    def _push(self, cell):
+        key = self._key(cell)
+        self.open_keys[cell] = key
+        heapq.heappush(self.open_heap, (key, cell))
+
+    def _top(self):
+        while self.open_heap:
+            key, cell = self.open_heap[0]
+            if self.open_keys.get(cell) == key:
+                return key, cell
+            heapq.heappop(self.open_heap)
+        return (INF, INF), None
+
+    def _update_vertex(self, cell):
+        if cell != self.goal:
+            best = INF
+            if self._passable(cell):
+                for other in self._neighbors(cell):
+                    if self._passable(other):
+                        best = min(best, self.g.get(other, INF) + 1)
+            self.rhs[cell] = best
+        self.open_keys.pop(cell, None)
+        if self.g.get(cell, INF) != self.rhs.get(cell, INF):
+            self._push(cell)
+
+    def compute_shortest_path(self):
+        while True:
+            key, cell = self._top()
+            start_key = self._key(self.start)
+            if cell is None or (key >= start_key and self.rhs.get(self.start, INF) == self.g.get(self.start, INF)):
+                return
+            heapq.heappop(self.open_heap)
+            del self.open_keys[cell]
+            self.expansions += 1
+            new_key = self._key(cell)
+            if key < new_key:
+                self._push(cell)
+            elif self.g.get(cell, INF) > self.rhs.get(cell, INF):
+                self.g[cell] = self.rhs[cell]
+                for other in self._neighbors(cell):
+                    self._update_vertex(other)
+            else:
+                self.g[cell] = INF
+                self._update_vertex(cell)
+                for other in self._neighbors(cell):
+                    self._update_vertex(other)
+
+    def move_start(self, start):
+        """The NPC has walked to start; shift the heap keys instead of re-keying everything."""
+        if start != self.start:
+            self.km += manhattan(self.last_start, start)
+            self.last_start = start
+            self.start = start
+
+    def update_blocked(self, blocked):
+        """Swap in the current set of occupied cells, updating only the cells that changed."""
+        blocked = set(blocked) - {self.start, self.goal}
+        changed = blocked ^ self.blocked
+        self.blocked = blocked
+        for cell in changed:
+            self._update_vertex(cell)
+            for other in self._neighbors(cell):
+                self._update_vertex(other)
+
+    def path(self):
+        """Cells from the step after start to the goal, [] at the goal, None if unreachable."""
+        self.compute_shortest_path()
+        if self.g.get(self.start, INF) == INF:
+            return None
+        path = []
+        cell = self.start
+        while cell != self.goal:
+            best, best_cost = None, INF
+            for other in self._neighbors(cell):
+                if self._passable(other) and self.g.get(other, INF) + 1 < best_cost:
+                    best, best_cost = other, self.g.get(other, INF) + 1
+            if best is None or best_cost == INF or len(path) > self.width * self.height:
+                return None
+            path.append(best)
+            cell = best
+        return path
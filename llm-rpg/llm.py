@@ -1,16 +1,26 @@
 from langchain.chat_models import ChatOpenAI
-from langchain.schema import HumanMessage, SystemMessage, ChatMessage
+from langchain.schema import HumanMessage, SystemMessage, ChatMessage, AIMessage, FunctionMessage
 
 # from langchain.tools import format_tool_to_openai_function, StructuredTool
 from langchain.agents import tool
 from langchain.tools.render import format_tool_to_openai_function
 
 from langchain.embeddings import OpenAIEmbeddings
-from constants import COLORS
+from constants import COLORS, CONTEXT_NPC_LIMIT, PLAN_MAX_STEPS, LLM_DECISION_RETRIES, LLM_FALLBACK_ACTIVITY, RULE_HUNGER, RULE_LOW_CURRENCY, RULE_LOW_SOCIAL, LLM_COMPLETION_TOKENS
+from llm_cache import LLM_CACHE, cache_key
+from llm_backends import get_backend
+from llm_pipeline import LLM_PIPELINE
+from llm_governor import LLM_GOVERNOR, CONVERSATION
+from functools import lru_cache
+from history import HISTORY, prompt_tokens, message_tokens
+from prompt_layout import PROMPT_ASSEMBLER
+from globals import NPC_INDEX
+from plans import STEP_ARGUMENTS, decision_error
 
 from langchain.vectorstores import Chroma
 # vectordb = Chroma(embedding_function=OpenAIEmbeddings())
 import json
+from collections import Counter
 
 from dotenv import load_dotenv
 
@@ -28,18 +38,60 @@ def system_message():
     """
     return message
 
+CONVERSATION_PROMPT = """
+    Right now you are in a conversation with another NPC. Based on what they say, talk back to them. 
+    If you want to end the conversation, respond with a <eos> token at the end of your response (This is optional).
+    """
+
+@lru_cache(maxsize=None)
+def static_messages(kind):
+    """Instructions that start every prompt of a kind, the same objects every call."""
+    if kind == 'conversation':
+        return (SystemMessage(content=system_message()), SystemMessage(content=CONVERSATION_PROMPT))
+    return (SystemMessage(content=system_message()),)
+
+def describe_target(action):
+    """How an action's target reads in the context: an NPC's name, a location or coordinates."""
+    if hasattr(action.target, 'name'):
+        return action.target.name
+    if action.location is not None:
+        return action.location.full_name()
+    return str(action.target)
+
+def npc_profile(npc):
+    """The part of the context that rarely changes, it goes ahead of everything that does."""
+    return f"""
+    NPC name: {npc.name}
+"""
+
 def get_context(npc, game_map, all_npcs, last_actions):
+    return npc_profile(npc) + npc_state(npc, game_map, all_npcs, last_actions)
+
+def memory_query(npc, location_name):
+    """What to look up in the NPC's memory: where it is, what it needs and what just happened."""
+    needs = []
+    if npc.hunger >= RULE_HUNGER:
+        needs.append("hungry eat food shop")
+    if npc.currency < RULE_LOW_CURRENCY:
+        needs.append("money job work")
+    if npc.social < RULE_LOW_SOCIAL:
+        needs.append("talk says")
+    return " ".join([location_name] + needs + npc.logs[-3:])
+
+def npc_state(npc, game_map, all_npcs, last_actions, exclude=None):
+    """exclude is the NPC left out of the nearby ones, npc itself by default."""
     # get NPC location, available locations, statuses
     current_location_name = game_map.get_current_location(npc.x, npc.y)
     available_locations = game_map.get_available_locations(npc.x, npc.y)
-    available_npcs = available_npcs = [n.name for n in all_npcs if n != npc]
+    # nearest NPCs from the spatial index rather than a scan of everyone
+    available_npcs = [n.name for n in NPC_INDEX.nearest((npc.x, npc.y), CONTEXT_NPC_LIMIT, exclude=exclude or npc) if n in all_npcs]
     available_locations = [l.full_name() for l in available_locations]
     actions = [a for a in npc.action_queue]
     action_string = ""
     for a in actions:
         action_string += f"type: {a.type}"
         if a.target:
-            action_string += f", target: {a.target.name}"
+            action_string += f", target: {describe_target(a)}"
         if a.message:
             action_string += f", message: {a.message}"
         action_string += "\n"
@@ -48,7 +100,7 @@ def get_context(npc, game_map, all_npcs, last_actions):
     if npc.paused_action:
         paused_action = f"type: {npc.paused_action.type}"
         if npc.paused_action.target:
-            paused_action += f", target: {npc.paused_action.target.name}"
+            paused_action += f", target: {describe_target(npc.paused_action)}"
         if npc.paused_action.message:
             paused_action += f", message: {npc.paused_action.message}"
     last_actions_str = ""
@@ -61,13 +113,14 @@ def get_context(npc, game_map, all_npcs, last_actions):
     for log in logs:
         game_logs_str+=log
         game_logs_str+="\n"
+
+    memories = npc.brain.memory.recall(memory_query(npc, current_location_name), exclude=logs)
+    memories_str = "".join(f"- {memory}\n    " for memory in memories) or "None"
     
 
     # Last 3 performed actions:
     # {last_actions_str}
-    context = f"""
-    NPC name: {npc.name}
-    Current Location: {current_location_name}
+    context = f"""    Current Location: {current_location_name}
     Available Locations to pathfind to: {available_locations}
     Available NPCs to pathfind/converse to: {available_npcs}
 
@@ -83,6 +136,8 @@ def get_context(npc, game_map, all_npcs, last_actions):
     Paused action if any:
     {paused_action}
 
+    Relevant memories:
+    {memories_str}
     Most recent game logs:
     {game_logs_str}
     """
@@ -142,6 +197,8 @@ def queue_multiple_actions(actions:list[dict]):
     actions should be a list of function calls. 
     each function call should have the name of the function
     and the arguments to pass to that function 
+    Prefer this for routines, e.g. pathfind to the Shop, buy_food, pathfind home, eat.
+    If a step fails the rest of the plan is dropped.
     """
     pass
 
@@ -150,7 +207,95 @@ def get_logs():
     pass
 import openai
 
+async def predict(chat, messages, accept=None, **kwargs):
+    """
+    chat.apredict_messages, answered from LLM_CACHE when the same prompt was sent before.
+    Answers accept(answer) turns down aren't cached, so they aren't served again. What
+    isn't cached waits its turn with LLM_GOVERNOR.
+    """
+    key = None
+    if LLM_CACHE.enabled:
+        key = cache_key(messages, model=chat.model_name, **kwargs)
+        cached = await LLM_CACHE.aget(key)
+        if cached is not None:
+            return AIMessage(**cached)
+    tokens = prompt_tokens(messages, kwargs.get('functions', ())) + LLM_COMPLETION_TOKENS
+    AI_message = await LLM_GOVERNOR.call(lambda: chat.apredict_messages(messages, **kwargs), tokens)
+    if key is not None and (accept is None or accept(AI_message)):
+        LLM_CACHE.put(key, {'content': AI_message.content, 'additional_kwargs': AI_message.additional_kwargs})
+    return AI_message
+
+@lru_cache(maxsize=64)
+def decision_functions(npc_names=(), locations=()):
+    """
+    The tool schemas, formatted once per set of targets and shared by every call with the
+    same ones. Don't modify. With npc_names and locations (tuples), converse and pathfind
+    targets are constrained to them, so the model can't make one up.
+    """
+    tools = [converse, pathfind, buy_food, eat, do_job, activity, queue_multiple_actions]
+    functions = [format_tool_to_openai_function(t) for t in tools]
+    functions[-1]['parameters'] = plan_parameters()
+    if npc_names:
+        functions[0]['parameters']['properties']['target'] = {'type': 'string', 'enum': list(npc_names)}
+    if npc_names or locations:
+        functions[1]['parameters']['properties']['target'] = {'type': 'string', 'enum': list(locations + npc_names)}
+    return functions
+
+def decision_targets(game_map, all_npcs, npc=None):
+    """
+    (NPC names, location full names) the decision tools of npc accept, every name but its
+    own. The same for every NPC with that name, so the schemas stay cacheable.
+    """
+    names = {other.name for other in all_npcs} - ({npc.name} if npc is not None else set())
+    return tuple(sorted(names)), location_names(game_map)
+
+@lru_cache(maxsize=8)
+def location_names(game_map):
+    names = []
+    locations = [game_map.village]
+    while locations:
+        location = locations.pop(0)
+        names.append(location.full_name())
+        locations += location.sub_locations
+    return tuple(names)
+
+def plan_parameters():
+    """
+    queue_multiple_actions' schema, spelled out since list[dict] tells the model nothing.
+    Step targets aren't constrained, a third copy of the names isn't worth the tokens and
+    parse_plan checks them anyway.
+    """
+    return {
+        'type': 'object',
+        'properties': {
+            'actions': {
+                'type': 'array',
+                'maxItems': PLAN_MAX_STEPS,
+                'items': {
+                    'type': 'object',
+                    'properties': {
+                        'name': {'type': 'string', 'enum': list(STEP_ARGUMENTS)},
+                        'target': {'type': 'string'},
+                        'message': {'type': 'string'},
+                    },
+                    'required': ['name'],
+                },
+            },
+        },
+        'required': ['actions'],
+    }
+
 def prompt(npc, game_map, all_npcs, last_actions):
+    """Blocking decision, the NPC's reasoning history is updated before returning."""
+    messages = decision_messages(npc, game_map, all_npcs, last_actions)
+    action_data, npc.reasoning_history = LLM_PIPELINE.run(decide(messages, all_npcs, game_map, npc), owner=npc)
+    return action_data
+
+def decision_messages(npc, game_map, all_npcs, last_actions, exclude=None):
+    """
+    Messages for the next decision, built from the game state as it is now. exclude is
+    passed on to npc_state(), for an npc that stands in for one of all_npcs.
+    """
     # used by decide action and converse
     # converse_tool = StructuredTool.from_function(converse)
     # pathfind_tool = StructuredTool.from_function(pathfind)
@@ -159,69 +304,140 @@ def prompt(npc, game_map, all_npcs, last_actions):
     # job_tool = StructuredTool.from_function(do_job)
 
 
-    tools = [converse, pathfind, buy_food, eat, do_job, activity]
     # tools = [converse_tool, pathfind_tool, food_tool, eat_tool, job_tool]
-    functions = [format_tool_to_openai_function(t) for t in tools]
-    tools=[{"type":"function", "function":f} for f in functions]
-    # chat = ChatOpenAI(model="gpt-3.5-turbo-1106")
-    chat = ChatOpenAI(model="gpt-3.5-turbo")
-    if not npc.reasoning_history:
-        messages = [SystemMessage(content=system_message()), SystemMessage(content=get_context(npc, game_map, all_npcs, last_actions))]
-    else:
-        sys = npc.reasoning_history.pop(0)
-        npc.reasoning_history = [sys] + npc.reasoning_history[-6:]
-        messages = npc.reasoning_history
+    static = static_messages('decision')
+    profile = SystemMessage(content=npc_profile(npc))
+    state = SystemMessage(content=npc_state(npc, game_map, all_npcs, last_actions, exclude))
+    logs = []
+    if npc.reasoning_history:
+        # the first prompt's state already has the latest logs
         logs = npc.logs
-        game_logs_str = "GAME LOGS:\n"
-        for log in logs:
-            game_logs_str+=log
-            game_logs_str+="\n"
-        messages.append(SystemMessage(content=game_logs_str))
-        messages.append(SystemMessage(content=get_context(npc, game_map, all_npcs, last_actions)))
         npc.clear_logs()
-    action, args = None, None
-    while check_valid_args(action, args, all_npcs, game_map):
-        AI_message = chat.predict_messages(messages, functions=functions)
+    # earlier turns and logs are summarized to keep the prompt in LLM_PROMPT_BUDGET
+    targets = decision_targets(game_map, all_npcs, npc)
+    tool_tokens = decision_functions_tokens(*targets)
+    head_tokens = tool_tokens + sum(message_tokens(m) for m in static) + message_tokens(profile)
+    body = HISTORY.build(npc.reasoning_history[len(static) + 1:], logs, state, reserved=head_tokens)
+    return PROMPT_ASSEMBLER.assemble('decision', npc.name, static, profile, body, tool_tokens, tools=targets)
+
+# How decisions came out: 'valid' first time, 'retried' until valid, or 'fallback'
+DECISIONS = Counter()
+
+async def decide(messages, all_npcs, game_map, npc=None):
+    """
+    Ask for npc's decision without blocking the event loop. Returns the action data and the
+    messages to keep as the NPC's reasoning history. Only reads the game state, so it is
+    safe to run off the game thread. Answers are checked locally, an invalid one is sent
+    back with the reason at most LLM_DECISION_RETRIES times, then fallback_action() is used.
+    """
+    functions = decision_functions(*decision_targets(game_map, all_npcs, npc))
+    # chat = ChatOpenAI(model="gpt-3.5-turbo-1106")
+    chat = get_backend()
+    accept = lambda answer: answer_error(answer, all_npcs, game_map, npc) is None
+    for attempt in range(LLM_DECISION_RETRIES + 1):
+        AI_message = await predict(chat, messages, accept=accept, functions=functions)
         messages.append(AI_message)
-        action = AI_message.additional_kwargs.get('function_call')
-        if action is None: 
+        error = answer_error(AI_message, all_npcs, game_map, npc)
+        if error is None:
+            DECISIONS['valid' if attempt == 0 else 'retried'] += 1
+            call = AI_message.additional_kwargs['function_call']
+            return {'type': call['name'], **json.loads(call.get('arguments') or '{}')}, messages
+        call = AI_message.additional_kwargs.get('function_call')
+        if call is None:
             messages.append(SystemMessage(content = "No action has been selected"))
-            continue
-        args = json.loads(action.get('arguments'))
-        
-        if check_valid_args(action, args, all_npcs, game_map):
-            messages.append(ChatMessage(
-                role='function',
-                additional_kwargs = {'name': action},
-                content = "The chosen arguments are not valid"
-            ))
-        min()
-        pass
-    
-    npc.reasoning_history = messages
-    return {'type': action['name'], **args}
-
-def check_valid_args(action, args, all_npcs, game_map):
-    if action is None: return True
-    
-    target_npc = None
-    target = args.get('target')
-    if target is None: return False
-    for npc in all_npcs:
-        if npc.name == target:
-            target_npc = npc
-            break
-    loc = target.split(':')[-1]
-    target_location = game_map._find_location_by_name(loc)
-
-    if action == "converse" and target_npc is None:
-        return True
-
-    if action == "pathfind" and target_npc is None and target_location is None:
-        return True 
-    return False
+        else:
+            messages.append(FunctionMessage(name=call.get('name', ''), content=f"The chosen arguments are not valid: {error}."))
+
+    DECISIONS['fallback'] += 1
+    action_data = fallback_action()
+    args = {k: v for k, v in action_data.items() if k != 'type'}
+    messages.append(AIMessage(content="", additional_kwargs={'function_call': {'name': action_data['type'], 'arguments': json.dumps(args)}}))
+    return action_data, messages
+
+def answer_error(AI_message, all_npcs, game_map, npc=None):
+    """Why an answer isn't a usable decision for npc, or None if it is."""
+    call = AI_message.additional_kwargs.get('function_call')
+    if call is None:
+        return "no function was called"
+    try:
+        args = json.loads(call.get('arguments') or '{}')
+    except ValueError:
+        return "the arguments aren't valid JSON"
+    if not isinstance(args, dict):
+        return "the arguments aren't an object"
+    return decision_error({'type': call.get('name'), **args}, game_map, all_npcs, npc)
+
+def fallback_action():
+    """What an NPC does when no valid decision came back, harmless and always valid."""
+    return {'type': 'activity', 'message': LLM_FALLBACK_ACTIVITY}
+
+@lru_cache(maxsize=64)
+def decision_functions_tokens(npc_names=(), locations=()):
+    return prompt_tokens([], decision_functions(npc_names, locations))
+
+@lru_cache(maxsize=64)
+def batch_function(npc_ids):
+    """One function call that carries a decision for every NPC in a batch, per tuple of batch ids."""
+    actions = list(STEP_ARGUMENTS)  # one action per NPC, no plans
+    return {
+        'name': 'decide_for_npcs',
+        'description': 'Choose the next action for each NPC. Exactly one entry per NPC.',
+        'parameters': {
+            'type': 'object',
+            'properties': {
+                'decisions': {
+                    'type': 'array',
+                    'items': {
+                        'type': 'object',
+                        'properties': {
+                            'npc': {'type': 'string', 'enum': list(npc_ids), 'description': 'the NPC id its context starts with'},
+                            'action': {'type': 'string', 'enum': actions},
+                            'target': {'type': 'string', 'description': 'converse/pathfind target, the name of an NPC or location'},
+                            'message': {'type': 'string', 'description': 'converse/activity message'},
+                        },
+                        'required': ['npc', 'action'],
+                    },
+                },
+            },
+            'required': ['decisions'],
+        },
+    }
+
+async def decide_batch(contexts):
+    """
+    One round trip for several NPCs' decisions. contexts maps an id unique within the
+    batch -> get_context(), since NPC names can repeat. The system message is sent once for
+    all of them. Returns id -> action data for the NPCs the answer had a decision for.
+    """
+    ids = list(contexts)
+    messages = [SystemMessage(content=system_message() + "\nThis time you are deciding for several NPCs at once, call decide_for_npcs with one decision per NPC id.")]
+    for npc_id, context in contexts.items():
+        messages.append(SystemMessage(content=f"NPC id: {npc_id}\n{context}"))
+    # chat = ChatOpenAI(model="gpt-3.5-turbo-1106")
+    chat = get_backend()
+    AI_message = await predict(chat, messages, functions=[batch_function(tuple(ids))], function_call={'name': 'decide_for_npcs'})
+    call = AI_message.additional_kwargs.get('function_call')
+    if call is None:
+        return {}
+    decisions = {}
+    for entry in json.loads(call.get('arguments')).get('decisions', []):
+        if entry.get('npc') in contexts and entry.get('action') in STEP_ARGUMENTS and entry['npc'] not in decisions:
+            decisions[entry['npc']] = {'type': entry['action'], **{k: entry[k] for k in ('target', 'message') if k in entry}}
+    return decisions
+
+def record_decision(npc, context, action_data):
+    """Add a decision made in a batch to the NPC's reasoning history, as if it was asked alone."""
+    if not npc.reasoning_history:
+        npc.reasoning_history = list(static_messages('decision')) + [SystemMessage(content=npc_profile(npc))]
+    args = {k: v for k, v in action_data.items() if k != 'type'}
+    npc.reasoning_history.append(SystemMessage(content=context))
+    npc.reasoning_history.append(AIMessage(content="", additional_kwargs={'function_call': {'name': action_data['type'], 'arguments': json.dumps(args)}}))
 
 def converse_message(npc, game_map, all_npcs, last_actions):
+    """Blocking conversation reply."""
+    return LLM_PIPELINE.run(reply(conversation_messages(npc, game_map, all_npcs, last_actions)), owner=npc, priority=CONVERSATION)
+
+def conversation_messages(npc, game_map, all_npcs, last_actions):
     # used by decide action and converse
     # converse_tool = StructuredTool.from_function(converse)
     # pathfind_tool = StructuredTool.from_function(pathfind)
@@ -229,22 +445,23 @@ def converse_message(npc, game_map, all_npcs, last_actions):
     # eat_tool = StructuredTool.from_function(eat)
     # job_tool = StructuredTool.from_function(do_job)
 
-    system_prompt = """
-    Right now you are in a conversation with another NPC. Based on what they say, talk back to them. 
-    If you want to end the conversation, respond with a <eos> token at the end of your response (This is optional).
-    """
-    
-    # chat = ChatOpenAI(model="gpt-3.5-turbo-1106")
-    chat = ChatOpenAI(model="gpt-3.5-turbo")
-    messages = [SystemMessage(content=system_message()+"\n"+get_context(npc, game_map, all_npcs, last_actions)), SystemMessage(content=system_prompt)]
+    # the conversation only grows at the end, so the state goes after it to keep it in the prefix
+    turns = []
     for message in npc.current_conversation:
         content = ":".join(message.split(":")[1:]).strip()
         if npc.name == message.split(":")[0]:
-            messages.append(AI_message(content=content))
+            turns.append(AIMessage(content=content))
         else:
-            messages.append(HumanMessage(content=content))
-    
-    AI_message = chat.predict_messages(messages)
+            turns.append(HumanMessage(content=content))
+    state = SystemMessage(content=npc_state(npc, game_map, all_npcs, last_actions))
+    return PROMPT_ASSEMBLER.assemble('conversation', npc.name, static_messages('conversation'),
+                                     SystemMessage(content=npc_profile(npc)), turns + [state])
+
+async def reply(messages):
+    """Reply to the conversation so far without blocking the event loop. Returns (content, end)."""
+    # chat = ChatOpenAI(model="gpt-3.5-turbo-1106")
+    chat = get_backend()
+    AI_message = await predict(chat, messages)
     end = False
     content = AI_message.content
     if "<eos>" in content:
@@ -0,0 +1,225 @@
+import ast
+import asyncio
+from abc import ABC, abstractmethod
+import hashlib
+import json
+import math
+import random
+import re
+import aiohttp
+import openai
+from langchain.chat_models import ChatOpenAI
+from langchain.schema import AIMessage
+from constants import (LLM_BACKEND, LLM_MODEL, LLM_MAX_CONNECTIONS, LLM_KEEPALIVE_S, STANDIN_LATENCY_MS, STANDIN_LATENCY_SPREAD, STANDIN_ERROR_RATE,
+                       STANDIN_COMPLETION_TOKENS, STANDIN_SEED)
+
+LOCATIONS_PATTERN = re.compile(r'Available Locations to pathfind to: (\[.*\])')
+NPCS_PATTERN = re.compile(r'Available NPCs to pathfind/converse to: (\[.*\])')
+BATCH_ID_PATTERN = re.compile(r'NPC id: (.+)')
+
+ACTIVITIES = ['reads a book', 'waters the plants', 'sweeps the floor', 'takes a nap', 'hums a tune']
+BATCH_ARGUMENTS = {'converse': ['target', 'message'], 'pathfind': ['target'], 'activity': ['message']}
+PLAN_STEPS = {'converse': ['target', 'message'], 'pathfind': ['target'], 'activity': ['message'],
+              'buy_food': [], 'eat': [], 'do_job': []}
+LINES = ['Hello there!', 'How has your day been?', 'The weather is lovely today.',
+         'Have you been to the shop lately?', 'I should get back to work.']
+
+
+class LLMBackend(ABC):
+    """
+    What llm.py talks to: a model_name and an async apredict_messages(messages, **kwargs)
+    that returns an AIMessage, with function calls in additional_kwargs['function_call']
+    like the OpenAI chat API.
+    """
+    model_name = None
+
+    @abstractmethod
+    async def apredict_messages(self, messages, **kwargs):
+        ...
+
+    async def close(self):
+        pass
+
+
+class OpenAIBackend(LLMBackend):
+    """
+    One ChatOpenAI client for the whole process, with its requests going through a pooled
+    keep-alive aiohttp session instead of the fresh session (and TLS handshake) openai
+    opens per async request by default. The session belongs to the event loop it was made
+    on, which is LLM_PIPELINE's for every call.
+    """
+    def __init__(self, model=LLM_MODEL):
+        self.model_name = model
+        self.chat = ChatOpenAI(model=model, max_retries=1)  # one attempt, llm_governor does the retrying
+        self.session = None
+
+    async def apredict_messages(self, messages, **kwargs):
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=LLM_MAX_CONNECTIONS, keepalive_timeout=LLM_KEEPALIVE_S)
+            self.session = aiohttp.ClientSession(connector=connector)
+        openai.aiosession.set(self.session)  # context of this task only
+        return await self.chat.apredict_messages(messages, **kwargs)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
+def _read_list(pattern, text):
+    match = pattern.search(text)
+    if not match:
+        return []
+    try:
+        return list(ast.literal_eval(match.group(1)))
+    except (ValueError, SyntaxError):
+        return []
+
+
+class StandInServer:
+    """
+    Local stand-in for the chat API for offline benchmarks and load tests. Answers are
+    valid function calls (plans of a few steps included) built from the NPC context in the
+    prompt (locations and NPCs it lists), picked deterministically from the prompt and seed. Latency is lognormal around
+    latency_ms, a fraction error_rate of calls fail with the errors openai raises for 429s
+    and outages, and token counts are tallied. Latency and errors come from one seeded
+    sequence, so a retried prompt doesn't fail forever.
+    """
+    def __init__(self, latency_ms=STANDIN_LATENCY_MS, latency_spread=STANDIN_LATENCY_SPREAD, error_rate=STANDIN_ERROR_RATE,
+                 completion_tokens=STANDIN_COMPLETION_TOKENS, seed=STANDIN_SEED):
+        self.latency_ms = latency_ms
+        self.latency_spread = latency_spread
+        self.error_rate = error_rate
+        self.completion_tokens = completion_tokens
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.calls = 0
+        self.errors = 0
+        self.prompt_tokens = 0
+        self.completion_tokens_used = 0
+        self.total_latency = 0.0
+
+    def _choose(self, rng, name, params, context):
+        """Arguments for one call of function name, valid for the NPC in context."""
+        locations = _read_list(LOCATIONS_PATTERN, context)
+        npcs = _read_list(NPCS_PATTERN, context)
+        args = {}
+        if 'target' in params:
+            targets = npcs if name == 'converse' else locations + npcs
+            if not targets:
+                return None
+            args['target'] = rng.choice(targets)
+        if 'message' in params:
+            args['message'] = rng.choice(ACTIVITIES if name == 'activity' else LINES)
+        if 'actions' in params:
+            steps = [self._decide(rng, PLAN_STEPS, context) for _ in range(rng.randint(2, 4))]
+            args['actions'] = [{'name': step[0], **step[1]} for step in steps if step]
+            if not args['actions']:
+                return None
+        return name, args
+
+    def _decide(self, rng, tools, context):
+        """tools maps function name -> its parameter names."""
+        options = sorted(tools)
+        rng.shuffle(options)
+        for name in options:
+            choice = self._choose(rng, name, tools[name], context)
+            if choice:
+                return choice
+        return None
+
+    def _answer(self, messages, functions, function_call):
+        text = "\n".join(m.content for m in messages)
+        rng = random.Random(f"{self.seed}:{hashlib.sha256(text.encode()).hexdigest()}")
+        if function_call and function_call.get('name') == 'decide_for_npcs':
+            item = functions[0]['parameters']['properties']['decisions']['items']['properties']
+            decision_tools = {name: BATCH_ARGUMENTS.get(name, []) for name in item['action']['enum']}
+            decisions = []
+            for message in messages:
+                npc_id = BATCH_ID_PATTERN.search(message.content)
+                choice = npc_id and self._decide(rng, decision_tools, message.content)
+                if choice:
+                    decisions.append({'npc': npc_id.group(1).strip(), 'action': choice[0], **choice[1]})
+            return AIMessage(content="", additional_kwargs={'function_call': {
+                'name': 'decide_for_npcs', 'arguments': json.dumps({'decisions': decisions})}})
+        if functions:
+            context = next((m.content for m in reversed(messages) if 'Available Locations' in m.content), "")
+            tools = {f['name']: list(f.get('parameters', {}).get('properties', {})) for f in functions}
+            choice = self._decide(rng, tools, context)
+            if choice:
+                return AIMessage(content="I'll do this next.", additional_kwargs={'function_call': {
+                    'name': choice[0], 'arguments': json.dumps(choice[1])}})
+        line = rng.choice(LINES)
+        return AIMessage(content=line + (" <eos>" if rng.random() < 0.3 else ""))
+
+    async def complete(self, messages, functions=None, function_call=None, **kwargs):
+        self.calls += 1
+        latency = self.latency_ms * math.exp(self.rng.gauss(0, self.latency_spread)) / 1000
+        failed = self.rng.random() < self.error_rate
+        self.prompt_tokens += (sum(len(m.content) for m in messages) + len(json.dumps(functions or []))) // 4
+        self.total_latency += latency
+        await asyncio.sleep(latency)
+        if failed:
+            self.errors += 1
+            if self.rng.random() < 0.5:
+                raise openai.error.RateLimitError("Rate limit reached (stand-in)", http_status=429)
+            raise openai.error.ServiceUnavailableError("The server is overloaded (stand-in)", http_status=503)
+        self.completion_tokens_used += max(1, int(self.rng.gauss(self.completion_tokens, self.completion_tokens / 4)))
+        return self._answer(messages, functions or [], function_call)
+
+    def stats(self):
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'prompt_tokens': self.prompt_tokens,
+            'completion_tokens': self.completion_tokens_used,
+            'mean_latency_ms': self.total_latency / self.calls * 1000 if self.calls else 0.0,
+        }
+
+
+# The one stand-in every StandInBackend talks to, like a local server
+STANDIN_SERVER = StandInServer()
+
+
+class StandInBackend(LLMBackend):
+    def __init__(self, model=LLM_MODEL, server=STANDIN_SERVER):
+        self.model_name = f"standin-{model}"
+        self.server = server
+
+    async def apredict_messages(self, messages, **kwargs):
+        return await self.server.complete(messages, **kwargs)
+
+
+# Picked by name with LLM_BACKEND in constants.py, or use_backend()
+LLM_BACKENDS = {
+    'openai': OpenAIBackend,
+    'standin': StandInBackend,
+}
+
+
+# Long-lived clients, one per (backend, model)
+_clients = {}
+_default = {'name': LLM_BACKEND}  # what get_backend() gives when it isn't named
+
+
+def use_backend(name):
+    """Make name the backend get_backend() hands out by default, e.g. 'standin' for a load test."""
+    if name not in LLM_BACKENDS:
+        raise ValueError(f"unknown LLM backend {name!r}, pick one of {sorted(LLM_BACKENDS)}")
+    _default['name'] = name
+
+
+def get_backend(name=None, model=LLM_MODEL):
+    """The shared client for a backend (the default one if None) and model, created on first use."""
+    name = name or _default['name']
+    key = (name, model)
+    if key not in _clients:
+        _clients[key] = LLM_BACKENDS[name](model)
+    return _clients[key]
+
+
+async def close_backends():
+    """Close every pooled client, run on the loop they were used on."""
+    for client in _clients.values():
+        await client.close()
+    _clients.clear()
@@ -0,0 +1,165 @@
+import asyncio
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from constants import USE_LLM_CACHE, LLM_CACHE_SIZE, LLM_CACHE_PATH, LLM_CACHE_TTL, LLM_CACHE_STAT_STEP
+
+# Status lines in get_context, e.g. "Social: 87.3"
+STAT_PATTERN = re.compile(r'\b(Hunger|Food|Currency|Social): (-?\d+(?:\.\d+)?)')
+
+
+def quantize_stats(text, step):
+    """Round the NPC stats in a context down to multiples of step, so nearly equal contexts match."""
+    if not step:
+        return text
+    return STAT_PATTERN.sub(lambda m: f"{m.group(1)}: {int(float(m.group(2)) // step * step)}", text)
+
+
+def cache_key(messages, functions=None, stat_step=LLM_CACHE_STAT_STEP, **kwargs):
+    """Hash of the messages, tool schemas and call options, with whitespace and stats normalized."""
+    normalized = {
+        'messages': [(m.type, ' '.join(quantize_stats(m.content, stat_step).split()), m.additional_kwargs) for m in messages],
+        'functions': functions,
+        'options': kwargs,
+    }
+    return hashlib.sha256(json.dumps(normalized, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class ResponseCache:
+    """
+    Two-tier cache of LLM responses keyed by cache_key: an in-memory LRU in front of a
+    SQLite table that survives between runs. Entries older than ttl seconds are misses
+    (None = keep forever). Values are JSON. A relative path is taken from this file's
+    directory. The SQLite work runs on a thread of its own, so the LLM pipeline's event
+    loop never waits on the disk: aget() awaits a lookup that misses memory, put() queues
+    the write and returns. Used from several threads, so the state is behind a lock. The
+    file is opened on first use. Callers skip the cache while enabled is False.
+    """
+    def __init__(self, max_size=LLM_CACHE_SIZE, path=LLM_CACHE_PATH, ttl=LLM_CACHE_TTL, enabled=USE_LLM_CACHE):
+        self.enabled = enabled
+        self.max_size = max_size
+        self.path = os.path.join(os.path.dirname(os.path.abspath(__file__)), path) if path else None
+        self.ttl = ttl
+        self.memory = OrderedDict()  # key -> (stored_at, value)
+        self.db = None
+        self.executor = None  # the one thread the database is used from
+        self.lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _connect(self):
+        if self.db is None and self.path:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT, stored_at REAL)")
+        return self.db
+
+    def _disk(self):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='llm-cache')
+        return self.executor
+
+    def _fresh(self, stored_at):
+        return self.ttl is None or time.time() - stored_at <= self.ttl
+
+    def _remember(self, key, stored_at, value):
+        self.memory[key] = (stored_at, value)
+        self.memory.move_to_end(key)
+        if len(self.memory) > self.max_size:
+            self.memory.popitem(last=False)
+
+    def _get_memory(self, key):
+        with self.lock:
+            if key in self.memory:
+                stored_at, value = self.memory[key]
+                if self._fresh(stored_at):
+                    self.memory_hits += 1
+                    self.memory.move_to_end(key)
+                    return value
+                del self.memory[key]
+            if not self.path:
+                self.misses += 1
+            return None
+
+    def _get_disk(self, key):
+        with self.lock:
+            db = self._connect()
+            row = db.execute("SELECT value, stored_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row and self._fresh(row[1]):
+                self.disk_hits += 1
+                value = json.loads(row[0])
+                self._remember(key, row[1], value)
+                return value
+            if row:
+                db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                db.commit()
+            self.misses += 1
+            return None
+
+    def get(self, key):
+        """Blocking lookup, for callers that aren't on an event loop."""
+        value = self._get_memory(key)
+        if value is None and self.path:
+            value = self._disk().submit(self._get_disk, key).result()
+        return value
+
+    async def aget(self, key):
+        value = self._get_memory(key)
+        if value is None and self.path:
+            value = await asyncio.get_running_loop().run_in_executor(self._disk(), self._get_disk, key)
+        return value
+
+    def _write(self, key, stored_at, value):
+        with self.lock:
+            self._connect().execute("INSERT OR REPLACE INTO responses (key, value, stored_at) VALUES (?, ?, ?)",
+                                    (key, json.dumps(value), stored_at))
+            self.db.commit()
+
+    def put(self, key, value):
+        stored_at = time.time()
+        with self.lock:
+            self._remember(key, stored_at, value)
+        if self.path:
+            self._disk().submit(self._write, key, stored_at, value)
+
+    def _clear_disk(self):
+        with self.lock:
+            self._connect().execute("DELETE FROM responses")
+            self.db.commit()
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+        if self.path:
+            self._disk().submit(self._clear_disk).result()  # after the writes queued before it
+
+    def close(self):
+        """Finish the queued writes and close the database."""
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+    def stats(self):
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            'size': len(self.memory),
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+        }
+
+
+# Shared by prompt() and converse_message(), decisions and replies alike
+LLM_CACHE = ResponseCache()
@@ -0,0 +1,201 @@
+import asyncio
+import contextvars
+import random
+import time
+from collections import Counter
+import openai
+from constants import (LLM_REQUESTS_PER_MIN, LLM_TOKENS_PER_MIN, LLM_BURST_S, LLM_MAX_IN_FLIGHT, LLM_PRIORITY_AGING_S,
+                       LLM_RETRIES, LLM_BACKOFF_S, LLM_BACKOFF_MAX_S)
+
+# Priority classes, lower is served first
+CONVERSATION = 0  # replies another NPC is waiting on
+DECISION = 1  # an idle NPC's next action
+SPECULATIVE = 2  # prefetched decisions that may not be used
+
+
+class Caller:
+    """
+    Who the LLM calls of a task are made for and at what priority, which can be raised
+    while they wait. owner is the request (an NPC's decision, a reply, a prefetch), npc
+    whose fair share the calls count against, the owner unless given.
+    """
+    def __init__(self, owner=None, priority=DECISION, npc=None):
+        self.owner = owner
+        self.priority = priority
+        self.npc = owner if npc is None else npc
+
+
+# The Caller of the LLM calls made in the current task, set by LLM_PIPELINE.submit
+CALLER = contextvars.ContextVar('llm_caller', default=Caller())
+
+# Worth trying again after a pause
+RETRYABLE = (openai.error.RateLimitError, openai.error.ServiceUnavailableError, openai.error.APIConnectionError,
+             openai.error.Timeout)
+
+
+class TokenBucket:
+    """rate_per_min units a minute, at most burst_s seconds' worth saved up."""
+    def __init__(self, rate_per_min, burst_s=LLM_BURST_S, clock=time.monotonic):
+        self.rate = rate_per_min / 60
+        self.capacity = max(1.0, self.rate * burst_s)
+        self.tokens = self.capacity
+        self.clock = clock
+        self.updated = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait(self, amount):
+        """Seconds until amount can be taken, 0 if it can now. More than capacity counts as capacity."""
+        self._refill()
+        missing = min(amount, self.capacity) - self.tokens
+        return max(0.0, missing / self.rate)
+
+    def take(self, amount):
+        self._refill()
+        self.tokens -= min(amount, self.capacity)
+
+
+class Waiter:
+    def __init__(self, caller, tokens, future, enqueued, order):
+        self.caller = caller
+        self.npc = caller.npc
+        self.tokens = tokens
+        self.future = future
+        self.enqueued = enqueued
+        self.order = order
+
+    @property
+    def priority(self):
+        return self.caller.priority
+
+
+class LLMGovernor:
+    """
+    The one way out to the LLM provider, every call waits its turn here. Calls go out
+    while there are fewer than max_in_flight out and both token buckets (requests and
+    tokens per minute) can pay for them. Waiting calls are served by priority class
+    (CONVERSATION, DECISION, SPECULATIVE). A call moves up a class for every aging_s
+    seconds it has waited, so nothing starves. Within a class, NPCs with fewer calls out
+    and fewer served so far go first, their decisions, replies and prefetches together, then the oldest call. Calls that fail with a
+    RETRYABLE error are retried up to retries times after a jittered exponential backoff.
+    A 429 also holds back every other call for a first backoff, since the provider is out
+    of budget for all of them.
+    """
+    def __init__(self, requests_per_min=LLM_REQUESTS_PER_MIN, tokens_per_min=LLM_TOKENS_PER_MIN, max_in_flight=LLM_MAX_IN_FLIGHT,
+                 aging_s=LLM_PRIORITY_AGING_S, retries=LLM_RETRIES, backoff_s=LLM_BACKOFF_S, backoff_max_s=LLM_BACKOFF_MAX_S,
+                 clock=time.monotonic):
+        self.requests = TokenBucket(requests_per_min, clock=clock)
+        self.tokens = TokenBucket(tokens_per_min, clock=clock)
+        self.max_in_flight = max_in_flight
+        self.aging_s = aging_s
+        self.retries = retries
+        self.backoff_s = backoff_s
+        self.backoff_max_s = backoff_max_s
+        self.clock = clock
+        self.rng = random.Random()
+        self.waiting = []  # Waiters
+        self.in_flight = Counter()  # Caller.npc -> calls out
+        self.served = Counter()  # Caller.npc -> calls sent so far
+        self.cooldown_until = 0.0
+        self.timer = None
+        self.order = 0
+        self.dispatched = Counter()  # priority class -> calls sent
+        self.waited = Counter()  # priority class -> seconds spent waiting
+        self.retried = 0
+        self.rate_limited = 0
+
+    def set_limits(self, requests_per_min, tokens_per_min):
+        """Start over with new per-minute limits, e.g. a load test's instead of the provider's."""
+        self.requests = TokenBucket(requests_per_min, clock=self.clock)
+        self.tokens = TokenBucket(tokens_per_min, clock=self.clock)
+
+    def _class(self, waiter, now):
+        return max(0, waiter.priority - int((now - waiter.enqueued) // self.aging_s))
+
+    def _dispatch(self):
+        self.timer = None
+        self.waiting = [w for w in self.waiting if not w.future.done()]  # cancelled while waiting
+        while self.waiting and sum(self.in_flight.values()) < self.max_in_flight:
+            now = self.clock()
+            waiter = min(self.waiting, key=lambda w: (self._class(w, now), self.in_flight[w.npc], self.served[w.npc], w.order))
+            delay = max(self.cooldown_until - now, self.requests.wait(1), self.tokens.wait(waiter.tokens))
+            if delay > 0:
+                self.timer = asyncio.get_running_loop().call_later(delay, self._dispatch)
+                return
+            self.waiting.remove(waiter)
+            self.requests.take(1)
+            self.tokens.take(waiter.tokens)
+            self.in_flight[waiter.npc] += 1
+            self.served[waiter.npc] += 1
+            self.dispatched[waiter.priority] += 1
+            self.waited[waiter.priority] += now - waiter.enqueued
+            waiter.future.set_result(None)
+
+    def _wake(self):
+        if self.timer is not None:
+            self.timer.cancel()
+        self._dispatch()
+
+    async def _acquire(self, caller, tokens):
+        future = asyncio.get_running_loop().create_future()
+        self.order += 1
+        self.waiting.append(Waiter(caller, tokens, future, self.clock(), self.order))
+        self._wake()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._release(caller.npc)  # let through just as it was cancelled
+            raise
+
+    def _release(self, npc):
+        self.in_flight[npc] -= 1
+        if not self.in_flight[npc]:
+            del self.in_flight[npc]
+        self._wake()
+
+    def backoff(self, attempt):
+        return min(self.backoff_max_s, self.backoff_s * 2 ** attempt) * self.rng.uniform(0.5, 1.5)
+
+    async def call(self, send, tokens):
+        """
+        await send() once it's this call's turn, retrying RETRYABLE errors. tokens is what
+        the call is expected to use, prompt and completion. Who it's for and its priority
+        come from CALLER.
+        """
+        caller = CALLER.get()
+        npc = caller.npc
+        attempt = 0
+        while True:
+            await self._acquire(caller, tokens)
+            try:
+                return await send()
+            except RETRYABLE as error:
+                if attempt >= self.retries:
+                    raise
+                delay = self.backoff(attempt)
+                if isinstance(error, openai.error.RateLimitError):
+                    self.rate_limited += 1
+                    self.cooldown_until = max(self.cooldown_until, self.clock() + self.backoff(0))
+            finally:
+                self._release(npc)
+            self.retried += 1
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    def stats(self):
+        return {
+            'waiting': len(self.waiting),
+            'in_flight': sum(self.in_flight.values()),
+            'dispatched': dict(self.dispatched),
+            'mean_wait_s': {p: self.waited[p] / n for p, n in self.dispatched.items()},
+            'retried': self.retried,
+            'rate_limited': self.rate_limited,
+        }
+
+
+# Shared by every LLM call, on LLM_PIPELINE's event loop
+LLM_GOVERNOR = LLMGovernor()
@@ -0,0 +1,104 @@
+import asyncio
+import threading
+from llm_governor import CALLER, DECISION, Caller
+
+
+async def _as_caller(coroutine, caller):
+    """Run coroutine with its LLM calls made as caller, for LLM_GOVERNOR."""
+    CALLER.set(caller)
+    return await coroutine
+
+
+class LLMPipeline:
+    """
+    Runs LLM calls as coroutines on an asyncio event loop in a background thread, so the
+    game loop never waits on the network and every NPC's request can be in flight at
+    once. Each request has an owner key: the NPC for its decisions, a tuple such as
+    ('reply', speaker, target) for the rest, so an NPC's decision and the replies it owes
+    don't collide. An owner has at most one request at a time, a second submit while
+    one is pending is refused, and promote() raises the priority it waits with. The results are applied by collect() at the start of the
+    next tick, on the game thread, so the game state is only ever changed there. The
+    loop is started on the first submit.
+    """
+    def __init__(self):
+        self.loop = None
+        self.thread = None
+        self.requests = {}  # owner -> (concurrent future, apply, fail, Caller)
+        self.completed = 0
+        self.failed = 0
+        self.refused = 0
+
+    def _start(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='llm-pipeline', daemon=True)
+        self.thread.start()
+
+    def submit(self, owner, coroutine, apply, fail=None, priority=DECISION, npc=None):
+        """
+        Run coroutine, then apply(result) or fail(exception) from a later collect(). Its
+        LLM calls wait with LLM_GOVERNOR at priority, as part of npc's share (owner's if
+        None). Returns False, without running it, if owner already has a request pending.
+        """
+        if owner in self.requests:
+            coroutine.close()
+            self.refused += 1
+            return False
+        if self.loop is None:
+            self._start()
+        caller = Caller(owner, priority, npc)
+        future = asyncio.run_coroutine_threadsafe(_as_caller(coroutine, caller), self.loop)
+        self.requests[owner] = (future, apply, fail, caller)
+        return True
+
+    def promote(self, owner, priority):
+        """Have owner's pending request wait with LLM_GOVERNOR at priority from now on, if that's higher."""
+        if owner in self.requests:
+            caller = self.requests[owner][3]
+            caller.priority = min(caller.priority, priority)
+
+    def run(self, coroutine, owner=None, priority=DECISION):
+        """Run coroutine on the pipeline's loop and wait for it, for callers that have to block."""
+        if self.loop is None:
+            self._start()
+        return asyncio.run_coroutine_threadsafe(_as_caller(coroutine, Caller(owner, priority)), self.loop).result()
+
+    def is_pending(self, owner):
+        return owner in self.requests
+
+    def in_flight(self):
+        return len(self.requests)
+
+    def collect(self):
+        """Apply every request that finished since the last call."""
+        for owner, (future, apply, fail, caller) in list(self.requests.items()):
+            if not future.done():
+                continue
+            del self.requests[owner]
+            error = future.exception()
+            if error is None:
+                self.completed += 1
+                apply(future.result())
+            else:
+                self.failed += 1
+                if fail:
+                    fail(error)
+
+    async def _cancel_all(self):
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def close(self):
+        if self.loop is None:
+            return
+        self.requests.clear()
+        asyncio.run_coroutine_threadsafe(self._cancel_all(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.loop = None
+
+
+# Shared by every NPC, collected from the game loop
+LLM_PIPELINE = LLMPipeline()
@@ -0,0 +1,96 @@
+"""
+Headless game loop against the stand-in LLM backend, for measuring tick throughput
+under realistic LLM latency without network access. Run from the repository root:
+
+    python llm-rpg/load_test.py --npcs 50 --ticks 600 --latency 800 --errors 0.02
+"""
+import argparse
+import random
+import time
+from constants import (IMAGE_PATH, COLORS, USE_ASYNC_LLM, USE_DECISION_BATCHING, STANDIN_LATENCY_MS, STANDIN_LATENCY_SPREAD,
+                       STANDIN_ERROR_RATE, STANDIN_SEED, LLM_REQUESTS_PER_MIN, LLM_TOKENS_PER_MIN)
+from game_map import GameMap
+from globals import NPC_REGISTRY
+from npc import NPC
+from llm_backends import STANDIN_SERVER, use_backend, close_backends
+from llm_pipeline import LLM_PIPELINE
+from llm_cache import LLM_CACHE
+from prompt_layout import PROMPT_ASSEMBLER
+from decision_rules import DECISION_RULES
+from decision_batch import DECISION_BATCHER
+from plans import PLANS
+from prefetch import PREFETCHER
+from llm import DECISIONS
+from llm_governor import LLM_GOVERNOR
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--npcs', type=int, default=20)
+    parser.add_argument('--ticks', type=int, default=600)
+    parser.add_argument('--fps', type=int, default=0, help='cap the tick rate like the game does, 0 = as fast as possible')
+    parser.add_argument('--latency', type=float, default=STANDIN_LATENCY_MS, help='median stand-in latency (ms)')
+    parser.add_argument('--spread', type=float, default=STANDIN_LATENCY_SPREAD)
+    parser.add_argument('--errors', type=float, default=STANDIN_ERROR_RATE, help='stand-in error rate')
+    parser.add_argument('--cache', action='store_true', help='answer repeated prompts from the LLM cache')
+    parser.add_argument('--seed', type=int, default=STANDIN_SEED)
+    parser.add_argument('--no-prefetch', action='store_true', help="don't ask for decisions before queues run out")
+    parser.add_argument('--rpm', type=int, default=LLM_REQUESTS_PER_MIN, help='governor requests per minute')
+    parser.add_argument('--tpm', type=int, default=LLM_TOKENS_PER_MIN, help='governor tokens per minute')
+    args = parser.parse_args()
+    use_backend('standin')
+    LLM_CACHE.enabled = args.cache
+    PREFETCHER.enabled = PREFETCHER.enabled and not args.no_prefetch
+    LLM_GOVERNOR.set_limits(args.rpm, args.tpm)
+
+    STANDIN_SERVER.latency_ms, STANDIN_SERVER.latency_spread = args.latency, args.spread
+    STANDIN_SERVER.error_rate, STANDIN_SERVER.seed = args.errors, args.seed
+    STANDIN_SERVER.rng = random.Random(args.seed)
+    random.seed(args.seed)
+    game_map = GameMap(IMAGE_PATH)
+    cells = game_map.walkable_cells((0, 0), (game_map.width - 1, game_map.height - 1))
+    colors = list(COLORS)
+    for i, cell in enumerate(random.sample(cells, args.npcs)):
+        npc = NPC(*cell, colors[i % len(colors)])
+        npc.name = f"{npc.name}{i}"  # colors repeat, names have to be unique for converse/pathfind targets
+
+    tick_times = []
+    most_in_flight = 0
+    idle = 0  # NPC ticks spent with nothing queued
+    started = time.perf_counter()
+    for _ in range(args.ticks):
+        tick_start = time.perf_counter()
+        if USE_ASYNC_LLM:
+            LLM_PIPELINE.collect()
+        for npc in NPC_REGISTRY:
+            if npc.hunger > 90 or npc.social < 10:
+                npc.hunger, npc.social = 0, 100  # keep everyone alive, stats aren't what's measured
+            npc.move(game_map)
+            idle += not npc.action_queue
+        if USE_DECISION_BATCHING:
+            DECISION_BATCHER.flush()
+        most_in_flight = max(most_in_flight, LLM_PIPELINE.in_flight())
+        tick_times.append(time.perf_counter() - tick_start)
+        if args.fps:
+            time.sleep(max(0.0, 1 / args.fps - tick_times[-1]))
+    elapsed = time.perf_counter() - started
+    LLM_PIPELINE.run(close_backends())
+    LLM_PIPELINE.close()
+    LLM_CACHE.close()
+
+    tick_times.sort()
+    print(f"{args.ticks} ticks with {args.npcs} NPCs in {elapsed:.2f}s: {args.ticks / elapsed:.1f} ticks/s")
+    print(f"tick ms: p50 {tick_times[len(tick_times) // 2] * 1000:.2f}, "
+          f"p95 {tick_times[int(len(tick_times) * 0.95)] * 1000:.2f}, max {tick_times[-1] * 1000:.2f}")
+    print(f"decisions applied: {LLM_PIPELINE.completed}, failed: {LLM_PIPELINE.failed}, most in flight: {most_in_flight}")
+    print(f"stand-in: {STANDIN_SERVER.stats()}")
+    print(f"prompt prefix: {PROMPT_ASSEMBLER.stats()}")
+    print(f"decision rules: {DECISION_RULES.stats()}")
+    print(f"LLM decisions: {dict(DECISIONS)}")
+    print(f"governor: {LLM_GOVERNOR.stats()}")
+    print(f"plans: {PLANS.stats()}")
+    print(f"idle NPC ticks: {idle / (args.ticks * args.npcs):.1%}, prefetch: {PREFETCHER.stats()}")
+
+
+if __name__ == '__main__':
+    main()
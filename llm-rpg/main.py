@@ -1,9 +1,16 @@
 import pygame
 import os
 from game_map import GameMap, create_map_image
-from constants import SCREEN_WIDTH, SCREEN_HEIGHT, IMAGE_PATH
+from constants import SCREEN_WIDTH, SCREEN_HEIGHT, IMAGE_PATH, COOPERATIVE_PATHFINDING, USE_PATH_SCHEDULER, USE_PATH_WORKERS, USE_ASYNC_LLM, USE_DECISION_BATCHING
 from globals import NPC_REGISTRY
 from npc import NPC
+from cooperative import COOPERATIVE_PLANNER
+from path_scheduler import PATH_SCHEDULER
+from path_workers import PATH_WORKERS
+from llm_pipeline import LLM_PIPELINE
+from llm_backends import close_backends
+from llm_cache import LLM_CACHE
+from decision_batch import DECISION_BATCHER
 
 def main():
     pygame.init()
@@ -31,14 +38,36 @@ def main():
                 running = False
         
         screen.blit(game_map.map_image, (0, 0))
+        if USE_ASYNC_LLM:
+            # queue the decisions and replies that came back since last tick
+            LLM_PIPELINE.collect()
+        if COOPERATIVE_PATHFINDING:
+            # plan every path requested last tick together, before anyone moves
+            COOPERATIVE_PLANNER.begin_tick(game_map)
+        if USE_PATH_SCHEDULER:
+            # finish what searches fit in this frame, the rest carry over to the next
+            PATH_SCHEDULER.process()
+        if USE_PATH_WORKERS:
+            PATH_WORKERS.collect()
         # NPC_REGISTRY: list[NPC]
         for npc in NPC_REGISTRY:
             
             npc.move(game_map)
             npc.draw(screen)
+        if USE_PATH_WORKERS:
+            # send this frame's requests off together
+            PATH_WORKERS.flush()
+        if USE_DECISION_BATCHING:
+            # send the decisions asked for this tick once the batch window is over
+            DECISION_BATCHER.flush()
         pygame.display.flip()
         clock.tick(60)
 
+    PATH_WORKERS.close()
+    if LLM_PIPELINE.loop is not None:
+        LLM_PIPELINE.run(close_backends())
+    LLM_PIPELINE.close()
+    LLM_CACHE.close()  # writes still queued go to disk
     pygame.quit()
 
 
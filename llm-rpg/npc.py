@@ -1,24 +1,31 @@
 import pygame
 from brain import Brain  # This is the decision-making logic which we'll define later
-from globals import NPC_REGISTRY
+from globals import NPC_REGISTRY, NPC_INDEX
 from constants import GRID_SIZE, COLORS
 from collections import deque
 import random
-from llm import converse_message
+from llm import converse_message, conversation_messages, reply
+from llm_pipeline import LLM_PIPELINE
+from llm_governor import CONVERSATION
+from constants import USE_ASYNC_LLM
+from plans import PLANS
 class Action:
-    def __init__(self, action_type, target=None, message=None, end=False):
+    def __init__(self, action_type, target=None, message=None, end=False, location=None):
         self.type = action_type  # 'pathfind', 'converse'
         self.target = target
         self.message = message
         self.end = end
+        self.location = location  # Location a pathfind target point was picked from
+        self.plan = None  # plans.Plan the action was queued as a step of
 
 class NPC:
     def __init__(self, x, y, color):
-        self.x = x
-        self.y = y
+        self._x = x
+        self._y = y
         self.color = color
         self.brain = Brain(self)
         NPC_REGISTRY.append(self)
+        NPC_INDEX.insert(self, (x, y))
 
         self.action_queue: deque = deque()  # Queue for actions
         self.paused_action = None
@@ -30,15 +37,45 @@ class NPC:
         self.food = 100
         self.current_conversation = []
         self.reasoning_history = []
+        self.owes_replies = set()  # NPCs this one's reply to is on its way for, with USE_ASYNC_LLM
 
         self.logs = []
 
+    @property
+    def x(self):
+        return self._x
+
+    @x.setter
+    def x(self, value):
+        self._x = value
+        NPC_INDEX.move(self, (self._x, self._y))
+
+    @property
+    def y(self):
+        return self._y
+
+    @y.setter
+    def y(self, value):
+        self._y = value
+        NPC_INDEX.move(self, (self._x, self._y))
+
+    def despawn(self):
+        """Take the NPC out of the world."""
+        NPC_REGISTRY.remove(self)
+        NPC_INDEX.remove(self)
+
     def clear_logs(self):
         self.logs = []
 
     def add_log(self, message):
         print(message)
         self.logs.append(message)
+        self.brain.memory.remember(message)
+
+    def hear(self, line):
+        """A conversation turn, said by this NPC or to it."""
+        self.current_conversation.append(line)
+        self.brain.memory.remember(line)
 
 
     def draw(self, screen):
@@ -55,8 +92,10 @@ class NPC:
                 self.add_log(f"NPC {COLORS[self.color]} ate food at {current_location_name}.")
             else:
                 self.add_log(f"NPC {COLORS[self.color]} does not have enough food to eat.")
+                self.action_failed(action)
         else:
             self.add_log(f"NPC {COLORS[self.color]} is not Home and cannot eat.")
+            self.action_failed(action)
         
         # deque
         self.action_queue.popleft()        
@@ -72,8 +111,10 @@ class NPC:
                 self.add_log(f"NPC {COLORS[self.color]} bought food at the Shop.")
             else:
                 self.add_log(f"NPC {COLORS[self.color]} does not have enough currency to buy food.")
+                self.action_failed(action)
         else:
             self.add_log(f"NPC {COLORS[self.color]} is not in the Shop and cannot buy food.")
+            self.action_failed(action)
         
         # deque
         self.action_queue.popleft()
@@ -92,6 +133,7 @@ class NPC:
                 self.add_log(f"NPC {COLORS[self.color]} has too much money.")
         else:
             self.add_log(f"NPC {COLORS[self.color]} is not in the Workplace and cannot earn money.")
+            self.action_failed(action)
         
         # deque
         self.action_queue.popleft()
@@ -106,25 +148,38 @@ class NPC:
     def _execute_pathfind(self, action, game_map):
         target = action.target
         if not self.brain.path:
-            self.brain.determine_path((self.x, self.y), game_map)
+            if not self.brain.path_pending:
+                self.brain.determine_path((self.x, self.y), game_map)
+            if self.brain.path_pending:
+                return  # wait in place until the path is planned
             if not self.brain.path:
+                if self.brain.path is None:
+                    self.action_failed(action)  # no way there
                 self.action_queue.popleft()
                 self.resume_previous_action()
                 return
 
-        if self.brain.target_has_moved_significantly():
+        if self.brain.follow_target((self.x, self.y), game_map):
+            if not self.brain.path:
+                return  # full re-search pending or found nothing, handled next tick
+        elif self.brain.target_has_moved_significantly():
             self.brain.determine_path((self.x, self.y), game_map)
+            if self.brain.path_pending:
+                return
         # Check if next step is blocked by another NPC and recompute path if necessary
         
         next_step = self.brain.path.pop(0)
         
-        if (next_step[0], next_step[1]) in [(npc.x, npc.y) for npc in NPC_REGISTRY if npc != self]:
-            # another npc in next step.
-            self.brain.path = None
-            self.brain.determine_path((self.x, self.y), game_map)
+        if NPC_INDEX.is_occupied(next_step, exclude=self):
+            # another npc in next step, repair the path around it
+            self.brain.replan((self.x, self.y), game_map)
+            if not self.brain.path:
+                # no way through right now, wait here and search again next tick
+                self.brain.path = None
+                return
             next_step = self.brain.path.pop(0)
             
-            if (next_step[0], next_step[1]) in [(npc.x, npc.y) for npc in NPC_REGISTRY if npc != self]:
+            if NPC_INDEX.is_occupied(next_step, exclude=self):
                 pass
             else:
                 self.x, self.y = next_step
@@ -146,11 +201,15 @@ class NPC:
             return
         
 
-    def queue_action(self, action_type, target=None, message=None, end=False):
+    def queue_action(self, action_type, target=None, message=None, end=False, location=None):
         """Queue an action for the NPC."""
-        action = Action(action_type, target=target, message=message, end=end)
+        action = Action(action_type, target=target, message=message, end=end, location=location)
         self.action_queue.append(action)
 
+    def action_failed(self, action):
+        """The action couldn't be done, PLANS decides what happens to the rest of its plan."""
+        PLANS.step_failed(self, action)
+
     def resume_previous_action(self):
         if self.paused_action:
             self.action_queue.append(self.paused_action)
@@ -166,29 +225,56 @@ class NPC:
                 # self.queue_action('pathfind', target=target_npc)
                 
                 self.add_log(f"{target_npc.name} is too far away to talk to!")
+                self.action_failed(action)
                 self.action_queue.popleft()  # Dequeue the current action
                 return
             else:
+                replying = False
                 if not self.action_queue[0].end:
                     if not target_npc.paused_action and target_npc.action_queue:
                         target_npc.paused_action = target_npc.action_queue.popleft()  # Pause target's current action
                     
-                    self.current_conversation.append(self.name +": "+ action.message)
-                    target_npc.current_conversation.append(self.name +": "+ action.message)
-                    response, end = converse_message(target_npc, game_map, NPC_REGISTRY, target_npc.brain.last_actions)
-                    
-                    self.current_conversation.append(target_npc.name +": "+ response)
-                    target_npc.current_conversation.append(target_npc.name +": "+ response)
-                    # target_npc.queue_action('converse', message=random.choice(['Hello', 'How are you?', 'Nice to meet you']), target=self, end=True)  # Force target to converse
-                    target_npc.queue_action('converse', message=response, target=self, end=end)  # Force target to converse
+                    self.hear(self.name +": "+ action.message)
+                    target_npc.hear(self.name +": "+ action.message)
+                    if USE_ASYNC_LLM:
+                        # the target's reply is queued when it arrives, the target idles until then
+                        def replied(result):
+                            self._receive_reply(target_npc, *result)
+                            self.end_conversation(game_map)
+
+                        def failed(error):
+                            self._reply_failed(target_npc, error)
+                            self.end_conversation(game_map)
+
+                        messages = conversation_messages(target_npc, game_map, NPC_REGISTRY, target_npc.brain.last_actions)
+                        if LLM_PIPELINE.submit(('reply', self, target_npc), reply(messages), replied, failed, priority=CONVERSATION,
+                                               npc=target_npc):
+                            target_npc.owes_replies.add(self)
+                            replying = True
+                    else:
+                        self._receive_reply(target_npc, *converse_message(target_npc, game_map, NPC_REGISTRY, target_npc.brain.last_actions))
                 
                 self.add_log(f"NPC {COLORS[self.color]} says: {action.message}")
                 self.social += 25
                 self.action_queue.popleft()  # Dequeue the current action
-                # End the conversation for both NPCs
-                self.end_conversation(game_map)
+                # End the conversation for both NPCs, once the reply is in like without USE_ASYNC_LLM
+                if not replying:
+                    self.end_conversation(game_map)
                 # target_npc.end_conversation(game_map)
 
+    def _receive_reply(self, target_npc, response, end):
+        target_npc.owes_replies.discard(self)
+        self.hear(target_npc.name +": "+ response)
+        target_npc.hear(target_npc.name +": "+ response)
+        # target_npc.queue_action('converse', message=random.choice(['Hello', 'How are you?', 'Nice to meet you']), target=self, end=True)  # Force target to converse
+        target_npc.queue_action('converse', message=response, target=self, end=end)  # Force target to converse
+
+    def _reply_failed(self, target_npc, error):
+        target_npc.owes_replies.discard(self)
+        target_npc.add_log(f"NPC {COLORS[target_npc.color]} couldn't answer {self.name} ({error}).")
+        if not target_npc.owes_replies:
+            target_npc.resume_previous_action()
+
     def end_conversation(self, game_map):
         self.current_conversation = []
         if self.paused_action:
@@ -213,8 +299,11 @@ class NPC:
 
         if not self.action_queue:
             self.brain.decide_action(game_map, NPC_REGISTRY)
+            if not self.action_queue:
+                return  # decision or conversation reply still on its way, idle this tick
 
         current_action = self.action_queue[0]  # Peek the first action
+        self.brain.prefetch(game_map, NPC_REGISTRY)
         
         action_function = '_execute_' + current_action.type
         getattr(self, action_function)(current_action, game_map)
@@ -0,0 +1,147 @@
+from collections import OrderedDict
+from constants import PATH_CACHE_SIZE, PATH_REPAIR_EXPANSIONS
+from pathfinding import LazyPath, grid_a_star, occupied_cells
+from hierarchy import get_door_graph
+
+
+def repair_path(path, start, game_map, blocked, max_expansions=PATH_REPAIR_EXPANSIONS):
+    """
+    Detour around the stretches of path that run through blocked cells, searching only
+    from the cell before each stretch to the cell after it. Returns None if the goal
+    itself is blocked or a detour isn't found within max_expansions.
+    """
+    path = list(path)
+    i = 0
+    while i < len(path):
+        if path[i] not in blocked:
+            i += 1
+            continue
+        j = i
+        while j < len(path) and path[j] in blocked:
+            j += 1
+        if j == len(path):
+            return None
+        anchor = path[i - 1] if i > 0 else start
+        detour = grid_a_star(game_map.wall_bytes, game_map.width, game_map.height, anchor, path[j], blocked, max_expansions)
+        if detour is None:
+            return None
+        path[i:j + 1] = detour
+        i += len(detour)
+    return path
+
+
+class PathCache:
+    """
+    LRU cache of routes over the door graph and of the static paths (walls only) between
+    doors, keyed with the map version. A route is keyed by the regions it joins (a house,
+    the shop, the workplace, or the village outside them), so a trip reuses it whatever
+    cell it starts from and whichever random point of the Location it was sent to. The
+    path comes back as a LazyPath: the stretches from the start to the first door and from
+    the last door to the goal are searched as they're walked, the ones between doors come
+    from the cache and are locally repaired around the NPCs standing on them right then.
+    Trips within one region are searched directly.
+    """
+    def __init__(self, max_size=PATH_CACHE_SIZE):
+        self.max_size = max_size
+        self.paths = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.direct = 0
+        self.repairs = 0
+        self.failed_repairs = 0
+
+    def _lookup(self, key, compute):
+        if key in self.paths:
+            self.paths.move_to_end(key)
+            return self.paths[key], True
+        value = compute()
+        self.paths[key] = value
+        if len(self.paths) > self.max_size:
+            self.paths.popitem(last=False)
+        return value, False
+
+    def route(self, start, goal, game_map):
+        """Door nodes from start's region to goal's, or None if they aren't joined."""
+        graph = get_door_graph(game_map)
+        key = ('route', graph.region(*start), graph.region(*goal), game_map.version)
+
+        def compute():
+            waypoints = graph.abstract_path(start, goal)
+            return tuple(waypoints[:-1]) if waypoints is not None else None
+
+        route, hit = self._lookup(key, compute)
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return route
+
+    def door_path(self, a, b, game_map):
+        """Static path between two door nodes, through their region or the door between them."""
+        graph = get_door_graph(game_map)
+
+        def compute():
+            region = graph.region(*a)
+            walls = graph.region_walls[region] if region == graph.region(*b) else game_map.wall_bytes
+            path = grid_a_star(walls, game_map.width, game_map.height, a, b)
+            return tuple(path) if path is not None else None
+
+        return self._lookup(('door', a, b, game_map.version), compute)[0]
+
+    def find_path(self, start, target, game_map, current_npc):
+        """Same signature as a_star_pathfinding."""
+        goal = target['data']
+        npc = current_npc.get('npc')
+
+        def blocked():
+            position = (npc.x, npc.y) if npc else current_npc['data']
+            return occupied_cells(target, {'type': 'npc', 'data': position})
+
+        graph = get_door_graph(game_map)
+        route = None
+        if game_map.in_bounds(*start) and game_map.in_bounds(*goal) and graph.region(*start) != graph.region(*goal):
+            route = self.route(start, goal, game_map)
+        if route is None:
+            self.direct += 1
+            return grid_a_star(game_map.wall_bytes, game_map.width, game_map.height, start, goal, blocked())
+
+        def refine(a, b):
+            if a in graph.nodes and b in graph.nodes:
+                path = self.door_path(a, b, game_map)
+                if path is None:
+                    return None
+                occupied = blocked()
+                if not any(cell in occupied for cell in path):
+                    return list(path)
+                self.repairs += 1
+                repaired = repair_path(path, a, game_map, occupied)
+                if repaired is None:
+                    self.failed_repairs += 1
+                return repaired
+            region = graph.region(*a)
+            walls = graph.region_walls[region] if region == graph.region(*b) else game_map.wall_bytes
+            return grid_a_star(walls, game_map.width, game_map.height, a, b, blocked())
+
+        def fallback(position):
+            return grid_a_star(game_map.wall_bytes, game_map.width, game_map.height, position, goal, blocked())
+
+        return LazyPath(start, list(route) + [goal], refine, fallback)
+
+    def clear(self):
+        self.paths.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self.paths),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'direct': self.direct,
+            'repairs': self.repairs,
+            'failed_repairs': self.failed_repairs,
+        }
+
+
+# Shared by every NPC's Brain
+PATH_CACHE = PathCache()
@@ -0,0 +1,75 @@
+import heapq
+import itertools
+import time
+from constants import PATHFINDING_BUDGET_MS, PATHFINDING_SLICE
+from pathfinding import AStarSearch, occupied_cells
+
+WAITING = 0  # the NPC has no path and stands still until this one is done
+REFRESH = 1  # the NPC keeps walking its old path meanwhile
+
+
+class PathRequest:
+    def __init__(self, npc, action, search, priority):
+        self.npc = npc
+        self.action = action  # the pathfind action the path is for, results for old actions are dropped
+        self.search = search
+        self.priority = priority
+
+
+class PathScheduler:
+    """
+    Queue of pathfinding requests worked off under a per-frame time budget, so one long
+    search can't stall the 60 FPS loop. Searches are AStarSearch objects that are stepped
+    a slice at a time and picked up again next frame when the budget runs out. NPCs that
+    are standing around without a path go first. A search sees the cells NPCs stood on
+    when it was submitted, not the live index, so every cell it settles is judged against
+    the same blocked set.
+    """
+    def __init__(self, budget_ms=PATHFINDING_BUDGET_MS, slice_size=PATHFINDING_SLICE):
+        self.budget = budget_ms / 1000
+        self.slice_size = slice_size
+        self.queue = []
+        self.requests = {}  # npc -> its live PathRequest
+        self.order = itertools.count()
+        self.completed = 0
+        self.last_frame_ms = 0.0
+
+    def submit(self, npc, action, start, target, game_map, priority=WAITING):
+        """Queue a search, replacing any earlier one for the same NPC."""
+        current_npc = {'type': 'npc', 'data': start, 'npc': npc}
+        blocked = frozenset(occupied_cells(target, current_npc))
+        search = AStarSearch(game_map.wall_bytes, game_map.width, game_map.height, start, target['data'], blocked)
+        request = PathRequest(npc, action, search, priority)
+        self.requests[npc] = request
+        heapq.heappush(self.queue, (priority, next(self.order), request))
+
+    def cancel(self, npc):
+        self.requests.pop(npc, None)
+
+    def is_pending(self, npc):
+        return npc in self.requests
+
+    def process(self):
+        """Work on queued searches until this frame's budget is spent."""
+        started = time.perf_counter()
+        deadline = started + self.budget
+        while self.queue and time.perf_counter() < deadline:
+            priority, order, request = self.queue[0]
+            if self.requests.get(request.npc) is not request:
+                heapq.heappop(self.queue)  # replaced or cancelled
+                continue
+            if not request.search.step(self.slice_size):
+                continue  # same request stays on top until it finishes or time is up
+            heapq.heappop(self.queue)
+            del self.requests[request.npc]
+            self.completed += 1
+            queue = request.npc.action_queue
+            if queue and queue[0] is request.action:
+                request.npc.brain.receive_path(request.search.result)
+            else:
+                request.npc.brain.path_pending = False  # action moved on, it'll ask again if needed
+        self.last_frame_ms = (time.perf_counter() - started) * 1000
+
+
+# Shared by every NPC's Brain, driven from the game loop
+PATH_SCHEDULER = PathScheduler()
@@ -0,0 +1,163 @@
+import atexit
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+from constants import PATH_WORKER_COUNT, PATH_WORKER_BATCH
+from pathfinding import grid_a_star, occupied_cells
+
+logger = logging.getLogger(__name__)
+
+# Set in each worker process, the wall grid it has mapped
+_worker_shm = None
+
+
+def _close_worker_shm():
+    global _worker_shm
+    if _worker_shm is not None:
+        _worker_shm.close()
+        _worker_shm = None
+
+
+def _init_worker():
+    atexit.register(_close_worker_shm)
+
+
+def _solve_batch(shm_name, width, height, requests):
+    """Run in a worker: A* for each (start, goal, blocked) against the shared wall grid called shm_name."""
+    global _worker_shm
+    if _worker_shm is None or _worker_shm.name != shm_name:
+        _close_worker_shm()  # the walls changed since, that grid is retired
+        _worker_shm = shared_memory.SharedMemory(name=shm_name)
+    walls = _worker_shm.buf
+    try:
+        return [grid_a_star(walls, width, height, start, goal, blocked) for start, goal, blocked in requests]
+    finally:
+        del walls  # no export left on the buffer, so it can be closed
+
+
+class PathWorkerPool:
+    """
+    Pathfinding on a pool of worker processes. The static collision grid lives in shared
+    memory that every worker maps once, so a request only carries its start, goal and a
+    snapshot of the cells other NPCs stand on. Requests made during a frame are sent off
+    in batches by flush() and the finished paths are handed to each Brain by collect().
+    The pool and shared grid are created on the first submit. A grid is never written
+    once workers may be reading it: when the walls change a new one is made for the
+    batches sent from then on, and the old one is freed once its batches are done. A
+    batch that fails (a worker died, the pool broke) is logged and searched in-process.
+    """
+    def __init__(self, workers=PATH_WORKER_COUNT, batch_size=PATH_WORKER_BATCH):
+        self.workers = workers or os.cpu_count() or 1
+        self.batch_size = batch_size
+        self.executor = None
+        self.game_map = None
+        self.shm = None  # grid of game_map.version
+        self.version = None
+        self.retired = []  # grids of earlier versions, until their batches are done
+        self.pending = []  # (npc, action, (start, goal, blocked)) not sent yet
+        self.in_flight = []  # (future, shm, [(npc, action, request), ...])
+        self.completed = 0
+        self.failed_batches = 0
+
+    def _share_walls(self, game_map):
+        if self.shm is not None:
+            self.retired.append(self.shm)
+        self.shm = shared_memory.SharedMemory(create=True, size=len(game_map.wall_bytes))
+        self.shm.buf[:len(game_map.wall_bytes)] = game_map.wall_bytes
+        self.version = game_map.version
+
+    def _free_retired(self):
+        in_use = {shm.name for _, shm, _ in self.in_flight}
+        for shm in [shm for shm in self.retired if shm.name not in in_use]:
+            self.retired.remove(shm)
+            shm.close()
+            shm.unlink()
+
+    def _start(self):
+        # spawn rather than fork, the game process has SDL running
+        self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'),
+                                            initializer=_init_worker)
+
+    def submit(self, npc, action, start, target, game_map):
+        self.game_map = game_map
+        if self.executor is None:
+            self._start()
+        if self.shm is None or game_map.version != self.version:
+            self._share_walls(game_map)
+        blocked = set(occupied_cells(target, {'type': 'npc', 'data': start, 'npc': npc}))  # snapshot for pickling
+        self.pending.append((npc, action, (start, target['data'], blocked)))
+
+    def is_pending(self, npc):
+        return any(p[0] is npc for p in self.pending) or \
+            any(owner[0] is npc for _, _, chunk in self.in_flight for owner in chunk)
+
+    def flush(self):
+        """Send everything submitted since the last flush, split into one batch per worker at most."""
+        if not self.pending:
+            return
+        size = max(1, min(self.batch_size, -(-len(self.pending) // self.workers)))
+        for i in range(0, len(self.pending), size):
+            chunk = self.pending[i:i + size]
+            future = self.executor.submit(_solve_batch, self.shm.name, self.game_map.width, self.game_map.height,
+                                          [request for _, _, request in chunk])
+            self.in_flight.append((future, self.shm, chunk))
+        self.pending = []
+
+    def _solve_here(self, chunk):
+        game_map = self.game_map
+        return [grid_a_star(game_map.wall_bytes, game_map.width, game_map.height, start, goal, blocked)
+                for _, _, (start, goal, blocked) in chunk]
+
+    def collect(self):
+        """Hand finished paths to their NPCs, skipping ones whose pathfind action has moved on."""
+        still_running = []
+        broken = False
+        for future, shm, chunk in self.in_flight:
+            if not future.done():
+                still_running.append((future, shm, chunk))
+                continue
+            try:
+                paths = future.result()
+            except Exception as error:
+                logger.exception("pathfinding batch of %d failed in a worker, searching it here", len(chunk))
+                self.failed_batches += 1
+                broken = broken or isinstance(error, BrokenProcessPool)
+                paths = self._solve_here(chunk)
+            for (npc, action, _), path in zip(chunk, paths):
+                self.completed += 1
+                if npc.action_queue and npc.action_queue[0] is action:
+                    npc.brain.receive_path(path)
+                else:
+                    npc.brain.path_pending = False
+        self.in_flight = still_running
+        if broken:
+            # every batch still out is lost with the pool, a new one starts on the next submit
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+        self._free_retired()
+
+    def stats(self):
+        return {
+            'pending': len(self.pending),
+            'in_flight': len(self.in_flight),
+            'completed': self.completed,
+            'failed_batches': self.failed_batches,
+        }
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None
+        self.in_flight = []
+        for shm in self.retired + ([self.shm] if self.shm is not None else []):
+            shm.close()
+            shm.unlink()
+        self.retired = []
+        self.shm = None
+
+
+# Shared by every NPC's Brain, driven from the game loop
+PATH_WORKERS = PathWorkerPool()
@@ -1,101 +1,258 @@
+import heapq
+from collections import deque
 from constants import *
-from globals import NPC_REGISTRY
+from globals import NPC_INDEX
 
-class Node:
-    def __init__(self, x, y):
-        self.x = x
-        self.y = y
-        self.g = 0
-        self.h = 0
-        self.f = 0
-        self.parent = None
+NEIGHBORS = [(0, -1), (0, 1), (-1, 0), (1, 0)]
 
-    def __eq__(self, other):
-        return self.x == other.x and self.y == other.y
+
+def manhattan(a, b):
+    return abs(a[0] - b[0]) + abs(a[1] - b[1])
+
+
+def occupied_cells(target, current_npc):
+    """Live view of the cells taken by other NPCs, leaving out the searching NPC and an NPC target."""
+    if target['type'] == 'npc':
+        return NPC_INDEX.view({current_npc['data'], target['data']})
+    return NPC_INDEX.view({current_npc['data']})
+
+
+class AStarSearch:
+    """
+    Binary-heap A* over a flat row-major wall grid (index = y * width + x, nonzero = wall),
+    with flat g-score/parent lists and a closed bitmap. The search can be run a slice at a
+    time with step(), so a caller with a frame budget can spread it over several frames.
+    When done, result is the list of cells from the step after start up to and including
+    goal, [] if start is the goal, or None if the goal can't be reached.
+    """
+    def __init__(self, wall_bytes, width, height, start, goal, blocked=()):
+        self.wall_bytes = wall_bytes
+        self.width = width
+        self.height = height
+        self.start_i = start[1] * width + start[0]
+        self.goal = goal
+        self.goal_i = goal[1] * width + goal[0]
+        self.blocked = blocked
+        self.expansions = 0
+        self.result = None
+        self.done = self.start_i == self.goal_i
+        if self.done:
+            self.result = []
+            return
+
+        size = width * height
+        self.g_score = [-1] * size
+        self.parent = [-1] * size
+        self.closed = bytearray(size)
+        self.g_score[self.start_i] = 0
+        h = manhattan(start, goal)
+        self.open_heap = [(h, h, self.start_i)]
+
+    def step(self, max_expansions=None):
+        """Expand up to max_expansions more nodes (all of them if None). Returns self.done."""
+        if self.done:
+            return True
+        wall_bytes, width, height = self.wall_bytes, self.width, self.height
+        g_score, parent, closed, open_heap = self.g_score, self.parent, self.closed, self.open_heap
+        blocked, goal_i = self.blocked, self.goal_i
+        gx, gy = self.goal
+        budget = max_expansions
+        while open_heap:
+            _, _, current = heapq.heappop(open_heap)
+            if closed[current]:
+                continue  # stale heap entry
+            if current == goal_i:
+                path = []
+                while current != self.start_i:
+                    path.append((current % width, current // width))
+                    current = parent[current]
+                self.result = path[::-1]
+                self.done = True
+                return True
+            closed[current] = 1
+            self.expansions += 1
+
+            cx, cy = current % width, current // width
+            child_g = g_score[current] + 1
+            for dx, dy in NEIGHBORS:
+                x, y = cx + dx, cy + dy
+                if x < 0 or x >= width or y < 0 or y >= height:
+                    continue
+                child = y * width + x
+                if closed[child] or wall_bytes[child] or (x, y) in blocked:
+                    continue
+                if g_score[child] != -1 and g_score[child] <= child_g:
+                    continue
+                g_score[child] = child_g
+                parent[child] = current
+                h = abs(x - gx) + abs(y - gy)
+                heapq.heappush(open_heap, (child_g + h, h, child))
+
+            if budget is not None:
+                budget -= 1
+                if budget <= 0:
+                    return False
+
+        self.done = True  # No path found
+        return True
+
+
+def grid_a_star(wall_bytes, width, height, start, goal, blocked=(), max_expansions=None):
+    """
+    Run an AStarSearch to the end. Returns the list of cells from the step after start up
+    to and including goal, [] if start is the goal, or None if the goal can't be reached
+    (within max_expansions).
+    """
+    search = AStarSearch(wall_bytes, width, height, start, goal, blocked)
+    if not search.step(max_expansions):
+        return None
+    return search.result
 
 
 def a_star_pathfinding(start, target, game_map, current_npc):
-    open_list = []
-    closed_list = []
-    start_node = Node(start[0], start[1])
-    target_node = Node(target['data'][0], target['data'][1])
+    npc_positions = occupied_cells(target, current_npc)
+    return grid_a_star(game_map.wall_bytes, game_map.width, game_map.height, start, target['data'], npc_positions)
 
-    open_list.append(start_node)
 
+class LazyPath:
+    """
+    List-like path built from waypoints, refined into cells one segment at a time as
+    the NPC consumes it. refine(a, b) returns the cells after a up to b, or None if the
+    segment can't be walked right now, in which case fallback(position) is asked for the
+    rest of the path.
+    """
+    def __init__(self, start, waypoints, refine, fallback=None):
+        self.position = start  # end of the last refined segment
+        self.waypoints = deque(waypoints)
+        self.refine = refine
+        self.fallback = fallback
+        self.steps = []
 
-    if target['type'] == 'npc':
-        npc_positions = {(npc.x, npc.y) for npc in NPC_REGISTRY if (npc.x, npc.y) != current_npc['data'] and (npc.x, npc.y) != target['data']}
-    else:
-        npc_positions = {(npc.x, npc.y) for npc in NPC_REGISTRY if (npc.x, npc.y) != current_npc['data']}
-
-    possible_target_positions = [target['data']]
-    # if target['type'] == 'npc':
-    #     possible_target_positions = [
-    #         (target_node.x + dx, target_node.y + dy) 
-    #         for dx, dy in [(0, -1), (0, 1), (-1, 0), (1, 0)]
-    #         if 0 <= target_node.x + dx < SCREEN_WIDTH // GRID_SIZE and 0 <= target_node.y + dy < SCREEN_HEIGHT // GRID_SIZE
-    #         and not game_map.is_wall(target_node.x + dx, target_node.y + dy)
-    #         and (target_node.x + dx, target_node.y + dy) not in npc_positions
-    #     ]
-    # else:
-    #     possible_target_positions = [target['data']]
-    # if not possible_target_positions:
-    #     Exception("No possible target positions")
-    
-    while len(open_list) > 0:
-        
-        current_node = sorted(open_list, key=lambda x: x.f)[0]
-        open_list.remove(current_node)
-
-        closed_list.append(current_node)
-        # print(f"Current node: {current_node.x}, {current_node.y}. Target node: {target_node.x}, {target_node.y}. Open list: {len(open_list)}. Closed list: {len(closed_list)}")
-        
-        # Found the goal
-        if any([current_node.x == x and current_node.y == y for x, y in possible_target_positions]):
-            path = []
-            current = current_node
-            while current is not None:
-                path.append((current.x, current.y))
-                current = current.parent
-            return path[::-1][1:]  # Return reversed path
-
-        children = []
-        for new_position in [(0, -1), (0, 1), (-1, 0), (1, 0)]:
-            node_position = (current_node.x + new_position[0], current_node.y + new_position[1])
-
-            # Ensure within range
-            if node_position[0] < 0 or node_position[0] >= SCREEN_WIDTH // GRID_SIZE or \
-            node_position[1] < 0 or node_position[1] >= SCREEN_HEIGHT // GRID_SIZE:
-                continue
+    def _fill(self):
+        while not self.steps and self.waypoints:
+            waypoint = self.waypoints.popleft()
+            segment = self.refine(self.position, waypoint)
+            if segment is None:
+                self.waypoints.clear()
+                segment = self.fallback(self.position) if self.fallback else None
+                if not segment:
+                    return
+                waypoint = segment[-1]
+            self.steps.extend(segment)
+            self.position = waypoint
 
-            # Ensure not a wall
-            if game_map.is_wall(node_position[0], node_position[1]) or node_position in npc_positions:
-                continue
+    def pop(self, index=0):
+        self._fill()
+        return self.steps.pop(index)
 
+    def __bool__(self):
+        self._fill()
+        return bool(self.steps)
 
-            new_node = Node(node_position[0], node_position[1])
-            new_node.parent = current_node
-            children.append(new_node)
+    def __len__(self):
+        """Refined steps left plus a Manhattan estimate for the unrefined waypoints."""
+        remaining = len(self.steps)
+        position = self.position
+        for waypoint in self.waypoints:
+            remaining += manhattan(position, waypoint)
+            position = waypoint
+        return remaining
 
-        for child in children:
-            if child in closed_list:
-                continue
+    def to_list(self):
+        """Refine everything that's left and return it as a plain list."""
+        while self.waypoints:
+            steps, self.steps = self.steps, []
+            self._fill()
+            self.steps = steps + self.steps
+        return list(self.steps)
+
+
+def grid_jps(wall_bytes, width, height, start, goal, blocked=()):
+    """
+    Jump Point Search adapted to 4-connected movement, same grid format and return value
+    as grid_a_star. Horizontal jumps stop where a vertical side opens up behind a wall
+    (a forced neighbor), vertical jumps stop wherever a horizontal jump from that cell
+    would find something. Only the jump points go on the heap.
+    """
+    if start == goal:
+        return []
+
+    def free(x, y):
+        if x < 0 or x >= width or y < 0 or y >= height:
+            return False
+        return not wall_bytes[y * width + x] and (x, y) not in blocked
 
-            child.g = current_node.g + 1
-            child.h = ((child.x - target_node.x) ** 2) + ((child.y - target_node.y) ** 2)
-            child.f = child.g + child.h
+    def jump_horizontal(x, y, dx):
+        while True:
+            x += dx
+            if not free(x, y):
+                return None
+            if (x, y) == goal:
+                return (x, y)
+            if (free(x, y - 1) and not free(x - dx, y - 1)) or (free(x, y + 1) and not free(x - dx, y + 1)):
+                return (x, y)
 
-            # Find if a node with the same coordinates as child exists in the open list
-            existing_node = next((node for node in open_list if node.x == child.x and node.y == child.y), None)
+    def jump_vertical(x, y, dy):
+        while True:
+            y += dy
+            if not free(x, y):
+                return None
+            if (x, y) == goal or jump_horizontal(x, y, 1) or jump_horizontal(x, y, -1):
+                return (x, y)
 
-            if existing_node:
-                # If the existing node's g value is higher, update its values
-                if existing_node.g > child.g:
-                    existing_node.g = child.g
-                    existing_node.h = child.h
-                    existing_node.f = child.f
-                    existing_node.parent = child.parent
+    def directions(node, parent_node):
+        x, y = node
+        if parent_node is None:
+            return NEIGHBORS
+        dx = (x > parent_node[0]) - (x < parent_node[0])
+        if dx:
+            forced = [(0, dy) for dy in (-1, 1) if free(x, y + dy) and not free(x - dx, y + dy)]
+            return [(dx, 0)] + forced
+        dy = (y > parent_node[1]) - (y < parent_node[1])
+        return [(0, dy), (1, 0), (-1, 0)]
+
+    g_score = {start: 0}
+    parent = {start: None}
+    closed = set()
+    h = manhattan(start, goal)
+    open_heap = [(h, h, start)]
+    while open_heap:
+        _, _, node = heapq.heappop(open_heap)
+        if node in closed:
+            continue
+        if node == goal:
+            jump_points = []
+            while node is not None:
+                jump_points.append(node)
+                node = parent[node]
+            jump_points.reverse()
+            path = []
+            for (x0, y0), (x1, y1) in zip(jump_points, jump_points[1:]):
+                sx, sy = (x1 > x0) - (x1 < x0), (y1 > y0) - (y1 < y0)
+                while (x0, y0) != (x1, y1):
+                    x0, y0 = x0 + sx, y0 + sy
+                    path.append((x0, y0))
+            return path
+        closed.add(node)
+
+        for dx, dy in directions(node, parent[node]):
+            if dx:
+                jump_point = jump_horizontal(node[0], node[1], dx)
             else:
-                open_list.append(child)
+                jump_point = jump_vertical(node[0], node[1], dy)
+            if jump_point is None or jump_point in closed:
+                continue
+            child_g = g_score[node] + manhattan(node, jump_point)
+            if jump_point in g_score and g_score[jump_point] <= child_g:
+                continue
+            g_score[jump_point] = child_g
+            parent[jump_point] = node
+            h = manhattan(jump_point, goal)
+            heapq.heappush(open_heap, (child_g + h, h, jump_point))
 
     return None  # No path found
+
+
+def jps_pathfinding(start, target, game_map, current_npc):
+    npc_positions = occupied_cells(target, current_npc)
+    return grid_jps(game_map.wall_bytes, game_map.width, game_map.height, start, target['data'], npc_positions)
@@ -0,0 +1,145 @@
+import json
+from constants import COLORS, PLAN_MAX_STEPS, PLAN_FAILURE_POLICY
+
+# Actions a plan step can be, with the arguments each one needs
+STEP_ARGUMENTS = {
+    'converse': ('target', 'message'),
+    'pathfind': ('target',),
+    'activity': ('message',),
+    'buy_food': (),
+    'eat': (),
+    'do_job': (),
+}
+
+
+def _find_npc(name, all_npcs):
+    return next((npc for npc in all_npcs if npc.name == name), None)
+
+
+def _step_data(step):
+    """
+    A step as action data, {'type': name, **arguments}. Steps come as function calls,
+    {'name': ..., 'arguments': {...}} (the arguments may be a JSON string), or with the
+    arguments next to the name like a batch decision.
+    """
+    if not isinstance(step, dict):
+        return None
+    name = step.get('name', step.get('type'))
+    args = step.get('arguments', {k: v for k, v in step.items() if k not in ('name', 'type')})
+    if isinstance(args, str):
+        try:
+            args = json.loads(args or '{}')
+        except ValueError:
+            return None
+    if not isinstance(args, dict):
+        return None
+    return {'type': name, **args}
+
+
+def check_step(action_data, game_map, all_npcs, npc=None):
+    """Why an action (or plan step) of npc, the one deciding, can't be queued, or None if it can."""
+    action = action_data['type']
+    if action not in STEP_ARGUMENTS:
+        return f"{action} is not an action"
+    for arg in STEP_ARGUMENTS[action]:
+        if not isinstance(action_data.get(arg), str) or not action_data[arg].strip():
+            return f"{action} needs a {arg}"
+    target = action_data.get('target')
+    if action in ('converse', 'pathfind') and npc is not None and target == npc.name:
+        return f"{target} is yourself"
+    if action == 'converse' and _find_npc(target, all_npcs) is None:
+        return f"there is no NPC called {target}"
+    if action == 'pathfind' and game_map._find_location_by_name(target.split(':')[-1]) is None \
+            and _find_npc(target, all_npcs) is None:
+        return f"there is no location or NPC called {target}"
+    return None
+
+
+def parse_plan(steps, game_map, all_npcs, max_steps=PLAN_MAX_STEPS, npc=None):
+    """
+    The action data of the steps of a queue_multiple_actions call that can be queued, and
+    why the rest were dropped (None if none were). Steps are checked in order and the plan
+    is cut at the first bad one, since later steps usually count on it (no point buying
+    food if going to the Shop was the bad step). At most max_steps are kept.
+    """
+    if not isinstance(steps, list) or not steps:
+        return [], "the plan has no steps"
+    parsed = []
+    for i, step in enumerate(steps[:max_steps]):
+        action_data = _step_data(step)
+        error = "it isn't a function call" if action_data is None else check_step(action_data, game_map, all_npcs, npc)
+        if error:
+            return parsed, f"step {i + 1}: {error}"
+        parsed.append(action_data)
+    if len(steps) > max_steps:
+        return parsed, f"plans can have at most {max_steps} steps"
+    return parsed, None
+
+
+def decision_error(action_data, game_map, all_npcs, npc=None):
+    """Why a decision can't be queued, or None if it can. A plan only needs a good first step."""
+    if action_data.get('type') == 'queue_multiple_actions':
+        steps, error = parse_plan(action_data.get('actions'), game_map, all_npcs, npc=npc)
+        return None if steps else error
+    return check_step(action_data, game_map, all_npcs, npc)
+
+
+class Plan:
+    """The steps queued from one queue_multiple_actions call, shared by their Actions."""
+    def __init__(self, steps):
+        self.steps = steps
+        self.failed = None  # type of the step that failed, if one did
+
+
+class PlanTracker:
+    """
+    Starts plans and applies the failure policy when one of their steps fails: 'abort'
+    drops the plan's remaining steps from the NPC's queue, so the next decision is made
+    with the failure in the logs, 'continue' carries on with them.
+    """
+    def __init__(self, policy=PLAN_FAILURE_POLICY):
+        self.policy = policy
+        self.plans = 0
+        self.steps = 0
+        self.cut_steps = 0  # steps parse_plan dropped
+        self.failed = 0
+        self.dropped_steps = 0  # steps not run because an earlier one failed
+
+    def start(self, steps, cut=0):
+        self.plans += 1
+        self.steps += len(steps)
+        self.cut_steps += cut
+        return Plan(steps)
+
+    def step_failed(self, npc, action):
+        plan = action.plan
+        if plan is None or plan.failed:
+            return
+        plan.failed = action.type
+        self.failed += 1
+        if self.policy == 'continue':
+            return
+        rest = [a for a in npc.action_queue if a.plan is plan and a is not action]
+        if npc.paused_action is not None and npc.paused_action.plan is plan:
+            rest.append(npc.paused_action)
+            npc.paused_action = None
+        for a in rest:
+            if a in npc.action_queue:
+                npc.action_queue.remove(a)
+        self.dropped_steps += len(rest)
+        if rest:
+            npc.add_log(f"NPC {COLORS[npc.color]} dropped the rest of its plan ({len(rest)} steps) after {action.type} failed.")
+
+    def stats(self):
+        return {
+            'plans': self.plans,
+            'steps': self.steps,
+            'steps_per_plan': self.steps / self.plans if self.plans else 0.0,
+            'cut_steps': self.cut_steps,
+            'failed': self.failed,
+            'dropped_steps': self.dropped_steps,
+        }
+
+
+# Shared by every NPC's Brain
+PLANS = PlanTracker()
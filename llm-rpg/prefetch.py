@@ -0,0 +1,161 @@
+from collections import deque
+from constants import USE_PREFETCH, PREFETCH_STEPS, PREFETCH_TOLERANCE, USE_DECISION_RULES
+from llm import decision_messages, decide
+from llm_pipeline import LLM_PIPELINE
+from llm_governor import DECISION, SPECULATIVE
+from decision_rules import DECISION_RULES
+
+# What each action does to the stats when it works
+EFFECTS = {
+    'eat': {'food': -10, 'hunger': -10},
+    'buy_food': {'currency': -10, 'food': 10},
+    'do_job': {'currency': 10},
+}
+STATS = ('hunger', 'food', 'currency', 'social')
+PREFETCH_PENDING = object()  # take() result while a prefetch that still fits is in flight
+
+
+class ProjectedNPC:
+    """
+    What an NPC should look like once its queue has run out, in ticks: at position, with
+    the stats its remaining actions leave it with and nothing queued. Stands in for the
+    NPC when the prompt is built, and remembers how many logs that prompt used up.
+    """
+    def __init__(self, npc, position, ticks, actions):
+        self.name = npc.name
+        self.color = npc.color
+        self.x, self.y = position
+        self.hunger = min(npc.hunger + ticks, 100)
+        self.social = npc.social - 0.1 * ticks
+        self.food = npc.food
+        self.currency = npc.currency
+        for action in actions:
+            for stat, change in EFFECTS.get(action.type, {}).items():
+                setattr(self, stat, getattr(self, stat) + change)
+        self.action_queue = deque()
+        self.paused_action = None
+        self.reasoning_history = npc.reasoning_history
+        self.brain = npc.brain  # for its memories
+        self.logs = list(npc.logs)
+        self.logs_taken = 0
+
+    def clear_logs(self):
+        self.logs_taken = len(self.logs)
+
+
+class Prefetch:
+    def __init__(self, projection):
+        self.projection = projection
+        self.result = None
+        self.error = None
+        self.checked = False  # the projection matched when the queue ran out
+
+    def ready(self, result):
+        self.result = result
+
+    def failed(self, error):
+        self.error = error
+
+
+class Prefetcher:
+    """
+    Asks for an NPC's next decision before its queue runs out, so it has something to do
+    the tick it does instead of idling for a round trip. Once only one-shot actions (eat,
+    buy_food, do_job, activity) are left, after at most a pathfind that's within steps of
+    arriving, the decision is requested with the context projected to when they're done.
+    When the queue runs out, take() checks the NPC against the projection: same location
+    and stats within tolerance and it's committed (or waited for, moved up to DECISION
+    priority as the NPC now idles on it), otherwise it's dropped and the decision is asked
+    for as usual. NPCs don't prefetch while enabled is False.
+    """
+    def __init__(self, steps=PREFETCH_STEPS, tolerance=PREFETCH_TOLERANCE, pipeline=LLM_PIPELINE, enabled=USE_PREFETCH):
+        self.enabled = enabled
+        self.steps = steps
+        self.tolerance = tolerance
+        self.pipeline = pipeline
+        self.prefetches = {}  # npc -> Prefetch
+        self.requested = 0
+        self.committed = 0
+        self.mismatched = 0
+        self.failed = 0
+
+    def project(self, npc):
+        """The NPC once its queue is done, or None if that's too far off or can't be told."""
+        queue = list(npc.action_queue)
+        if not queue or npc.paused_action is not None or npc.current_conversation:
+            return None
+        current, rest = queue[0], queue[1:]
+        if any(action.type in ('pathfind', 'converse') for action in rest) or current.type == 'converse':
+            return None  # conversations go on with replies, further walks aren't worth guessing
+        ticks = len(queue)
+        position = (npc.x, npc.y)
+        if current.type == 'pathfind':
+            if not npc.brain.path or npc.brain.path_pending:
+                return None
+            ticks += len(npc.brain.path) - 1
+            position = npc.brain._target_position(current)['data']
+        if ticks > self.steps:
+            return None
+        return ProjectedNPC(npc, position, ticks, queue)
+
+    def request(self, npc, game_map, all_npcs, last_actions):
+        """Prefetch the NPC's next decision if its queue is close to running out."""
+        if npc in self.prefetches:
+            return
+        projection = self.project(npc)
+        if projection is None:
+            return
+        others = [other for other in all_npcs if other is not npc]
+        if USE_DECISION_RULES and any(rule(projection, game_map, others) for rule in DECISION_RULES.rules):
+            return  # a rule will answer it on the spot
+        # all_npcs for the targets, so the tool schemas are the ones every other decision uses
+        messages = decision_messages(projection, game_map, all_npcs, last_actions, exclude=npc)
+        prefetch = Prefetch(projection)
+        self.prefetches[npc] = prefetch
+        self.requested += 1
+        self.pipeline.submit(('prefetch', npc), decide(messages, all_npcs, game_map, npc), prefetch.ready, prefetch.failed,
+                             priority=SPECULATIVE, npc=npc)
+
+    def matches(self, projection, npc, game_map):
+        if game_map.get_current_location(npc.x, npc.y) != game_map.get_current_location(projection.x, projection.y):
+            return False
+        return all(abs(getattr(npc, stat) - getattr(projection, stat)) <= self.tolerance for stat in STATS)
+
+    def take(self, npc, game_map):
+        """
+        For an NPC whose queue ran out: the prefetched (action data, reasoning history),
+        PREFETCH_PENDING if it's still on its way, or None when there's nothing usable.
+        """
+        prefetch = self.prefetches.get(npc)
+        if prefetch is None:
+            return None
+        if not prefetch.checked:
+            if not self.matches(prefetch.projection, npc, game_map):
+                del self.prefetches[npc]
+                self.mismatched += 1
+                return None
+            prefetch.checked = True
+            self.pipeline.promote(('prefetch', npc), DECISION)
+        if prefetch.error is not None:
+            del self.prefetches[npc]
+            self.failed += 1
+            return None  # asked again the usual way
+        if prefetch.result is None:
+            return PREFETCH_PENDING
+        del self.prefetches[npc]
+        self.committed += 1
+        del npc.logs[:prefetch.projection.logs_taken]  # they're in the prompt already
+        return prefetch.result
+
+    def stats(self):
+        return {
+            'requested': self.requested,
+            'committed': self.committed,
+            'mismatched': self.mismatched,
+            'failed': self.failed,
+            'hit_rate': self.committed / self.requested if self.requested else 0.0,
+        }
+
+
+# Shared by every NPC's Brain
+PREFETCHER = Prefetcher()
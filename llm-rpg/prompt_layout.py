@@ -0,0 +1,72 @@
+import json
+from history import message_tokens
+
+
+def _message_key(message):
+    return (message.type, message.content, json.dumps(message.additional_kwargs, sort_keys=True, default=str))
+
+
+class Prompt(list):
+    """The messages of one request, with the cacheable prefix and total tokens measured for it."""
+    def __init__(self, messages, prefix_tokens=0, total_tokens=0):
+        super().__init__(messages)
+        self.prefix_tokens = prefix_tokens
+        self.total_tokens = total_tokens
+
+
+class PromptAssembler:
+    """
+    Lays out every prompt the same way so its start stays byte-identical from call to call
+    and the provider's prompt cache can serve it: static instructions first, then the
+    NPC's profile, which rarely changes, then the body that changes every call (history,
+    logs, state). The API puts the tool schemas ahead of the messages, tools is a key for
+    them (decision tools leave out the deciding NPC's name). Each request's cacheable
+    prefix is measured against what was sent before: the tools and static part are shared
+    by every request with the same tools, the rest is compared with the same NPC's
+    previous request of that kind.
+    """
+    def __init__(self):
+        self.previous = {}  # (kind, owner) -> (tools, message keys) of its last request
+        self.static_seen = set()  # (kind, tools) whose static part was sent at least once
+        self.requests = 0
+        self.prefix_tokens = 0
+        self.total_tokens = 0
+        self.last_prefix_tokens = 0
+        self.last_total_tokens = 0
+
+    def assemble(self, kind, owner, static, profile, body, tool_tokens=0, tools=None):
+        """The request's messages in order, as a Prompt that carries its own prefix size."""
+        messages = list(static) + [profile] + list(body)
+        keys = [_message_key(m) for m in messages]
+        sizes = [message_tokens(m) for m in messages]
+
+        previous_tools, previous = self.previous.get((kind, owner), (None, []))
+        common = 0
+        if previous_tools == tools:
+            while common < min(len(keys), len(previous)) and keys[common] == previous[common]:
+                common += 1
+        static_seen = (kind, tools) in self.static_seen
+        if static_seen:
+            common = max(common, len(static))
+        prefix = sum(sizes[:common]) + (tool_tokens if static_seen else 0)
+
+        self.previous[(kind, owner)] = (tools, keys)
+        self.static_seen.add((kind, tools))
+        self.requests += 1
+        self.last_prefix_tokens = prefix
+        self.last_total_tokens = sum(sizes) + tool_tokens
+        self.prefix_tokens += prefix
+        self.total_tokens += self.last_total_tokens
+        return Prompt(messages, prefix, self.last_total_tokens)
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'last_prefix_tokens': self.last_prefix_tokens,
+            'last_total_tokens': self.last_total_tokens,
+            'cacheable_fraction': self.prefix_tokens / self.total_tokens if self.total_tokens else 0.0,
+        }
+
+
+# Shared by decisions and conversation replies
+PROMPT_ASSEMBLER = PromptAssembler()
@@ -0,0 +1,63 @@
+from constants import PURSUIT_REPAIR_EXPANSIONS
+from pathfinding import AStarSearch
+
+
+def _drop_loops(cells):
+    """Cut out every stretch of cells that comes back to a cell visited before it."""
+    path = []
+    seen = {}
+    for cell in cells:
+        if cell in seen:
+            for dropped in path[seen[cell] + 1:]:
+                del seen[dropped]
+            del path[seen[cell] + 1:]
+            continue
+        seen[cell] = len(path)
+        path.append(cell)
+    return path
+
+
+class Pursuit:
+    """
+    Keeps paths to moving NPC targets up to date without searching from scratch. When the
+    target changes cell the path is cut where it crosses the new cell, or else extended
+    from its end with a search capped at max_expansions and any loop the extension makes
+    back over the path is cut out. Only when that search gives up does the caller need a
+    full search again.
+    """
+    def __init__(self, max_expansions=PURSUIT_REPAIR_EXPANSIONS):
+        self.max_expansions = max_expansions
+        self.trims = 0
+        self.extensions = 0
+        self.full_searches = 0
+        self.expansions = 0  # spent on extensions
+
+    def retarget(self, path, start, goal, game_map, blocked):
+        """
+        The path from start moved to end at goal, or None if that would cost more than
+        max_expansions.
+        """
+        cells = [start] + list(path)
+        if goal in cells:
+            self.trims += 1
+            return cells[1:cells.index(goal) + 1]
+        search = AStarSearch(game_map.wall_bytes, game_map.width, game_map.height, cells[-1], goal, blocked)
+        finished = search.step(self.max_expansions)
+        self.expansions += search.expansions
+        if not finished or search.result is None:
+            self.full_searches += 1
+            return None
+        self.extensions += 1
+        return _drop_loops(cells + search.result)[1:]
+
+    def stats(self):
+        return {
+            'trims': self.trims,
+            'extensions': self.extensions,
+            'full_searches': self.full_searches,
+            'expansions': self.expansions,
+        }
+
+
+# Shared by every NPC's Brain
+PURSUIT = Pursuit()
@@ -0,0 +1,102 @@
+from constants import SPATIAL_BUCKET_SIZE
+
+
+class SpatialHash:
+    """
+    Grid-bucketed index of where NPCs stand, kept up to date as their x/y change.
+    Cell lookups are a dict hit, range queries only visit the buckets that overlap the range.
+    """
+    def __init__(self, bucket_size=SPATIAL_BUCKET_SIZE):
+        self.bucket_size = bucket_size
+        self.cells = {}  # (x, y) -> set of NPCs standing there
+        self.buckets = {}  # (x // bucket_size, y // bucket_size) -> set of NPCs
+        self.positions = {}  # NPC -> (x, y)
+
+    def _bucket(self, cell):
+        return (cell[0] // self.bucket_size, cell[1] // self.bucket_size)
+
+    def insert(self, npc, cell):
+        self.positions[npc] = cell
+        self.cells.setdefault(cell, set()).add(npc)
+        self.buckets.setdefault(self._bucket(cell), set()).add(npc)
+
+    def remove(self, npc):
+        cell = self.positions.pop(npc, None)
+        if cell is None:
+            return
+        for table, key in ((self.cells, cell), (self.buckets, self._bucket(cell))):
+            members = table[key]
+            members.discard(npc)
+            if not members:
+                del table[key]
+
+    def move(self, npc, cell):
+        if self.positions.get(npc) != cell:
+            self.remove(npc)
+            self.insert(npc, cell)
+
+    def is_occupied(self, cell, exclude=None):
+        """Is anyone other than exclude standing on cell."""
+        members = self.cells.get(cell)
+        if not members:
+            return False
+        return len(members) > 1 or exclude not in members
+
+    def in_rect(self, top_left, bottom_right):
+        """NPCs inside an inclusive rectangle of cells."""
+        (x0, y0), (x1, y1) = top_left, bottom_right
+        bx0, by0 = self._bucket((x0, y0))
+        bx1, by1 = self._bucket((x1, y1))
+        found = []
+        for bx in range(bx0, bx1 + 1):
+            for by in range(by0, by1 + 1):
+                for npc in self.buckets.get((bx, by), ()):
+                    x, y = self.positions[npc]
+                    if x0 <= x <= x1 and y0 <= y <= y1:
+                        found.append(npc)
+        return found
+
+    def within(self, cell, radius, exclude=None):
+        """NPCs within a Manhattan distance of cell, nearest first."""
+        x, y = cell
+        found = []
+        for npc in self.in_rect((x - radius, y - radius), (x + radius, y + radius)):
+            px, py = self.positions[npc]
+            distance = abs(px - x) + abs(py - y)
+            if npc is not exclude and distance <= radius:
+                found.append((distance, npc))
+        found.sort(key=lambda item: item[0])
+        return [npc for _, npc in found]
+
+    def nearest(self, cell, k, exclude=None):
+        """Up to k NPCs closest to cell, growing the search radius until enough are found."""
+        others = len(self.positions) - (exclude in self.positions)
+        radius = self.bucket_size
+        while True:
+            found = self.within(cell, radius, exclude)
+            if len(found) >= min(k, others):
+                return found[:k]
+            radius *= 2
+
+    def view(self, exclude_cells=()):
+        """Live set-like view of occupied cells, leaving out exclude_cells."""
+        return OccupancyView(self, exclude_cells)
+
+
+class OccupancyView:
+    """Answers `cell in view` from the index without copying every NPC position into a set."""
+    def __init__(self, index, exclude_cells=()):
+        self.index = index
+        self.exclude_cells = set(exclude_cells)
+
+    def __contains__(self, cell):
+        return cell in self.index.cells and cell not in self.exclude_cells
+
+    def __iter__(self):
+        return (cell for cell in self.index.cells if cell not in self.exclude_cells)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __bool__(self):
+        return any(True for _ in self)
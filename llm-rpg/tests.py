@@ -17,3 +17,930 @@ def test_game_map_collisions():
     # Inside the main area should not be a wall
     assert not game_map.is_wall(4, 4)  
     assert not game_map.is_wall(5, 5)
+
+
+def test_game_map_out_of_bounds_is_wall():
+    game_map = GameMap(IMAGE_PATH)
+    assert (game_map.width, game_map.height) == (SCREEN_WIDTH // GRID_SIZE, SCREEN_HEIGHT // GRID_SIZE)
+    assert game_map.is_wall(-1, 5)
+    assert game_map.is_wall(game_map.width, 5)
+    assert game_map.is_wall(5, game_map.height)
+    # The village spans one cell past the grid, random points must still land on it
+    for _ in range(50):
+        x, y = game_map.village.get_random_point(game_map)
+        assert not game_map.is_wall(x, y)
+
+
+def test_game_map_are_walls_matches_is_wall():
+    game_map = GameMap(IMAGE_PATH)
+    xs = [0, 1, 11, 12, 13, 4, 5, -1, 80]
+    ys = [0, 0, 19, 19, 19, 4, 5, 0, 0]
+    assert game_map.are_walls(xs, ys).tolist() == [game_map.is_wall(x, y) for x, y in zip(xs, ys)]
+
+
+def test_game_map_collision_image():
+    game_map = GameMap(IMAGE_PATH, init_locations=False, collision_path='llm-rpg/images/maps/LLM-RPG-collision.png')
+    assert (game_map.width, game_map.height) == (240, 160)
+    assert game_map.is_wall(0, 0)
+    assert not game_map.is_wall(10, 0)
+
+
+def test_a_star_finds_shortest_path():
+    from pathfinding import a_star_pathfinding
+    game_map = GameMap(IMAGE_PATH)
+    start, goal = (4, 4), (70, 55)  # Red's House to the Workplace
+    path = a_star_pathfinding(start, {'type': 'coords', 'data': goal}, game_map, {'type': 'npc', 'data': start})
+    assert path[-1] == goal
+    assert len(path) == 117  # out through both 3-cell doors
+    for (x0, y0), (x1, y1) in zip([start] + path, path):
+        assert abs(x0 - x1) + abs(y0 - y1) == 1
+        assert not game_map.is_wall(x1, y1)
+    assert a_star_pathfinding(start, {'type': 'coords', 'data': start}, game_map, {'type': 'npc', 'data': start}) == []
+    assert a_star_pathfinding(start, {'type': 'coords', 'data': (0, 0)}, game_map, {'type': 'npc', 'data': start}) is None
+
+
+def test_hierarchical_pathfinding_walks_through_doors():
+    from hierarchy import get_door_graph, hierarchical_pathfinding
+    game_map = GameMap(IMAGE_PATH)
+    graph = get_door_graph(game_map)
+    assert (13, 19) in graph.nodes and (13, 20) in graph.nodes  # Red's House door
+    start, goal = (23, 2), (70, 55)  # Red's Bedroom to the Workplace
+    path = hierarchical_pathfinding(start, {'type': 'coords', 'data': goal}, game_map, {'type': 'npc', 'data': start})
+    steps = []
+    while path:
+        steps.append(path.pop(0))
+    assert steps[-1] == goal
+    assert (13, 19) in steps
+    for (x0, y0), (x1, y1) in zip([start] + steps, steps):
+        assert abs(x0 - x1) + abs(y0 - y1) == 1
+        assert not game_map.is_wall(x1, y1)
+
+
+def test_path_cache_reuses_routes_to_random_points_and_repairs_around_npcs():
+    from path_cache import PathCache
+    from globals import NPC_INDEX
+
+    game_map = GameMap(IMAGE_PATH)
+    cache = PathCache()
+
+    def walk(start, goal):
+        path = cache.find_path(start, {'type': 'coords', 'data': goal}, game_map, {'type': 'npc', 'data': start})
+        steps = []
+        while path:
+            steps.append(path.pop(0))
+        assert steps[-1] == goal
+        for (x0, y0), (x1, y1) in zip([start] + steps, steps):
+            assert abs(x0 - x1) + abs(y0 - y1) == 1 and not game_map.is_wall(x1, y1)
+        return steps
+
+    first = walk((4, 4), game_map.shop.get_random_point(game_map))
+    assert (cache.hits, cache.misses) == (0, 1)
+    # Another trip from Red's House to the Shop, another start and random point
+    walk((6, 5), game_map.shop.get_random_point(game_map))
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    outside = first[first.index((13, 20)) + 5]  # between Red's House door and the Shop's
+    standing = object()
+    NPC_INDEX.insert(standing, outside)
+    try:
+        repaired = walk((4, 4), game_map.shop.get_random_point(game_map))
+    finally:
+        NPC_INDEX.remove(standing)
+    assert cache.hits == 2 and cache.repairs == 1 and outside not in repaired
+
+    game_map.set_wall(*first[5])
+    walk((4, 4), game_map.shop.get_random_point(game_map))
+    assert cache.misses == 2  # new map version
+
+
+def test_flow_field_leads_into_location():
+    from flow_field import get_flow_field
+    game_map = GameMap(IMAGE_PATH)
+    field = get_flow_field(game_map, game_map.shop)
+    assert get_flow_field(game_map, game_map.shop) is field
+    position, steps = (70, 5), 0
+    while field.distance(*position) > 0:
+        position = field.next_step(*position)
+        steps += 1
+    assert game_map.shop.contains_point(*position)
+    assert steps == field.distance(70, 5)
+    assert field.distance(0, 0) == -1  # wall
+
+
+def test_jps_matches_a_star_path_length():
+    from pathfinding import grid_a_star, grid_jps
+    game_map = GameMap(IMAGE_PATH)
+    blocked = {(40, 30), (41, 30), (13, 19)}
+    for start, goal in [((4, 4), (70, 55)), ((30, 25), (50, 35)), ((23, 2), (5, 45))]:
+        a_star = grid_a_star(game_map.wall_bytes, game_map.width, game_map.height, start, goal, blocked)
+        jps = grid_jps(game_map.wall_bytes, game_map.width, game_map.height, start, goal, blocked)
+        assert len(jps) == len(a_star) and jps[-1] == goal
+        for (x0, y0), (x1, y1) in zip([start] + jps, jps):
+            assert abs(x0 - x1) + abs(y0 - y1) == 1
+            assert not game_map.is_wall(x1, y1) and (x1, y1) not in blocked
+
+
+def test_d_star_lite_replans_around_new_blockers():
+    from incremental import DStarLite
+    from pathfinding import grid_a_star
+    game_map = GameMap(IMAGE_PATH)
+    start, goal = (4, 4), (70, 55)
+    planner = DStarLite(game_map, start, goal)
+    path = planner.path()
+    assert len(path) == 117
+    first_search = planner.expansions
+
+    blocked = {(12, 19), (13, 19)}  # two NPCs in Red's door
+    planner.move_start(path[5])
+    planner.update_blocked(blocked)
+    repaired = planner.path()
+    assert len(repaired) == len(grid_a_star(game_map.wall_bytes, game_map.width, game_map.height, path[5], goal, blocked))
+    assert not blocked & set(repaired)
+    assert planner.expansions - first_search < first_search
+
+
+def test_cooperative_planner_keeps_npcs_apart_in_a_doorway():
+    from cooperative import CooperativePlanner
+    from globals import NPC_REGISTRY
+    from npc import NPC
+    game_map = GameMap(IMAGE_PATH)
+    planner = CooperativePlanner(window=8)
+    inside = [NPC(11 + i, 17, (255, 0, 0)) for i in range(3)]
+    outside = [NPC(11 + i, 21, (0, 0, 255)) for i in range(3)]
+    try:
+        for i, npc in enumerate(inside):
+            npc.queue_action('pathfind', (11 + i, 24))
+            planner.request(npc)
+        for i, npc in enumerate(outside):
+            npc.queue_action('pathfind', (11 + i, 14))
+            planner.request(npc)
+        for _ in range(40):
+            planner.begin_tick(game_map)
+            for npc in inside + outside:
+                if npc.brain.path:
+                    next_step = npc.brain.path.pop(0)
+                    assert next_step not in [(other.x, other.y) for other in NPC_REGISTRY if other is not npc]
+                    npc.x, npc.y = next_step
+                    if not npc.brain.path:
+                        npc.action_queue.popleft()
+        assert [(npc.x, npc.y) for npc in inside] == [(11, 24), (12, 24), (13, 24)]
+        assert [(npc.x, npc.y) for npc in outside] == [(11, 14), (12, 14), (13, 14)]
+    finally:
+        for npc in inside + outside:
+            npc.despawn()
+
+
+def test_path_scheduler_resumes_searches_across_frames():
+    from path_scheduler import PathScheduler
+    from npc import NPC
+    game_map = GameMap(IMAGE_PATH)
+    scheduler = PathScheduler(budget_ms=1000, slice_size=10)
+    npc = NPC(4, 4, (255, 0, 0))
+    try:
+        npc.queue_action('pathfind', (70, 55))
+        npc.brain.path_pending = True
+        scheduler.submit(npc, npc.action_queue[0], (4, 4), {'type': 'coords', 'data': (70, 55)}, game_map)
+        scheduler.budget = 0.0  # not even one slice fits
+        scheduler.process()
+        assert scheduler.is_pending(npc)
+        scheduler.budget = 1.0
+        scheduler.process()
+        assert not scheduler.is_pending(npc) and not npc.brain.path_pending
+        assert len(npc.brain.path) == 117
+    finally:
+        npc.despawn()
+
+
+def test_brain_uses_path_scheduler_and_prefetch_together():
+    import brain
+    from path_scheduler import PathScheduler, WAITING, REFRESH
+    from prefetch import Prefetch, ProjectedNPC, PREFETCH_PENDING
+    from npc import NPC
+    game_map = GameMap(IMAGE_PATH)
+    scheduler = PathScheduler(budget_ms=1000)
+    walker, refresher = NPC(4, 4, (255, 0, 0)), NPC(6, 4, (0, 0, 255))
+    use_scheduler, shared_scheduler = brain.USE_PATH_SCHEDULER, brain.PATH_SCHEDULER
+    try:
+        brain.USE_PATH_SCHEDULER, brain.PATH_SCHEDULER = True, scheduler
+        walker.queue_action('pathfind', (70, 55))
+        walker.brain.determine_path((4, 4), game_map)
+        refresher.queue_action('pathfind', (70, 50))
+        refresher.brain.path = [(6, 4), (7, 4)]
+        refresher.brain.determine_path((6, 4), game_map)
+        assert sorted(entry[0] for entry in scheduler.queue) == [WAITING, REFRESH]
+        scheduler.process()
+        assert walker.brain.path and not walker.brain.path_pending
+
+        refresher.action_queue.clear()
+        prefetch = Prefetch(ProjectedNPC(refresher, (6, 4), 0, []))  # still in flight
+        prefetch.checked = True
+        brain.PREFETCHER.prefetches[refresher] = prefetch
+        assert brain.PREFETCHER.enabled and brain.PREFETCHER.take(refresher, game_map) is PREFETCH_PENDING
+        refresher.brain.decide_action(game_map, [walker, refresher])
+        assert not brain.LLM_PIPELINE.is_pending(refresher)  # waits for the prefetch instead of asking again
+    finally:
+        brain.USE_PATH_SCHEDULER, brain.PATH_SCHEDULER = use_scheduler, shared_scheduler
+        brain.PREFETCHER.prefetches.pop(refresher, None)
+        walker.despawn()
+        refresher.despawn()
+
+
+def test_path_worker_pool_solves_against_shared_grid():
+    from path_workers import PathWorkerPool
+    from npc import NPC
+    from concurrent.futures import Future
+    from concurrent.futures.process import BrokenProcessPool
+    import time
+    game_map = GameMap(IMAGE_PATH)
+    pool = PathWorkerPool(workers=2, batch_size=1)
+    npcs = [NPC(4, 4, (255, 0, 0)), NPC(70, 55, (0, 0, 255))]
+    try:
+        npcs[0].queue_action('pathfind', (70, 54))
+        npcs[1].queue_action('pathfind', (5, 4))
+        for npc in npcs:
+            npc.brain.path_pending = True
+            pool.submit(npc, npc.action_queue[0], (npc.x, npc.y), {'type': 'coords', 'data': npc.action_queue[0].target}, game_map)
+        pool.flush()
+        deadline = time.time() + 60
+        while pool.in_flight and time.time() < deadline:
+            pool.collect()
+            time.sleep(0.01)
+        assert [len(npc.brain.path) for npc in npcs] == [116, 116]
+        assert not any(npc.brain.path_pending for npc in npcs)
+
+        # New walls go to a new grid, the old one is freed once nothing reads it
+        first_grid = pool.shm.name
+        game_map.set_wall(40, 40)
+        pool.submit(npcs[0], npcs[0].action_queue[0], (4, 4), {'type': 'coords', 'data': (70, 54)}, game_map)
+        assert pool.shm.name != first_grid and [shm.name for shm in pool.retired] == [first_grid]
+
+        # A batch lost with the pool is searched in-process instead
+        broken = Future()
+        broken.set_exception(BrokenProcessPool())
+        pool.in_flight = [(broken, pool.shm, pool.pending)]
+        pool.pending = []
+        npcs[0].brain.path_pending = True
+        pool.collect()
+        assert len(npcs[0].brain.path) == 116 and not npcs[0].brain.path_pending
+        assert pool.failed_batches == 1 and pool.executor is None and pool.retired == []
+    finally:
+        pool.close()
+        for npc in npcs:
+            npc.despawn()
+
+
+def test_spatial_hash_tracks_npc_moves():
+    from globals import NPC_INDEX
+    from npc import NPC
+    npcs = [NPC(10, 10, (255, 0, 0)), NPC(12, 10, (0, 255, 0)), NPC(40, 40, (0, 0, 255))]
+    try:
+        assert NPC_INDEX.is_occupied((12, 10)) and not NPC_INDEX.is_occupied((10, 10), exclude=npcs[0])
+        npcs[1].x, npcs[1].y = 17, 3  # crosses into another bucket
+        assert not NPC_INDEX.is_occupied((12, 10)) and (17, 3) in NPC_INDEX.view()
+        assert NPC_INDEX.within((10, 10), 5, exclude=npcs[0]) == []
+        assert NPC_INDEX.nearest((10, 10), 2, exclude=npcs[0]) == [npcs[1], npcs[2]]
+        assert NPC_INDEX.in_rect((0, 0), (20, 20)) and npcs[2] not in NPC_INDEX.in_rect((0, 0), (20, 20))
+    finally:
+        for npc in npcs:
+            npc.despawn()
+    assert not NPC_INDEX.positions
+
+
+def test_pursuit_follows_moving_target_cheaply():
+    from pursuit import Pursuit
+    from pathfinding import grid_a_star
+    from npc import NPC
+    game_map = GameMap(IMAGE_PATH)
+    pursuit = Pursuit(max_expansions=64)
+    chaser, target = NPC(4, 4, (255, 0, 0)), NPC(70, 55, (0, 0, 255))
+    try:
+        chaser.queue_action('pathfind', target)
+        chaser.brain.determine_path((chaser.x, chaser.y), game_map)
+        path = chaser.brain.path
+        for step in [(70, 54), (69, 54), (68, 54), (68, 55)]:
+            target.x, target.y = step
+            path = pursuit.retarget(path, (4, 4), step, game_map, set())
+            assert path[-1] == step and len(set(path)) == len(path)
+            for (x0, y0), (x1, y1) in zip([(4, 4)] + path, path):
+                assert abs(x0 - x1) + abs(y0 - y1) == 1 and not game_map.is_wall(x1, y1)
+        full = grid_a_star(game_map.wall_bytes, game_map.width, game_map.height, (4, 4), (68, 55))
+        assert len(path) <= len(full) + 4  # can be a few steps off the shortest, never a full search
+        assert pursuit.full_searches == 0 and pursuit.expansions < 20
+
+        trims = pursuit.trims
+        path = pursuit.retarget(path, (4, 4), path[50], game_map, set())  # walked back towards the chaser
+        assert len(path) == 51 and pursuit.trims == trims + 1
+        assert pursuit.retarget(path, (4, 4), (5, 45), game_map, set()) is None  # too far for the budget
+    finally:
+        chaser.despawn()
+        target.despawn()
+
+
+def test_llm_pipeline_runs_requests_concurrently_and_applies_on_collect():
+    import asyncio
+    import threading
+    import time
+    from llm_pipeline import LLMPipeline
+    pipeline = LLMPipeline()
+    applied, failed = [], []
+
+    async def answer(value):
+        await asyncio.sleep(0.2)
+        if value is None:
+            raise ValueError('no answer')
+        return value
+
+    try:
+        started = time.time()
+        for owner in range(5):
+            pipeline.submit(owner, answer(owner), lambda result: applied.append((result, threading.current_thread())))
+        pipeline.submit('broken', answer(None), applied.append, failed.append)
+        assert pipeline.in_flight() == 6 and not applied  # nothing is applied outside collect()
+        while pipeline.in_flight() and time.time() - started < 5:
+            pipeline.collect()
+            time.sleep(0.01)
+        assert time.time() - started < 0.6  # ran side by side, not one after the other
+        assert sorted(result for result, _ in applied) == [0, 1, 2, 3, 4]
+        assert all(thread is threading.current_thread() for _, thread in applied)
+        assert isinstance(failed[0], ValueError) and (pipeline.completed, pipeline.failed) == (5, 1)
+
+        # A pending request isn't replaced, a reply has its own key next to the NPC's decision
+        assert pipeline.submit('npc', answer('decision'), applied.append)
+        assert not pipeline.submit('npc', answer('another'), applied.append) and pipeline.refused == 1
+        assert pipeline.submit(('reply', 'other', 'npc'), answer('reply'), applied.append)
+        while pipeline.in_flight() and time.time() - started < 5:
+            pipeline.collect()
+            time.sleep(0.01)
+        assert {'decision', 'reply'} <= set(applied) and 'another' not in applied
+    finally:
+        pipeline.close()
+
+
+def test_async_reply_is_heard_once_by_the_speaker():
+    import npc as npc_module
+    from npc import NPC
+
+    class Pipeline:
+        def submit(self, owner, coroutine, apply, fail=None, priority=None, npc=None):
+            coroutine.close()
+            self.apply = apply
+            return True
+
+    game_map = GameMap(IMAGE_PATH)
+    red, blue = NPC(5, 5, (255, 0, 0)), NPC(6, 5, (0, 0, 255))
+    shared_pipeline, use_async = npc_module.LLM_PIPELINE, npc_module.USE_ASYNC_LLM
+    try:
+        npc_module.LLM_PIPELINE, npc_module.USE_ASYNC_LLM = Pipeline(), True
+        red.queue_action('converse', target=blue, message='Hello!')
+        red.move(game_map)
+        assert red.current_conversation == ["RED: Hello!"] and red in blue.owes_replies  # still going
+        npc_module.LLM_PIPELINE.apply(("Hi, RED.", False))
+        assert not blue.owes_replies and blue.action_queue[0].message == "Hi, RED."
+        blue.move(game_map)  # says the reply to RED
+        assert red.current_conversation.count("BLUE: Hi, RED.") == 1
+    finally:
+        npc_module.LLM_PIPELINE, npc_module.USE_ASYNC_LLM = shared_pipeline, use_async
+        red.despawn()
+        blue.despawn()
+
+
+def test_decision_batcher_splits_one_answer_per_npc():
+    import asyncio
+    import time
+    from decision_batch import DecisionBatcher
+    from llm_pipeline import LLMPipeline
+    from npc import NPC
+    game_map = GameMap(IMAGE_PATH)
+    pipeline = LLMPipeline()
+    npcs = [NPC(4, 4, (255, 0, 0)), NPC(6, 4, (255, 0, 0)), NPC(8, 4, (0, 0, 255)), NPC(10, 4, (0, 0, 255))]
+    batched = []
+
+    async def decide_batch(contexts):
+        batched.append(sorted(contexts))
+        # two REDs told apart by batch id, the second BLUE gets a decision that doesn't check out
+        return {'1': {'type': 'activity', 'message': 'reads'}, '2': {'type': 'do_job'},
+                '4': {'type': 'converse', 'target': 'NOBODY', 'message': 'hi'}}
+
+    async def decide(messages, all_npcs, game_map, npc=None):
+        return {'type': 'activity', 'message': 'asked alone'}, messages
+
+    batcher = DecisionBatcher(window_ms=1000, max_size=8, mode='combined', pipeline=pipeline,
+                              decide=decide, decide_batch=decide_batch)
+    try:
+        for npc in npcs:
+            batcher.add(npc, game_map, npcs)
+        batcher.flush()
+        assert not batched and all(batcher.is_pending(npc) for npc in npcs)  # window still open
+        batcher.flush(force=True)
+        deadline = time.time() + 5
+        while pipeline.in_flight() and time.time() < deadline:
+            pipeline.collect()
+            time.sleep(0.01)
+        assert batched == [['1', '2', '3', '4']] and batcher.batches == 1
+        assert [npc.action_queue[0].type for npc in npcs] == ['activity', 'do_job', 'activity', 'activity']
+        assert [npc.action_queue[0].message for npc in npcs[2:]] == ['asked alone'] * 2 and batcher.fallbacks == 2
+        assert npcs[0].reasoning_history[-1].additional_kwargs['function_call']['name'] == 'activity'
+        assert not any(batcher.is_pending(npc) for npc in npcs)
+
+        class FailingPipeline:
+            def submit(self, owner, coroutine, apply, fail=None, priority=None, npc=None):
+                asyncio.run(coroutine)  # the answers get lost on the way back
+                fail(RuntimeError("provider down"))
+
+        parallel = DecisionBatcher(window_ms=0, mode='parallel', pipeline=FailingPipeline(), decide=decide)
+        for npc in npcs[:2]:
+            parallel.add(npc, game_map, npcs)
+        parallel.flush()
+        assert parallel.stats()['failed'] == 2 and not any(parallel.is_pending(npc) for npc in npcs)
+        assert all("couldn't decide what to do (provider down)" in npc.logs[-1] for npc in npcs[:2])
+    finally:
+        pipeline.close()
+        for npc in npcs:
+            npc.despawn()
+
+
+def test_llm_cache_persists_and_matches_near_identical_contexts(tmp_path):
+    import asyncio
+    from langchain.schema import AIMessage, SystemMessage
+    from llm_cache import ResponseCache, cache_key
+    import llm
+
+    class FakeChat:
+        model_name = 'fake'
+        calls = 0
+
+        async def apredict_messages(self, messages, **kwargs):
+            FakeChat.calls += 1
+            return AIMessage(content='', additional_kwargs={'function_call': {'name': 'eat', 'arguments': '{}'}})
+
+    path = str(tmp_path / 'responses.sqlite')
+    functions = [{'name': 'eat'}]
+    first = [SystemMessage(content="NPC name: RED\n    Hunger: 41\n    Social: 87.3")]
+    near = [SystemMessage(content="NPC name: RED\n    Hunger: 44\n    Social: 82.9")]
+    other = [SystemMessage(content="NPC name: RED\n    Hunger: 51\n    Social: 87.3")]
+    assert cache_key(first, functions) == cache_key(near, functions) != cache_key(other, functions)
+    assert cache_key(first, functions) != cache_key(first, [{'name': 'buy_food'}])
+
+    original = llm.LLM_CACHE
+    llm.LLM_CACHE = ResponseCache(max_size=4, path=path, ttl=None)
+    try:
+        for messages in (first, near, first):
+            answer = asyncio.run(llm.predict(FakeChat(), messages, functions=functions))
+            assert answer.additional_kwargs['function_call']['name'] == 'eat'
+        assert FakeChat.calls == 1 and llm.LLM_CACHE.memory_hits == 2
+        llm.LLM_CACHE.close()
+    finally:
+        llm.LLM_CACHE = original
+
+    reopened = ResponseCache(max_size=4, path=path, ttl=None)  # next run
+    key = cache_key(first, functions, model='fake')
+    assert asyncio.run(reopened.aget(key))['additional_kwargs']['function_call']['name'] == 'eat'  # read off the loop
+    assert reopened.disk_hits == 1
+    reopened.close()
+    expired = ResponseCache(max_size=4, path=path, ttl=-1)
+    assert expired.get(key) is None and expired.misses == 1
+    expired.close()
+
+
+def test_standin_backend_answers_with_valid_function_calls():
+    import asyncio
+    import json
+    import openai
+    from langchain.schema import SystemMessage
+    from llm import get_context, decision_functions, batch_function
+    from llm_backends import StandInServer, StandInBackend
+    from npc import NPC
+    game_map = GameMap(IMAGE_PATH)
+    npcs = [NPC(4, 4, (255, 0, 0)), NPC(6, 4, (0, 255, 0))]
+    try:
+        contexts = {npc.name: get_context(npc, game_map, npcs, []) for npc in npcs}
+        messages = [SystemMessage(content=contexts['RED'])]
+        functions = decision_functions()
+        answers = []
+        for _ in range(2):
+            backend = StandInBackend(server=StandInServer(latency_ms=1, error_rate=0, seed=3))
+            answers.append(asyncio.run(backend.apredict_messages(messages, functions=functions)))
+        assert answers[0] == answers[1]  # same prompt and seed, same answer
+        call = answers[0].additional_kwargs['function_call']
+        args = json.loads(call['arguments'])
+        assert call['name'] in {f['name'] for f in functions}
+        if 'target' in args:
+            assert args['target'] in ['GREEN'] + [l.full_name() for l in game_map.get_available_locations(4, 4)]
+
+        server = StandInServer(latency_ms=1, error_rate=0)
+        batch = [SystemMessage(content=f"NPC id: {i}\n{context}") for i, context in enumerate(contexts.values(), 1)]
+        answer = asyncio.run(server.complete(batch, functions=[batch_function(('1', '2'))], function_call={'name': 'decide_for_npcs'}))
+        decisions = json.loads(answer.additional_kwargs['function_call']['arguments'])['decisions']
+        assert sorted(d['npc'] for d in decisions) == ['1', '2']
+        assert server.calls == 1 and server.prompt_tokens > 0 and server.completion_tokens_used > 0
+
+        failing = StandInServer(latency_ms=1, error_rate=1)
+        try:
+            asyncio.run(failing.complete(messages, functions=functions))
+            assert False, 'expected an error'
+        except (openai.error.RateLimitError, openai.error.ServiceUnavailableError):
+            assert failing.errors == 1
+    finally:
+        for npc in npcs:
+            npc.despawn()
+
+
+def test_llm_clients_and_tool_schemas_are_built_once():
+    import llm
+    from llm_backends import LLMBackend, get_backend, use_backend, close_backends
+    from constants import LLM_BACKEND
+    from llm_pipeline import LLMPipeline
+    assert llm.decision_functions() is llm.decision_functions()
+    assert llm.batch_function(('RED', 'BLUE')) is llm.batch_function(('RED', 'BLUE'))
+    client = get_backend('standin', 'test-model')
+    assert get_backend('standin', 'test-model') is client
+    with pytest.raises(TypeError):
+        LLMBackend()  # apredict_messages is abstract
+    try:
+        use_backend('standin')
+        assert get_backend(model='test-model') is client
+        with pytest.raises(ValueError):
+            use_backend('nowhere')
+    finally:
+        use_backend(LLM_BACKEND)
+    pipeline = LLMPipeline()
+    try:
+        pipeline.run(close_backends())
+    finally:
+        pipeline.close()
+    assert get_backend('standin', 'test-model') is not client
+
+
+def test_reasoning_history_stays_in_token_budget():
+    import json
+    from langchain.schema import AIMessage
+    from constants import LLM_PROMPT_BUDGET
+    from history import prompt_tokens, SUMMARY_HEADER
+    from llm import decision_messages, decision_functions
+    from npc import NPC
+    game_map = GameMap(IMAGE_PATH)
+    npc = NPC(4, 4, (255, 0, 0))
+    try:
+        sizes = []
+        for turn in range(30):
+            for i in range(turn * 3):  # logs pile up faster and faster between decisions
+                npc.add_log(f"NPC RED performed the activity: reads chapter {turn}-{i} of a very long book.")
+            messages = decision_messages(npc, game_map, [npc], [])
+            sizes.append(prompt_tokens(messages, decision_functions()))
+            call = {'name': 'activity', 'arguments': json.dumps({'message': f'reads chapter {turn}'})}
+            npc.reasoning_history = messages + [AIMessage(content="Reading.", additional_kwargs={'function_call': call})]
+        assert max(sizes) <= LLM_PROMPT_BUDGET
+        summary = next(m.content for m in messages if m.content.startswith(SUMMARY_HEADER))
+        assert 'chose activity' in summary
+        assert any(m.additional_kwargs.get('function_call', {}).get('arguments', '').find('chapter 28') > 0 for m in messages)
+        assert not npc.logs
+    finally:
+        npc.despawn()
+
+
+def test_prompt_layout_keeps_a_stable_prefix():
+    from history import message_tokens
+    from llm import decision_messages, conversation_messages, decision_functions_tokens
+    from prompt_layout import PromptAssembler
+    import llm
+    from npc import NPC
+    game_map = GameMap(IMAGE_PATH)
+    original = llm.PROMPT_ASSEMBLER
+    llm.PROMPT_ASSEMBLER = assembler = PromptAssembler()
+    red, blue, other_red = NPC(4, 4, (255, 0, 0)), NPC(6, 4, (0, 0, 255)), NPC(8, 4, (255, 0, 0))
+    npcs = [red, blue, other_red]
+    try:
+        red.queue_action('pathfind', (40, 30), location=game_map.shop)  # tuple targets used to break the context
+        first = decision_messages(red, game_map, npcs, [])
+        assert assembler.last_prefix_tokens == 0  # nothing sent before
+        decision_messages(blue, game_map, npcs, [])
+        assert assembler.last_prefix_tokens == 0  # BLUE's tools leave out BLUE, not RED
+        other = decision_messages(other_red, game_map, npcs, [])
+        assert other[0] is first[0] and other[1].content == first[1].content  # same static part, tools and profile
+        assert assembler.last_prefix_tokens == sum(message_tokens(m) for m in first[:2]) + decision_functions_tokens(*llm.decision_targets(game_map, npcs, red))
+        assert other.prefix_tokens == assembler.last_prefix_tokens and 0 < other.prefix_tokens < other.total_tokens
+        assert 'target: Village:Shop' in first[-1].content
+
+        red.current_conversation = ["BLUE: Hello!"]
+        conversation_messages(red, game_map, [red, blue], [])
+        red.current_conversation += ["RED: Hi Blue.", "BLUE: Nice weather."]
+        red.hunger += 7  # the state changes, everything before it stays the same
+        messages = conversation_messages(red, game_map, [red, blue], [])
+        assert [m.type for m in messages] == ['system', 'system', 'system', 'human', 'ai', 'human', 'system']
+        assert assembler.last_prefix_tokens == sum(message_tokens(m) for m in messages[:4])
+        assert first.prefix_tokens == 0 and other.prefix_tokens > 0  # each request keeps its own, later ones don't overwrite it
+        assert 0 < assembler.stats()['cacheable_fraction'] < 1
+    finally:
+        llm.PROMPT_ASSEMBLER = original
+        for npc in npcs:
+            npc.despawn()
+
+
+def test_decision_rules_answer_obvious_cases_and_escalate_the_rest():
+    from decision_rules import DecisionRules
+    from npc import NPC
+    game_map = GameMap(IMAGE_PATH)
+    rules = DecisionRules()
+    red, blue = NPC(5, 5, (255, 0, 0)), NPC(30, 30, (0, 0, 255))
+    try:
+        red.hunger, red.food = 90, 20
+        assert rules.decide(red, game_map, [red, blue]) == {'type': 'eat'}  # in Red's House
+        red.food = 0
+        assert rules.decide(red, game_map, [red, blue]) == {'type': 'pathfind', 'target': 'Village:Shop'}
+        red.hunger, red.currency = 10, 0
+        assert rules.decide(red, game_map, [red, blue]) == {'type': 'pathfind', 'target': 'Village:Workplace'}
+        red.currency, red.social = 100, 5
+        assert rules.decide(red, game_map, [red, blue]) == {'type': 'pathfind', 'target': 'BLUE'}
+        red.x, red.y = 31, 30
+        assert rules.decide(red, game_map, [red, blue])['type'] == 'converse'
+        red.social = 80
+        assert rules.decide(red, game_map, [red, blue]) is None  # nothing obvious, ask the LLM
+
+        red.brain.apply_decision({'type': 'pathfind', 'target': 'Village:Shop'}, game_map, [red, blue])
+        assert game_map.shop.contains_point(*red.action_queue[0].target)
+        stats = rules.stats()
+        assert stats['handled'] == 5 and stats['escalated'] == 1 and stats['by_rule']['socialize_when_lonely'] == 2
+    finally:
+        red.despawn()
+        blue.despawn()
+
+
+def test_plans_queue_every_step_and_a_failed_step_drops_the_rest():
+    import llm
+    from npc import NPC
+    from plans import PLANS, decision_error
+    game_map = GameMap(IMAGE_PATH)
+    assert 'queue_multiple_actions' in [f['name'] for f in llm.decision_functions()]
+    red, blue = NPC(5, 5, (255, 0, 0)), NPC(30, 30, (0, 0, 255))
+    try:
+        plan = {'type': 'queue_multiple_actions', 'actions': [
+            {'name': 'pathfind', 'arguments': '{"target": "Village:Shop"}'},
+            {'name': 'buy_food'},
+            {'name': 'converse', 'target': 'BLUE', 'message': 'Hi'},
+            {'name': 'pathfind', 'target': 'Nowhere'},  # cut here, and everything after it
+            {'name': 'eat'},
+        ]}
+        red.brain.apply_decision(plan, game_map, [red, blue])
+        assert [a.type for a in red.action_queue] == ['pathfind', 'buy_food', 'converse']
+        assert red.action_queue[2].target is blue and red.action_queue[0].plan is red.action_queue[2].plan
+        assert decision_error(plan, game_map, [red, blue], red) is None
+        assert decision_error({'type': 'queue_multiple_actions', 'actions': [{'name': 'fly'}]}, game_map, [red, blue], red)
+        talk_to_self = {'type': 'converse', 'target': 'RED', 'message': 'Hi'}
+        assert decision_error(talk_to_self, game_map, [red, blue], red) == "RED is yourself"
+        assert decision_error({'type': 'queue_multiple_actions', 'actions': [talk_to_self]}, game_map, [red, blue], red)
+
+        # not in the Shop, so buying fails and the rest of its plan goes with it
+        red.action_queue.popleft()
+        dropped = PLANS.dropped_steps
+        red._execute_buy_food(red.action_queue[0], game_map)
+        assert not red.action_queue and PLANS.dropped_steps == dropped + 1
+
+        PLANS.policy = 'continue'
+        red.brain.apply_decision({'type': 'queue_multiple_actions', 'actions': [{'name': 'buy_food'}, {'name': 'eat'}]}, game_map, [red, blue])
+        red._execute_buy_food(red.action_queue[0], game_map)
+        assert [a.type for a in red.action_queue] == ['eat']
+    finally:
+        PLANS.policy = 'abort'
+        red.despawn()
+        blue.despawn()
+
+
+def test_prefetched_decision_is_used_only_if_the_projection_held():
+    from npc import NPC
+    from llm import decision_targets
+    from prefetch import Prefetcher, PREFETCH_PENDING
+    from llm_governor import DECISION
+
+    class Pipeline:
+        def submit(self, owner, coroutine, apply, fail=None, priority=None, npc=None):
+            self.arguments = dict(coroutine.cr_frame.f_locals)  # what decide() was called with
+            coroutine.close()
+            self.apply = apply
+
+        def promote(self, owner, priority):
+            self.promoted = (owner, priority)
+
+    game_map = GameMap(IMAGE_PATH)
+    pipeline = Pipeline()
+    prefetcher = Prefetcher(pipeline=pipeline)
+    red = NPC(5, 5, (255, 0, 0))
+    blues = [NPC(8, 5, (0, 0, 255)), NPC(9, 5, (0, 0, 255))]
+    try:
+        red.queue_action('do_job')
+        red.queue_action('activity', message='reads a book')
+        prefetcher.request(red, game_map, [red] + blues, [])
+        projection = prefetcher.prefetches[red].projection
+        assert projection.currency == red.currency + 10 and projection.hunger == red.hunger + 2
+        # the same tool schemas as RED's and everyone else's decisions, each name once
+        assert pipeline.arguments['npc'] is red and pipeline.arguments['all_npcs'] == [red] + blues
+        assert decision_targets(game_map, pipeline.arguments['all_npcs'], red)[0] == ('BLUE',)
+        state = "\n".join(m.content for m in pipeline.arguments['messages'])
+        assert "pathfind/converse to: ['BLUE', 'BLUE']" in state  # RED isn't offered itself
+
+        red.action_queue.clear()  # both done, but not in the Workplace so no money was made
+        assert prefetcher.take(red, game_map) is None and prefetcher.mismatched == 1
+
+        red.queue_action('activity', message='reads a book')
+        prefetcher.request(red, game_map, [red], [])
+        red.action_queue.clear()
+        red.hunger += 1
+        assert prefetcher.take(red, game_map) is PREFETCH_PENDING
+        assert pipeline.promoted == (('prefetch', red), DECISION)  # RED idles on it now
+        pipeline.apply(({'type': 'eat'}, ['history']))
+        assert prefetcher.take(red, game_map) == ({'type': 'eat'}, ['history'])
+        assert prefetcher.stats()['committed'] == 1
+    finally:
+        for npc in [red] + blues:
+            npc.despawn()
+
+
+def test_committed_prefetch_is_not_starved_by_newer_decisions():
+    import asyncio
+    import threading
+    import time
+    from llm_governor import LLMGovernor, DECISION, SPECULATIVE
+    from llm_pipeline import LLMPipeline
+    governor = LLMGovernor(max_in_flight=1)
+    pipeline = LLMPipeline()
+    released = threading.Event()
+    order = []
+
+    async def send(name):
+        while name == 'first' and not released.is_set():
+            await asyncio.sleep(0.001)
+        order.append(name)
+
+    def call(name):
+        return governor.call(lambda: send(name), tokens=10)
+
+    try:
+        pipeline.submit('first', call('first'), lambda result: None)
+        pipeline.submit(('prefetch', 'red'), call('prefetch'), lambda result: None, priority=SPECULATIVE)
+        for name in ['blue', 'green', 'yellow']:
+            pipeline.submit(name, call(name), lambda result: None)
+        while len(governor.waiting) < 4:
+            time.sleep(0.001)
+        pipeline.promote(('prefetch', 'red'), DECISION)  # RED's queue ran out and it committed
+        released.set()
+        while pipeline.in_flight():
+            time.sleep(0.001)
+            pipeline.collect()
+    finally:
+        pipeline.close()
+    assert order == ['first', 'prefetch', 'blue', 'green', 'yellow']
+
+
+def test_decisions_are_validated_locally_with_bounded_retries():
+    import asyncio
+    import json
+    import llm
+    from langchain.schema import AIMessage, SystemMessage
+    from npc import NPC
+
+    class Backend:
+        model_name = 'scripted'
+
+        def __init__(self, calls):
+            self.calls = list(calls)
+
+        async def apredict_messages(self, messages, **kwargs):
+            self.functions = kwargs['functions']
+            name, args = self.calls.pop(0)
+            if name is None:
+                return AIMessage(content="Hmm.")
+            return AIMessage(content="", additional_kwargs={'function_call': {'name': name, 'arguments': json.dumps(args)}})
+
+    game_map = GameMap(IMAGE_PATH)
+    red, blue = NPC(5, 5, (255, 0, 0)), NPC(30, 30, (0, 0, 255))
+    get_backend, use_cache = llm.get_backend, llm.LLM_CACHE.enabled
+    try:
+        llm.LLM_CACHE.enabled = False
+        backend = Backend([('pathfind', {'target': 'Atlantis'}), ('pathfind', {'target': 'Village:Shop'}),
+                           (None, {}), ('converse', {'target': 'RED', 'message': 'Hi'})])
+        llm.get_backend = lambda: backend
+        retried = llm.DECISIONS['retried']
+        action_data, messages = asyncio.run(llm.decide([SystemMessage(content="decide")], [red, blue], game_map, red))
+        assert action_data == {'type': 'pathfind', 'target': 'Village:Shop'} and llm.DECISIONS['retried'] == retried + 1
+        assert 'Atlantis' in messages[2].content and messages[2].type == 'function'
+        functions = {f['name']: f['parameters']['properties'] for f in backend.functions}
+        assert functions['converse']['target']['enum'] == ['BLUE']  # not RED itself
+        assert 'Village:Shop' in functions['pathfind']['target']['enum'] and 'RED' not in functions['pathfind']['target']['enum']
+
+        action_data, messages = asyncio.run(llm.decide([SystemMessage(content="decide")], [red, blue], game_map, red))
+        assert action_data == llm.fallback_action() and not backend.calls  # LLM_DECISION_RETRIES = 1
+        assert json.loads(messages[-1].additional_kwargs['function_call']['arguments'])['message'] == action_data['message']
+    finally:
+        llm.get_backend, llm.LLM_CACHE.enabled = get_backend, use_cache
+        red.despawn()
+        blue.despawn()
+
+
+def test_vector_memory_recalls_relevant_memories_into_the_context():
+    from vector_memory import VectorMemory
+    from llm import get_context
+    from npc import NPC
+    memory = VectorMemory(capacity=5000)
+    for i in range(700):
+        memory.remember(f"NPC RED walked past tree number {i} near the village square")
+        if i == 300:
+            memory.remember("BLUE said the Shop sells cheap bread in the morning")
+    memory.remember("NPC RED walked past tree number 5 near the village square")  # already known
+    assert len(memory) == 701 and len(memory.index.vectors) == 1024  # grown as needed, not 5000 rows up front
+    assert memory.recall("where can I buy bread at the shop", k=1) == ["BLUE said the Shop sells cheap bread in the morning"]
+    stats = memory.stats()
+    assert stats['approximate_searches'] == 1 and stats['scored_per_search'] < 701
+
+    small = VectorMemory(capacity=2)
+    for text in ["first", "second", "third"]:
+        small.remember(text)
+    assert len(small) == 2 and small.recall("first") == []  # the oldest was forgotten
+    small.remember("second")  # seen again, so "third" is now the least recent
+    small.remember("fourth")
+    assert small.recall("second") == ["second"] and small.recall("third") == []
+
+    game_map = GameMap(IMAGE_PATH)
+    red = NPC(5, 5, (255, 0, 0))
+    try:
+        red.add_log("BLUE said the Shop sells cheap bread in the morning")
+        red.hear("BLUE: the old well is haunted")
+        red.clear_logs()
+        red.hunger = 80
+        context = get_context(red, game_map, [red], [])
+        memories = context.split("Relevant memories:")[1].split("Most recent game logs:")[0]
+        assert "cheap bread" in memories
+    finally:
+        red.despawn()
+
+
+def test_llm_governor_orders_by_priority_and_retries_rate_limits():
+    import asyncio
+    import openai
+    from llm_governor import LLMGovernor, TokenBucket, Caller, CALLER, CONVERSATION, DECISION, SPECULATIVE
+
+    now = [0.0]
+    bucket = TokenBucket(60, burst_s=2, clock=lambda: now[0])  # a token a second, two saved up
+    bucket.take(2)
+    assert bucket.wait(1) == 1.0
+    now[0] = 0.5
+    assert bucket.wait(1) == 0.5
+
+    governor = LLMGovernor(max_in_flight=1, retries=2, backoff_s=0.001)
+    order = []
+
+    async def send(name, release=None):
+        order.append(name)
+        if release:
+            await release.wait()
+        return name
+
+    async def as_caller(owner, priority, name, release=None):
+        CALLER.set(Caller(owner, priority))
+        return await governor.call(lambda: send(name, release), tokens=10)
+
+    async def scenario():
+        release = asyncio.Event()
+        first = asyncio.create_task(as_caller('a', DECISION, 'first', release))
+        await asyncio.sleep(0)
+        waiting = [asyncio.create_task(as_caller(owner, priority, owner))
+                   for owner, priority in [('prefetch', SPECULATIVE), ('idle', DECISION), ('reply', CONVERSATION)]]
+        await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(first, *waiting)
+
+        failures = [openai.error.RateLimitError("slow down", http_status=429)]
+
+        async def flaky():
+            if failures:
+                raise failures.pop()
+            return 'ok'
+        return await governor.call(flaky, tokens=10)
+
+    assert asyncio.run(scenario()) == 'ok'
+    assert order == ['first', 'reply', 'idle', 'prefetch']
+    assert governor.retried == 1 and governor.rate_limited == 1 and not governor.in_flight
+
+    fair = LLMGovernor(max_in_flight=1)
+    order.clear()
+
+    async def call_as(caller, name, release=None):
+        CALLER.set(caller)
+        return await fair.call(lambda: send(name, release), tokens=10)
+
+    async def shares():
+        release = asyncio.Event()
+        first = asyncio.create_task(call_as(Caller('red', DECISION), 'red decision', release))
+        await asyncio.sleep(0)
+        # RED's reply is its own request but counts against RED's share, BLUE asked later yet goes first
+        waiting = [asyncio.create_task(call_as(Caller(('reply', 'blue', 'red'), DECISION, npc='red'), 'red reply')),
+                   asyncio.create_task(call_as(Caller('blue', DECISION), 'blue decision'))]
+        await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(first, *waiting)
+
+    asyncio.run(shares())
+    assert order == ['red decision', 'blue decision', 'red reply'] and fair.served == {'red': 2, 'blue': 1}
+
+    aged = LLMGovernor(aging_s=2.0, clock=lambda: now[0])
+    waiter = type('Waiter', (), {'priority': SPECULATIVE, 'enqueued': 0.0})
+    now[0] = 4.5
+    assert aged._class(waiter, now[0]) == CONVERSATION  # waited two aging periods
@@ -0,0 +1,169 @@
+import hashlib
+import re
+from collections import OrderedDict
+from functools import lru_cache
+import numpy as np
+from constants import (MEMORY_EMBEDDING, MEMORY_DIM, MEMORY_CAPACITY, MEMORY_TOP_K, MEMORY_MIN_SCORE, MEMORY_ANN_MIN,
+                       MEMORY_ANN_PROBES)
+
+WORD_PATTERN = re.compile(r"[a-z0-9']+")
+INITIAL_ROWS = 64  # rows a VectorIndex starts with, doubled as it fills up to its capacity
+
+
+@lru_cache(maxsize=65536)
+def _feature_hash(feature):
+    return int.from_bytes(hashlib.blake2b(feature.encode(), digest_size=8).digest(), 'little')
+
+
+def hashing_embedding(text, dim=MEMORY_DIM):
+    """
+    Signed feature hashing of the words and word pairs in text, L2-normalized. Needs no
+    model and is the same in every process, so texts about the same things score high.
+    """
+    words = WORD_PATTERN.findall(text.lower())
+    vector = np.zeros(dim, dtype=np.float32)
+    for feature in words + [f"{a} {b}" for a, b in zip(words, words[1:])]:
+        h = _feature_hash(feature)
+        vector[h % dim] += 1.0 if h >> 63 else -1.0
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+# Picked by name with MEMORY_EMBEDDING in constants.py, each takes (text, dim) and returns a unit vector
+EMBEDDINGS = {
+    'hashing': hashing_embedding,
+}
+
+
+class VectorIndex:
+    """
+    Up to capacity unit vectors in one float32 matrix, which starts small and doubles as
+    it fills. Once it's full the oldest is overwritten, unless add() is told which slot
+    to overwrite. search() scores everything with one matrix product while there are fewer than
+    ann_min vectors. From then on it's approximate, an inverted file index: the vectors
+    are clustered around sqrt(n) centroids (a few rounds of spherical k-means) and only
+    those in the probes clusters nearest the query are scored. The clusters are redone
+    whenever the index has doubled since, or been overwritten once over when it's full.
+    """
+    def __init__(self, dim=MEMORY_DIM, capacity=MEMORY_CAPACITY, ann_min=MEMORY_ANN_MIN, probes=MEMORY_ANN_PROBES, seed=0):
+        self.vectors = np.zeros((min(capacity, INITIAL_ROWS), dim), dtype=np.float32)
+        self.capacity = capacity
+        self.ann_min = ann_min
+        self.probes = probes
+        self.rng = np.random.default_rng(seed)
+        self.centroids = None
+        self.clusters = np.zeros(len(self.vectors), dtype=np.int32)  # slot -> centroid
+        self.trained_at = 0  # self.added when the clusters were made
+        self.added = 0
+        self.searches = 0
+        self.approximate = 0
+        self.scored = 0
+
+    def __len__(self):
+        return min(self.added, self.capacity)
+
+    def _cluster(self, iterations=4):
+        vectors = self.vectors[:len(self)]
+        count = int(np.sqrt(len(vectors)))
+        centroids = vectors[self.rng.choice(len(vectors), count, replace=False)]
+        for _ in range(iterations):
+            assigned = np.argmax(vectors @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assigned, vectors)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            centroids = np.where(norms > 0, sums / np.maximum(norms, 1e-12), centroids)
+        self.centroids = centroids
+        self.clusters[:len(vectors)] = np.argmax(vectors @ centroids.T, axis=1)
+        self.trained_at = self.added
+
+    def _grow(self):
+        rows = min(self.capacity, 2 * len(self.vectors))
+        self.vectors = np.concatenate([self.vectors, np.zeros((rows - len(self.vectors), self.vectors.shape[1]), np.float32)])
+        self.clusters = np.concatenate([self.clusters, np.zeros(rows - len(self.clusters), np.int32)])
+
+    def add(self, vector, slot=None):
+        """Store vector in slot, by default the next free one or the oldest, returns the slot."""
+        if slot is None:
+            slot = self.added % self.capacity
+        if slot >= len(self.vectors):
+            self._grow()
+        self.vectors[slot] = vector
+        self.added += 1
+        if len(self) >= self.ann_min and (self.centroids is None or self.added >= 2 * self.trained_at
+                                          or self.added - self.trained_at >= self.capacity):
+            self._cluster()
+        elif self.centroids is not None:
+            self.clusters[slot] = np.argmax(self.centroids @ vector)
+        return slot
+
+    def search(self, vector, k):
+        """Up to k (slot, score) pairs, best first, score being the dot product."""
+        size = len(self)
+        if not size or k <= 0:
+            return []
+        self.searches += 1
+        candidates = None
+        if self.centroids is not None:
+            nearest = np.argsort(-(self.centroids @ vector))[:self.probes]
+            found = np.flatnonzero(np.isin(self.clusters[:size], nearest))
+            if len(found) >= k:
+                candidates = found
+                self.approximate += 1
+        if candidates is None:
+            candidates = np.arange(size)
+        scores = self.vectors[candidates] @ vector
+        self.scored += len(candidates)
+        best = np.argpartition(-scores, k - 1)[:k] if len(candidates) > k else np.arange(len(candidates))
+        best = best[np.argsort(-scores[best])]
+        return [(int(candidates[i]), float(scores[i])) for i in best]
+
+
+class VectorMemory:
+    """
+    One NPC's long-term memory: observations and conversation turns, embedded with embed
+    and kept in a VectorIndex. Once it's full the memory seen least recently is forgotten.
+    A text it already holds isn't stored twice, it counts as seen again. recall()
+    returns the k texts most like a query that score at least min_score.
+    """
+    def __init__(self, embed=None, dim=MEMORY_DIM, capacity=MEMORY_CAPACITY, min_score=MEMORY_MIN_SCORE):
+        self.embed = embed or EMBEDDINGS[MEMORY_EMBEDDING]
+        self.dim = dim
+        self.min_score = min_score
+        self.capacity = capacity
+        self.index = VectorIndex(dim=dim, capacity=capacity)
+        self.texts = []  # slot -> text
+        self.slots = OrderedDict()  # text -> slot, least recently seen first
+
+    def __len__(self):
+        return len(self.index)
+
+    def remember(self, text):
+        if not text.strip():
+            return
+        if text in self.slots:
+            self.slots.move_to_end(text)
+            return
+        slot = None
+        if len(self.slots) >= self.capacity:
+            _, slot = self.slots.popitem(last=False)  # full, the least recently seen goes
+        slot = self.index.add(self.embed(text, self.dim), slot)
+        if slot == len(self.texts):
+            self.texts.append(text)
+        else:
+            self.texts[slot] = text
+        self.slots[text] = slot
+
+    def recall(self, query, k=MEMORY_TOP_K, exclude=()):
+        """The k memories most relevant to query, best first, leaving out the texts in exclude."""
+        hits = self.index.search(self.embed(query, self.dim), k + len(exclude))
+        texts = [self.texts[slot] for slot, score in hits if score >= self.min_score]
+        return [text for text in texts if text not in exclude][:k]
+
+    def stats(self):
+        index = self.index
+        return {
+            'memories': len(self),
+            'searches': index.searches,
+            'approximate_searches': index.approximate,
+            'scored_per_search': index.scored / index.searches if index.searches else 0.0,
+        }